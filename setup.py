@@ -16,6 +16,7 @@ setuptools.setup(
     package_dir={'': 'src'},
     include_package_data=True,
     install_requires=[
+        'numpy',
         'pandas',
         'pyfaidx',
         'tqdm'
@@ -24,7 +25,9 @@ setuptools.setup(
     entry_points={'console_scripts': (
         'ava = ava.ava:main',
         'pre_ava = ava.pre_ava:main',
-        'post_ava = ava.post_ava:main'
+        'post_ava = ava.post_ava:main',
+        'ava_bench = ava.bench:main',
+        'ava_merge = ava.merge:main'
     )},
     zip_safe=False
 )
\ No newline at end of file
@@ -0,0 +1,18 @@
+import importlib
+
+# The command line entry point and the Python API (see api.py) are loaded on first use, so importing a submodule (e.g.
+# the workers in parallellisation, or python -m ava.ava) doesn't pull in the rest of ava
+_EXPORTS = {"main": "ava.ava", "apply_variants": "ava.api", "load_config": "ava.api", "open_sequences": "ava.api",
+            "read_variants": "ava.api"}
+
+__all__ = list(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Region tables (chromosome -> gene -> ranges) from the metadata CSV, GFF3 or GenBank annotations. Compiled tables are
+# kept in the index cache, so big annotations are only parsed once
+
+import csv
+import gzip
+import pathlib
+import pickle
+import re
+
+from typing import Callable, Dict, Iterable, List, Optional, Set, TextIO, Tuple
+from urllib.parse import unquote
+
+try:
+    from ava.bgzf import is_gzip, plain_name
+    from ava.index_cache import atomic_open, cached_config_path
+    from ava.log_sink import UNREADABLE_FEATURE, Event
+    from ava.metadata_types import Cid, Gid, Regions
+except:
+    # allow imports when run in place
+    from bgzf import is_gzip, plain_name
+    from index_cache import atomic_open, cached_config_path
+    from log_sink import UNREADABLE_FEATURE, Event
+    from metadata_types import Cid, Gid, Regions
+
+Config = Dict[Cid, Dict[Gid, Regions]]
+
+# Suffixes of each format (optionally .gz)
+CSV_SUFFIXES = (".csv",)
+GFF_SUFFIXES = (".gff", ".gff3")
+GENBANK_SUFFIXES = (".gb", ".gbk", ".gbff", ".genbank")
+CONFIG_SUFFIXES = CSV_SUFFIXES + GFF_SUFFIXES + GENBANK_SUFFIXES
+
+CSV_COLUMNS = ("Chromosome_ID", "Gene_ID", "Region")
+
+# Bumped whenever the compiled tables change shape, so old ones in the cache are ignored
+COMPILED_VERSION = 2
+
+def compile_regions(config: Config) -> Dict[str, Dict[str, Tuple[str, List[int]]]]:
+    # Only builtins, so the cache loads whether ava is imported as a package or run in place
+    return {cid: {gid: (regions.strand, [bound for subset in regions for bound in (subset.start, subset.stop)])
+                  for gid, regions in genes.items()} for cid, genes in config.items()}
+
+def expand_regions(compiled: Dict[str, Dict[str, Tuple[str, List[int]]]]) -> Config:
+    return {cid: {gid: Regions(map(range, bounds[::2], bounds[1::2]), strand) for gid, (strand, bounds) in genes.items()}
+            for cid, genes in compiled.items()}
+
+def config_format(path: pathlib.Path) -> Optional[str]:
+    name = plain_name(path).lower()
+    for kind, suffixes in (("csv", CSV_SUFFIXES), ("gff3", GFF_SUFFIXES), ("genbank", GENBANK_SUFFIXES)):
+        if name.endswith(suffixes):
+            return kind
+    return None
+
+def _open_text(path: pathlib.Path) -> TextIO:
+    # utf-8-sig drops the byte order mark some editors (e.g. Excel's CSV UTF-8) start files with
+    if is_gzip(path):
+        return gzip.open(path, 'rt', encoding="utf-8-sig", newline="")
+    return open(path, 'r', encoding="utf-8-sig", newline="")
+
+def _parse_location(text: str, pos: int, strand: str) -> Tuple[List[Tuple[range, str]], int]:
+    for operator in ("complement(", "join(", "order("):
+        if text.startswith(operator, pos):
+            pos += len(operator)
+            inner = "-" if operator == "complement(" and strand == "+" else \
+                    "+" if operator == "complement(" else strand
+            spans = []
+            while True:
+                part, pos = _parse_location(text, pos, inner)
+                spans += part
+                if pos < len(text) and text[pos] == ",":
+                    pos += 1
+                    continue
+                break
+            if pos >= len(text) or text[pos] != ")":
+                raise ValueError(f"missing ) in {text}")
+            return spans, pos + 1
+
+    end = pos
+    while end < len(text) and text[end] not in ",)":
+        end += 1
+    span = text[pos:end]
+    if ":" in span:
+        raise ValueError(f"{span} refers to another sequence")
+    # Partial ends (<, >) are read as if they were exact, and a site between two bases (^) covers no bases
+    bounds = span.replace("<", "").replace(">", "")
+    if "^" in bounds:
+        return [], end
+    if ".." in bounds:
+        start, stop = bounds.split("..")
+    else:
+        start = stop = bounds
+    return [(range(int(start) - 1, int(stop)), strand)], end
+
+def parse_location(text: str) -> Regions:
+    """ Ranges (0-based, end exclusive) of a GenBank style location, e.g. 61..700, complement(5001..5500) or
+        join(complement(10..20),complement(1..5)). complement, join and order nest to any depth. Ranges keep the order
+        they are written in """
+    text = "".join(text.split())
+    spans, pos = _parse_location(text, 0, "+")
+    if pos != len(text):
+        raise ValueError(f"unexpected {text[pos:]} in {text}")
+    strands = {strand for _, strand in spans}
+    return Regions([subset for subset, _ in spans], strands.pop() if len(strands) == 1 else ".")
+
+def load_csv(path: pathlib.Path, select: Callable[[str], bool]) -> Config:
+    """ The metadata CSV: Chromosome_ID, Gene_ID and Region (a GenBank style location) columns """
+    result: Config = {}
+    with _open_text(path) as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError(f"{path} is missing the {', '.join(missing)} column(s)")
+        for row in reader:
+            cid, gid, region = row['Chromosome_ID'], row['Gene_ID'], row['Region']
+            if not select(gid):
+                continue
+            if not region or not region.strip():
+                raise ValueError(f"{path} line {reader.line_num}: gene {gid} has no Region")
+            try:
+                result.setdefault(cid, {})[gid] = parse_location(region)
+            except ValueError as error:
+                raise ValueError(f"{path} line {reader.line_num}: could not read the Region {region} of gene {gid} "
+                                 f"({error})") from None
+    return result
+
+def load_gff3(path: pathlib.Path, select: Callable[[str], bool], feature: str = "gene") -> Config:
+    """ Every feature of type feature, named by its ID (or Name, or Parent). Lines sharing an ID (e.g. the parts of a
+        CDS) are joined in position order """
+    spans: Dict[Tuple[Cid, Gid], List[Tuple[int, int, str]]] = {}
+    with _open_text(path) as f:
+        for line in f:
+            if line.startswith("##FASTA"):
+                break
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 9 or fields[2] != feature:
+                continue
+            attributes = dict(item.split("=", 1) for item in fields[8].split(";") if "=" in item)
+            name = attributes.get("ID") or attributes.get("Name") or attributes.get("Parent")
+            if name is None:
+                continue
+            gid = unquote(name)
+            if not select(gid):
+                continue
+            strand = fields[6] if fields[6] in ("+", "-") else "."
+            spans.setdefault((unquote(fields[0]), gid), []).append((int(fields[3]) - 1, int(fields[4]), strand))
+
+    result: Config = {}
+    for (cid, gid), parts in spans.items():
+        parts.sort()
+        strands = {strand for _, _, strand in parts}
+        result.setdefault(cid, {})[gid] = Regions([range(start, stop) for start, stop, _ in parts],
+                                                  strands.pop() if len(strands) == 1 else ".")
+    return result
+
+def _genbank_features(lines: Iterable[str]):
+    """ (record name, feature key, location, {qualifier: value}) for every feature in a GenBank flat file """
+    name = None
+    in_features = False
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.startswith("LOCUS"):
+            name = line.split()[1]
+            continue
+        if line.startswith("FEATURES"):
+            in_features = True
+            continue
+        if not in_features:
+            continue
+        if line and not line.startswith(" "):
+            # ORIGIN, CONTIG, // and the like end the feature table
+            if current is not None:
+                yield current
+                current = None
+            in_features = False
+            continue
+
+        if len(line) > 5 and line[5] != " ":
+            if current is not None:
+                yield current
+            current = (name, line[5:21].strip(), line[21:].strip(), {})
+        elif current is not None:
+            value = line[21:].strip()
+            if value.startswith("/"):
+                key, _, value = value[1:].partition("=")
+                current[3][key] = value.strip('"')
+            elif not current[3]:
+                # Long locations carry on over several lines
+                current = (current[0], current[1], current[2] + value, current[3])
+    if current is not None:
+        yield current
+
+def load_genbank(path: pathlib.Path, select: Callable[[str], bool],
+                 feature: str = "gene") -> Tuple[Config, List[Event]]:
+    """ Every feature of type feature, on the chromosome named in its LOCUS line, named by its locus_tag (or gene).
+        Returns (regions, warnings) """
+    result: Config = {}
+    warnings: List[Event] = []
+    skipped = 0
+    with _open_text(path) as f:
+        for cid, key, location, qualifiers in _genbank_features(f):
+            name = qualifiers.get("locus_tag") or qualifiers.get("gene")
+            if key != feature or name is None or not select(name):
+                continue
+            try:
+                regions = parse_location(location)
+            except ValueError:
+                skipped += 1
+                continue
+            result.setdefault(cid, {})[name] = regions
+    if skipped:
+        warnings.append((UNREADABLE_FEATURE, f"[WARN] While processing {str(path.absolute())}: skipped {skipped} "
+                         f"features with locations on other sequences or that couldn't be read"))
+    return result, warnings
+
+def gene_selector(genes: Optional[Iterable[str]] = None, pattern: Optional[str] = None) -> Callable[[str], bool]:
+    """ Keep genes listed in genes or matching the regular expression pattern. Everything if neither is given """
+    if genes is None and pattern is None:
+        return lambda gid: True
+    wanted: Set[str] = set(genes or ())
+    expression = re.compile(pattern) if pattern is not None else None
+    return lambda gid: gid in wanted or (expression is not None and expression.search(gid) is not None)
+
+def split_genes(config: Config, genes: Optional[Iterable[str]] = None,
+                pattern: Optional[str] = None) -> Tuple[Config, Dict[Cid, Set[Gid]]]:
+    """ (the genes of config gene_selector keeps, {cid: the genes it leaves out}) """
+    select = gene_selector(genes, pattern)
+    kept: Config = {}
+    left_out: Dict[Cid, Set[Gid]] = {}
+    for cid, values in config.items():
+        for gid, regions in values.items():
+            if select(gid):
+                kept.setdefault(cid, {})[gid] = regions
+            else:
+                left_out.setdefault(cid, set()).add(gid)
+    return kept, left_out
+
+def load_regions(path: pathlib.Path, genes: Optional[Iterable[str]] = None, pattern: Optional[str] = None,
+                 feature: str = "gene", cache_dir: Optional[pathlib.Path] = None) -> Tuple[Config, List[Event]]:
+    """ (region table, warnings) for a metadata CSV, GFF3 or GenBank file (each optionally gzipped). With cache_dir
+        the table and its warnings are compiled into a pickle there, keyed on the file's fingerprint and the
+        selection, and later reads load that """
+    kind = config_format(path)
+    if kind is None:
+        raise ValueError(f"{path} is not a CSV, GFF3 or GenBank file")
+
+    cached = None
+    if cache_dir is not None:
+        options = f"{COMPILED_VERSION}\0{kind}\0{feature}\0{sorted(genes) if genes is not None else None}\0{pattern}"
+        cached = cached_config_path(path, cache_dir, options)
+        if cached.exists():
+            try:
+                with open(cached, 'rb') as f:
+                    compiled, warnings = pickle.load(f)
+                return expand_regions(compiled), warnings
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # Rebuilt below
+                pass
+
+    select = gene_selector(genes, pattern)
+    warnings: List[Event] = []
+    if kind == "csv":
+        result = load_csv(path, select)
+    elif kind == "gff3":
+        result = load_gff3(path, select, feature)
+    else:
+        result, warnings = load_genbank(path, select, feature)
+
+    if cached is not None:
+        # Written to the side first so an interrupted run doesn't leave a partial table in the cache
+        with atomic_open(cached, 'wb') as f:
+            pickle.dump((compile_regions(result), warnings), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return result, warnings
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+# Library interface. Applies variants and streams the resulting sequences back to the caller instead of writing files
+#
+#   import ava
+#   config = ava.load_config("metadata.csv")
+#   variants = ava.read_variants(["S1_Gene1.csv", "S1_Gene2.csv"], config)
+#   for sid, cid, gid, sequence in ava.apply_variants("reference.fa", config, variants, workers=4):
+#       ...
+
+import os
+import pathlib
+import queue
+
+from multiprocessing import Pool
+from typing import Callable, Dict, IO, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+try:
+    from ava.ava import build_operations, gene_cost, group_by_gene, load_config
+    from ava.fasta_reader import index_reference, open_reference, read_fai
+    from ava.index_cache import default_cache_dir
+    from ava.log_sink import DUPLICATE_GENE, Event
+    from ava.metadata_types import Cid, Gid, Sid
+    from ava.parallellisation import apply_variations, mismatch_events, parse_sample_variants_compat, parse_variant_compat
+    from ava.region_index import RegionIndex
+    from ava.scheduler import schedule
+    from ava.variant_store import VariantSet
+    from ava.vcf import load_vcf
+except:
+    # allow imports when run in place
+    from ava import build_operations, gene_cost, group_by_gene, load_config
+    from fasta_reader import index_reference, open_reference, read_fai
+    from index_cache import default_cache_dir
+    from log_sink import DUPLICATE_GENE, Event
+    from metadata_types import Cid, Gid, Sid
+    from parallellisation import apply_variations, mismatch_events, parse_sample_variants_compat, parse_variant_compat
+    from region_index import RegionIndex
+    from scheduler import schedule
+    from variant_store import VariantSet
+    from vcf import load_vcf
+
+Config = Dict[Cid, Dict[Gid, List[range]]]
+Variants = Dict[Sid, Dict[Cid, Dict[Gid, VariantSet]]]
+# Where warnings go, e.g. LogSink.events or list.extend
+EventCallback = Callable[[List[Event]], None]
+PathLike = Union[str, os.PathLike]
+
+# Most batches handed to the pool per worker before the caller has taken their results
+PENDING_PER_WORKER = 2
+
+class MemoryReference():
+    """ Reference sequences held in memory, with the same fetch() as the file readers """
+    def __init__(self, sequences: Mapping[str, Union[str, bytes]]):
+        self.sequences = {Cid(cid): sequence.encode() if isinstance(sequence, str) else bytes(sequence)
+                          for cid, sequence in sequences.items()}
+
+    @classmethod
+    def from_handle(cls, handle: IO) -> "MemoryReference":
+        """ Read every record of an open FASTA file (text or binary) """
+        sequences: Dict[str, bytes] = {}
+        name = None
+        parts: List[bytes] = []
+        for line in handle:
+            if isinstance(line, str):
+                line = line.encode()
+            if line.startswith(b">"):
+                if name is not None:
+                    sequences[name] = b"".join(parts)
+                name = line[1:].split(maxsplit=1)[0].decode() if line[1:].strip() else ""
+                parts = []
+            elif name is not None:
+                parts.append(line.strip())
+        if name is not None:
+            sequences[name] = b"".join(parts)
+        return cls(sequences)
+
+    def fetch(self, cid: Cid, start: int, stop: int) -> bytes:
+        return self.sequences[cid][start:stop]
+
+    def close(self):
+        pass
+
+class _Events():
+    """ The part of LogSink that build_operations uses, passing events on to a callback """
+    def __init__(self, callback: Optional[EventCallback]):
+        self.callback = callback
+
+    def event(self, category: str, message: str):
+        self.events([(category, message)])
+
+    def events(self, events: List[Event]):
+        if events and self.callback is not None:
+            self.callback(events)
+
+def open_sequences(reference, cache_dir: Optional[pathlib.Path] = None) -> Dict[Cid, object]:
+    """ {chromosome: reader} for a FASTA path (plain, gzip or bgzip), a list of paths, an open FASTA handle, or a
+        {chromosome: sequence} mapping """
+    if isinstance(reference, Mapping):
+        reader = MemoryReference(reference)
+        return {cid: reader for cid in reader.sequences}
+    if hasattr(reference, "read"):
+        reader = MemoryReference.from_handle(reference)
+        return {cid: reader for cid in reader.sequences}
+
+    paths = [reference] if isinstance(reference, (str, os.PathLike)) else list(reference)
+    cache_dir = pathlib.Path(cache_dir) if cache_dir is not None else default_cache_dir()
+    result = {}
+    for path in paths:
+        indexed = index_reference(pathlib.Path(path), cache_dir)
+        reader = open_reference(indexed)
+        for cid in read_fai(indexed.index):
+            result[cid] = reader
+    return result
+
+def read_variants(paths: Iterable[PathLike], config: Config, whole_chromosome: bool = False,
+                  log: Optional[EventCallback] = None) -> Variants:
+    """ Read variant files into {sid: {cid: {gid: VariantSet}}}. .vcf files (plain, gzip or bgzip) may hold many
+        samples, .csv files are one sample and gene each ({sid}_{gid}.csv), or one sample across whole chromosomes with
+        whole_chromosome ({sid}.csv) """
+    log_output = _Events(log)
+    compact_cfg = {cid: set(genes) for cid, genes in config.items()}
+    index = RegionIndex(config)
+    result: Variants = {}
+    for path in paths:
+        path = pathlib.Path(path)
+        if path.name.endswith((".vcf", ".vcf.gz")):
+            values, warnings = load_vcf(path, index)
+        elif whole_chromosome:
+            values, warnings = parse_sample_variants_compat((path, index))
+            values = {values[0]: values[1]} if values is not None else {}
+        else:
+            values, warnings = parse_variant_compat((path, compact_cfg, {}))
+            values = {values[0]: {values[1]: {values[2]: values[3]}}} if values is not None else {}
+        log_output.events(warnings)
+
+        for sid, sid_data in values.items():
+            for cid, cid_data in sid_data.items():
+                for gid, variations in cid_data.items():
+                    genes = result.setdefault(sid, {}).setdefault(cid, {})
+                    if gid in genes:
+                        log_output.event(DUPLICATE_GENE, f"[WARN], variant files for different genes, were for the "
+                                                         f"same gene {gid} from sample {sid}")
+                    genes[gid] = variations
+    return result
+
+def _as_variant_set(variations) -> VariantSet:
+    # Plain {0-based position: (reference, allele)} dicts are accepted too
+    return variations if isinstance(variations, VariantSet) else VariantSet.from_dict(variations)
+
+def _apply_batch(batch) -> Tuple[List[Tuple[Sid, Cid, Gid, bytes]], List[Event]]:
+    """ Pool worker: each gene arrives with its reference region already extracted """
+    results = []
+    events = []
+    for cid, gid, ranges, region, samples in batch:
+        for sid, variations in samples:
+            buffer = bytearray(region)
+            events += mismatch_events(apply_variations(buffer, ranges, variations))
+            results.append((sid, cid, gid, bytes(buffer)))
+    return results, events
+
+def apply_variants(reference, config: Union[PathLike, Config], variants: Mapping, workers: int = 1,
+                   log: Optional[EventCallback] = None,
+                   cache_dir: Optional[PathLike] = None) -> Iterator[Tuple[Sid, Cid, Gid, bytes]]:
+    """ Lazily yield (sid, cid, gid, sequence) for every sample and gene in variants, with the gene's config ranges
+        read from the reference, concatenated, and the sample's variants applied.
+
+        reference: anything open_sequences accepts. config: a metadata file or the result of load_config.
+        variants: {sid: {cid: {gid: VariantSet or {0-based position: (reference, allele)}}}}, e.g. from read_variants.
+        workers: processes to use. With more than 1, results come back in the order they finish.
+        log: called with lists of (category, message) warnings, e.g. a LogSink's events.
+        cache_dir: where reference indexes are kept, defaulting to the same cache as the ava command """
+    log_output = _Events(log)
+    if not isinstance(config, Mapping):
+        config = load_config(pathlib.Path(config), log_output=log_output)
+    chromosomes = open_sequences(reference, cache_dir)
+    variants = {sid: {cid: {gid: _as_variant_set(variations) for gid, variations in cid_data.items()}
+                      for cid, cid_data in sid_data.items()} for sid, sid_data in variants.items()}
+
+    genes = group_by_gene(build_operations(variants, chromosomes, config, log_output))
+    try:
+        if workers <= 1:
+            for cid, gid, ranges, reader, samples in genes:
+                region = b"".join(reader.fetch(cid, subset.start, subset.stop) for subset in ranges)
+                results, events = _apply_batch([(cid, gid, ranges, region, samples)])
+                log_output.events(events)
+                yield from results
+            return
+
+        # imap_unordered's feeder thread would drain a generator of batches straight away, reading every region into
+        # the pool's queue before the first result comes back. Instead batches go out a few at a time, with their
+        # regions read as they go, so no more than a window of them is held in memory however slowly results are used
+        finished: "queue.Queue" = queue.Queue()
+        batches = iter(schedule(genes, gene_cost, workers))
+        pending = 0
+        with Pool(workers) as pool:
+            while True:
+                while pending < workers * PENDING_PER_WORKER:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    regions = [(cid, gid, ranges, b"".join(reader.fetch(cid, subset.start, subset.stop)
+                                                           for subset in ranges), samples)
+                               for cid, gid, ranges, reader, samples in batch]
+                    pool.apply_async(_apply_batch, (regions,), callback=finished.put, error_callback=finished.put)
+                    pending += 1
+                if not pending:
+                    break
+                result = finished.get()
+                pending -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                results, events = result
+                log_output.events(events)
+                yield from results
+    finally:
+        for reader in set(chromosomes.values()):
+            reader.close()
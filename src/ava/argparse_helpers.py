@@ -28,3 +28,14 @@ class ValidOutput(object):
         if path.parent.exists() and path.parent.is_dir():
             return path
         raise argparse.ArgumentTypeError(f"{value} is not a valid folder path. Ensure that {path.parent.name} exists")
+
+class ValidShard(object):
+    """ Check this is a valid shard - i/N, 1 <= i <= N """
+    def __new__(cls, value):
+        try:
+            shard, shards = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"{value} is not a valid shard. Expecting i/N, e.g. 1/4")
+        if not 1 <= shard <= shards:
+            raise argparse.ArgumentTypeError(f"{value} is not a valid shard. Expecting 1 <= i <= N")
+        return shard, shards
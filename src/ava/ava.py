@@ -4,319 +4,505 @@
 
 import argparse
 import errno
-from io import TextIOWrapper
+import multiprocessing
 from multiprocessing import Pool
 import os
 import pathlib
+import re
 
-import pandas
-
+from contextlib import nullcontext
 from typing import List, Dict, Set, Tuple
-from pyfaidx import Fasta, FastaRecord, MutableFastaRecord
 
-from tqdm import tqdm
+# tqdm is imported inside the functions that use it, and pandas only by the variant parsers. Spawned pool workers
+# import this module too, and shouldn't pay for either
 try:
-    from ava.argparse_helpers import ValidFolder, ValidFile, ValidOutput
-    from ava.metadata_types import Cid, Gid, Sid
-    from ava.parallellisation import parse_variant_compat, process_variations_compat
+    from ava.argparse_helpers import ValidFolder, ValidFile, ValidOutput, ValidShard
+    from ava.annotations import CONFIG_SUFFIXES, load_regions, split_genes
+    from ava.catalog import Catalog
+    from ava.fasta_reader import index_reference, read_fai
+    from ava.index_cache import default_cache_dir, fingerprint
+    from ava.log_sink import DUPLICATE_GENE, MISSING_CHROMOSOME, MISSING_RANGES, NO_OUTPUT, LogSink
+    from ava.manifest import Manifest, member_key, operation_digest, variants_digest
+    from ava.metadata_types import Cid, Gid, Reference, Regions, Sid
+    from ava.collector import LAYOUTS, RecordCollector, output_file_name
+    from ava.parallellisation import (OutputOptions, init_worker, parse_sample_variants_compat, parse_variant_compat,
+                                      process_batch, process_gene_compat, process_haplotypes_compat,
+                                      process_sites_compat, process_variations_compat)
+    from ava.profiling import RunProfile
+    from ava.region_index import RegionIndex
+    from ava.scheduler import estimate_cost, schedule
+    from ava.shared_reference import SharedReference
+    from ava.sharding import (SHARD_MODES, done_marker_path, select_shard, shard_suffix, stable_hash,
+                              write_done_marker)
+    from ava.sites import SITE_FORMATS, site_file_name
+    from ava.variant_store import VariantSet
+    from ava.vcf import load_vcf
 except:
     # allow imports when run in place
-    from argparse_helpers import ValidFolder, ValidFile, ValidOutput
-    from metadata_types import Cid, Gid, Sid
-    from parallellisation import parse_variant_compat, process_variations_compat
+    from argparse_helpers import ValidFolder, ValidFile, ValidOutput, ValidShard
+    from annotations import CONFIG_SUFFIXES, load_regions, split_genes
+    from catalog import Catalog
+    from fasta_reader import index_reference, read_fai
+    from index_cache import default_cache_dir, fingerprint
+    from log_sink import DUPLICATE_GENE, MISSING_CHROMOSOME, MISSING_RANGES, NO_OUTPUT, LogSink
+    from manifest import Manifest, member_key, operation_digest, variants_digest
+    from metadata_types import Cid, Gid, Reference, Regions, Sid
+    from collector import LAYOUTS, RecordCollector, output_file_name
+    from parallellisation import (OutputOptions, init_worker, parse_sample_variants_compat, parse_variant_compat,
+                                  process_batch, process_gene_compat, process_haplotypes_compat,
+                                  process_sites_compat, process_variations_compat)
+    from profiling import RunProfile
+    from region_index import RegionIndex
+    from scheduler import estimate_cost, schedule
+    from shared_reference import SharedReference
+    from sharding import (SHARD_MODES, done_marker_path, select_shard, shard_suffix, stable_hash,
+                          write_done_marker)
+    from sites import SITE_FORMATS, site_file_name
+    from variant_store import VariantSet
+    from vcf import load_vcf
+
+def load_sequences(sequence_paths: List[pathlib.Path], cache_dir: pathlib.Path) -> Dict[Cid, Reference]:
+    from tqdm import tqdm
 
-def load_sequences(sequence_paths: List[pathlib.Path]) -> Dict[FastaRecord, Fasta]:
     result = {}
 
     for path in tqdm(sequence_paths, desc="Loading sequence files: "):
-        data = Fasta(path.absolute(), one_based_attributes=False)
-        for cid in data:
-            result[cid.name] = data
-    return result
-
-def load_config(cfg_file: pathlib.Path):
-    result: Dict[Cid, Dict[Gid, List[range]]] = {}
-
-    cfg = pandas.read_csv(str(cfg_file.absolute()))
-
-    # Get a list of genes in each chromosome
-    for cid, gid, region_str in zip(cfg['Chromosome_ID'], cfg['Gene_ID'], cfg['Region']):
-        if not cid in result:
-            result[cid] = {}
-        region_str: str
-        regions: List[range] = []
-        prefix = "complement("
-        suffix = ")"
-        if region_str.startswith(prefix):
-            region_str = region_str.removeprefix(prefix).removesuffix(suffix)
-        prefix = "join("
-        if region_str.startswith(prefix):
-            region_str = region_str.removeprefix(prefix).removesuffix(")")
-        for region in region_str.split(","):
-            values = region.split("..")
-            regions.append(range(int(values[0]) - 1, int(values[1])))
-        result[cid][gid] = regions
-
+        # Index into the cache rather than next to the input, and reuse it on later runs
+        reference = index_reference(path, cache_dir)
+        for cid in read_fai(reference.index):
+            result[cid] = reference
     return result
 
-def parse_variant(variant_path: pathlib.Path, info: dict[Cid, Set[Gid]], log_output: TextIOWrapper):
-    name = variant_path.name
-    gid: Gid | None = None
-    data = pandas.read_csv(str(variant_path.absolute()))
-
-    if not len(data):
-        log_output.write(f"[WARN] While parsing {str(variant_path.absolute())}: File has no entries. Unable to map "
-                         f"variants to a known chromosomes detected in same file. Skipping.\n")
-        return None
-
-    # Get the first value
-    ch = data["Chromosome"][0]
-
-    # See if there's a gene in this chromosome in the file name
-    sid = None
-    gid = None
-    for gene in info[ch]:
-        if gene in name:
-            sid = name.removesuffix(variant_path.suffix).removesuffix(gene).removesuffix("_")
-            gid = gene
-            break
-
-    if sid == None:
-        return None
-
-    sid: Sid
-    gid: Gid
-
-    # Get the variation data
-    prev_region = ""
-    prev_allele = ""
-    variances: Dict[int, Tuple[str, str]] = {}
-
-    for cid, region, ref, allele in zip(data["Chromosome"], data["Region"], data["Reference"], data["Allele"]):
-        if (cid != ch):
-            log_output.write(f"[WARN] While parsing {str(variant_path.absolute())}: multiple chromosomes detected in"
-                             f" same file. This will cause unexpected behaviour\n")
-
-        # Check for an edge case for two regions with different alleles
-        if prev_region == region and allele != ref and prev_allele != ref:
-            log_output.write(f"[WARN] Unexpected event. Found an instance in {str(variant_path.absolute())} where "
-                             f"neither allele - ({allele} and {prev_allele}) did not match the reference: {ref} at position {region}\n")
-
-        prev_region = region
-        prev_allele = allele
-
-        # Skip instances where this was not the variance
-        if allele == ref:
-            continue
-
-        variances[int(region) - 1] = (ref, allele)
-
-    return (sid, ch, gid, variances)
+def load_config(cfg_file: pathlib.Path, genes: List[str] = None, pattern: str = None, feature: str = "gene",
+                cache_dir: pathlib.Path = None, log_output: LogSink = None) -> Dict[Cid, Dict[Gid, Regions]]:
+    """ Regions of each gene from the metadata CSV, or a GFF3 or GenBank annotation (features of type feature).
+        genes and pattern pick out which genes to keep. With cache_dir the parsed table is reused on later runs.
+        Warnings (e.g. GenBank features that couldn't be read) go to log_output when given """
+    cfg, warnings = load_regions(cfg_file, genes, pattern, feature, cache_dir)
+    if log_output is not None:
+        log_output.events(warnings)
+    return cfg
 
 def load_variants(variant_paths: List[pathlib.Path], cfg_file: pathlib.Path, cfg: dict[Cid, Set[Gid]],
-                  log_output: TextIOWrapper):
+                  log_output: LogSink, workers: int = None, index: RegionIndex = None,
+                  left_out: Dict[Cid, Set[Gid]] = None):
+    """ Parse the variant files. By default each file holds one gene of one sample, named {sid}_{gid}.csv. With an
+        index each file holds whole chromosomes for one sample, named {sid}.csv, and is routed to genes by position.
+        Files of genes in left_out (not picked by --genes or --gene-pattern) are skipped quietly """
+    from tqdm import tqdm
+
     # Remove cfg file from variant (if present)
     if cfg_file in variant_paths:
         variant_paths.remove(cfg_file)
 
-    result: Dict[Sid, Dict[Cid, Dict[Gid, Dict[int, Tuple[str, str]]]]] = {}
-
-    # Todo use parallel implementation if requested
-    for variant in tqdm(variant_paths, desc="Loading variant files: "):
-        values: tuple[Sid, Gid, Dict[int, Tuple[str, str]]] | None = parse_variant(variant, cfg, log_output)
-        if values is None:
-            continue
-        sid, cid, gid, ranges = values
+    result: Dict[Sid, Dict[Cid, Dict[Gid, VariantSet]]] = {}
+
+    # Parse the files across a pool, keeping submission order so duplicates resolve the same way every run
+    workers = workers or os.cpu_count() or 1
+    with Pool(workers) as pool:
+        chunksize = max(1, len(variant_paths) // (workers * 4))
+        if index is None:
+            parse = parse_variant_compat
+            tasks = [(variant, cfg, left_out or {}) for variant in variant_paths]
+        else:
+            parse = parse_sample_variants_compat
+            tasks = [(variant, index) for variant in variant_paths]
+        for values, warnings in tqdm(pool.imap(parse, tasks, chunksize=chunksize),
+                                     total=len(tasks), desc="Loading variant files: "):
+            log_output.events(warnings)
+            if values is None:
+                continue
+            if index is None:
+                sid, cid, gid, ranges = values
+                values = (sid, {cid: {gid: ranges}})
+            sid, sid_data = values
 
-        if not sid in result:
-            result[sid] = {}
+            if not sid in result:
+                result[sid] = {}
 
-        if not cid in result[sid]:
-            result[sid][cid] = {}
+            for cid, cid_data in sid_data.items():
+                if not cid in result[sid]:
+                    result[sid][cid] = {}
 
-        if (gid in result[sid]):
-            log_output.write(f"[WARN], variant files for different genes, were for the same gene {gid} from sample {sid}\n")
+                for gid, ranges in cid_data.items():
+                    if (gid in result[sid][cid]):
+                        log_output.event(DUPLICATE_GENE, f"[WARN], variant files for different genes, were for the "
+                                                         f"same gene {gid} from sample {sid}")
 
-        result[sid][cid][gid] = ranges
+                    result[sid][cid][gid] = ranges
 
     return result
 
-def process_variations(args: Tuple[pathlib.Path, Tuple[Sid, Cid, Gid, List[range], Dict[int, Tuple[str, str]],
-                                                      FastaRecord], TextIOWrapper]):
-    output_root, data, log_output = args
-    # Create a temp file and copy the contents of
-    sid, cid, gid, ranges, variations, record = data
-    temp_file = output_root / f"{cid}_{sid}_{gid}_temp.fa"
-    with open(temp_file, 'w') as f:
-        f.write(f">{record.name}\n")
-        for line in record:
-            f.write(f"{str(line)}\n")
-
-    # temp file has been created. Open it as a fasta, but make it mutable
-    fasta = Fasta(temp_file.absolute(), one_based_attributes=False, mutable=True)
-    mutable = fasta[cid]
-
-    failed_modifications = []
-
-    # Apply changes gloablly for this sample
-    for index, [current, new] in variations.items():
-        if (mutable[index] != current):
-            log_output.write(f"[WARN] while processing varations, position {index + 1} was expecting {current}, but "
-                             f"found {mutable[index]}. Skipping\n")
+def build_operations(variants: Dict[Sid, Dict[Cid, Dict[Gid, VariantSet]]], chromosomes: Dict[Cid, Reference],
+                     cfg: Dict[Cid, Dict[Gid, List[range]]], log_output: LogSink):
+    # convert every permutation in variants to a big list
+    operations: List[Tuple[Sid, Cid, Gid, List[range], VariantSet, Reference]] = []
 
-        try:
-            mutable[index] = new
-            continue
-        except OSError as e:
-            # Fault in pyfaidx with newlines. Can circumvent this by modifying 2 chars, but depends on the location
-            if index % 60 == 1 and index > 0:
-                # use the character before
-                mutable[index - 1 : index + 1] = str(mutable[index - 1]) + new
+    for sid, sid_data in variants.items():
+        for cid, cid_data in sid_data.items():
+            if cid not in chromosomes:
+                log_output.event(MISSING_CHROMOSOME, f"[WARN] chromosome {cid} was not found in sequences when trying "
+                                                     f"to process sample {sid}.")
                 continue
 
-            if index % 60 == 0 and index + 1 < len(mutable):
-                mutable[index:index + 1] = new + str(mutable[index + 1])
-                continue
+            for gid, gid_data in cid_data.items():
+                # Get the range data from the
 
-            # hail mary
-            try:
-                mutable[index - 1 : index + 1] = str(mutable[index - 1]) + new
-                continue
-            except:
-                pass
-            try:
+                if cid not in cfg or gid not in cfg[cid]:
+                    log_output.event(MISSING_RANGES, f"[WARN] output ranges for {cid}_{sid}_{gid} could not be found "
+                                                     f"in the metadata file.")
+                    continue
 
-                mutable[index:index + 1] = new + str(mutable[index + 1])
-                continue
-            except:
-                pass
-
-            # rip in peace
-            log_output.writable(f"Fatal Error. While processing {sid}_{cid}_{gid} unable to modify {current} to {new} "
-                                "at position {index + 1} due to a bug in pyfaidx with single characters but my "
-                                "workaround didn't work.\n")
-
-            raise e
-
-    # Same subsections of each file
-    # Unclear what to do with ranges here - For now assume to just concatenate everything
-    ext_name = f"{cid}_{sid}_{gid}"
-    output_file = output_root / f"{ext_name}.fa"
-    with open(output_file, 'w') as f:
-        f.write(f">{ext_name}\n")
-        temp = ""
-        for subset in ranges:
-            for i in range(subset.start, subset.stop):
-                temp += str(mutable[i])
-                if len(temp) % 61 == 60:
-                    #60th character, + new lines before it
-                    temp += "\n"
-        if (temp[-1] != "\n"):
-            temp += "\n"
-        temp += "\n"
-        f.write(temp)
-    # done?
-    fasta.close()
+                operations.append((sid, cid, gid, cfg[cid][gid], gid_data, chromosomes[cid]))
+
+    return operations
+
+def group_by_gene(operations: List[Tuple[Sid, Cid, Gid, List[range], VariantSet, Reference]]):
+    # Collapse the operations for each gene so its reference region is extracted once for all samples
+    genes: Dict[Tuple[Cid, Gid], Tuple[Cid, Gid, List[range], Reference, List[Tuple[Sid, VariantSet]]]] = {}
+    for sid, cid, gid, ranges, variations, reference in operations:
+        if (cid, gid) not in genes:
+            genes[(cid, gid)] = (cid, gid, ranges, reference, [])
+        genes[(cid, gid)][4].append((sid, variations))
+    return list(genes.values())
+
+def group_by_haplotype(operations: List[Tuple[Sid, Cid, Gid, List[range], VariantSet, Reference]]):
+    # Like group_by_gene, but samples with identical variants for a gene share one entry so it is only computed once
+    genes: Dict[Tuple[Cid, Gid], Tuple[Cid, Gid, List[range], Reference, Dict[str, Tuple[VariantSet, List[Sid]]]]] = {}
+    for sid, cid, gid, ranges, variations, reference in operations:
+        if (cid, gid) not in genes:
+            genes[(cid, gid)] = (cid, gid, ranges, reference, {})
+        # VariantSets are sorted and deduplicated when built, so equal variants give equal digests
+        haplotypes = genes[(cid, gid)][4]
+        key = variants_digest(variations)
+        if key not in haplotypes:
+            haplotypes[key] = (variations, [])
+        haplotypes[key][1].append(sid)
+    return [(cid, gid, ranges, reference, list(haplotypes.values())) for cid, gid, ranges, reference, haplotypes
+            in genes.values()]
+
+def write_haplotype_report(path: pathlib.Path,
+                           genes: List[Tuple[Cid, Gid, List[range], Reference, List[Tuple[VariantSet, List[Sid]]]]]):
+    """ Tab separated samples and distinct haplotypes per gene, with how many samples share the most common one """
+    with open(path, 'w') as f:
+        f.write("Chromosome_ID\tGene_ID\tSamples\tHaplotypes\tLargest\n")
+        for cid, gid, _, _, haplotypes in genes:
+            sizes = [len(sids) for _, sids in haplotypes]
+            f.write(f"{cid}\t{gid}\t{sum(sizes)}\t{len(haplotypes)}\t{max(sizes)}\n")
+
+def operation_cost(data: Tuple[Sid, Cid, Gid, List[range], VariantSet, Reference]) -> int:
+    return estimate_cost(data[3], len(data[4]))
+
+def gene_cost(data: Tuple[Cid, Gid, List[range], Reference, List[Tuple[Sid, VariantSet]]]) -> int:
+    return estimate_cost(data[2], sum(len(variations) for _, variations in data[4]), len(data[4]))
+
+def sites_cost(data: Tuple[Cid, Gid, List[range], Reference, List[Tuple[Sid, VariantSet]]]) -> int:
+    # Only the bases under the variants are read and written, so the length of the gene doesn't matter
+    return estimate_cost([], sum(len(variations) for _, variations in data[4]), len(data[4]))
+
+def haplotype_cost(data: Tuple[Cid, Gid, List[range], Reference, List[Tuple[VariantSet, List[Sid]]]]) -> int:
+    # Variants are applied once per haplotype, but every sample is still written
+    return estimate_cost(data[2], sum(len(variations) for variations, _ in data[4]),
+                         sum(len(sids) for _, sids in data[4]))
 
 def main():
+    from tqdm import tqdm
+
     # Load input arguments
 
     parser = argparse.ArgumentParser("ava", description="Allele Variance Applicator")
 
     parser.add_argument("--input", "-i", type=ValidFolder, help="Folder with all the input .csv and .fasta files",
                         default='.')
-    parser.add_argument("--config", '-c', type=ValidFile, help="Configuration/metadata file with regions of interest",
-                        required=True)
+    parser.add_argument("--config", '-c', type=ValidFile, help="Configuration/metadata file with regions of interest. "
+                        "Either a CSV or a GFF3 or GenBank annotation (optionally gzipped)", required=True)
+    parser.add_argument("--genes", nargs="+", default=None, help="Only use these genes from the config. Each value is "
+                        "a gene ID, or a file with one gene ID per line")
+    parser.add_argument("--gene-pattern", type=str, default=None, help="Only use genes from the config whose IDs "
+                        "match this regular expression (as well as any given with --genes)")
+    parser.add_argument("--feature", type=str, default="gene", help="Feature type to read from GFF3 and GenBank "
+                        "configs, e.g. gene, mRNA or CDS (default: %(default)s)")
     parser.add_argument("--output", "-o", type=ValidOutput, help="Folder for all output files to go. Ensure this is not "
                         "the input folder", required=True)
+    parser.add_argument("--vcf", type=ValidFile, nargs="+", help="Multi-sample VCF file(s) (plain, gzip or bgzip) to "
+                        "read variants from instead of the per gene .csv files")
+    parser.add_argument("--whole-chromosome", action="store_true", help="Each .csv file holds the variants of one "
+                        "sample (named after the file) across whole chromosomes, rather than one gene. Variants are "
+                        "routed to the genes whose regions cover them")
+    parser.add_argument("--scan-snapshot", type=ValidOutput, default=None, help="File to save a snapshot of the "
+                        "input folder listing to. Later runs only list folders that have changed since")
+    parser.add_argument("--index-cache", type=pathlib.Path, default=default_cache_dir(), help="Folder to keep the "
+                        "reference .fai indexes in between runs (default: %(default)s)")
+    parser.add_argument("--incremental", action="store_true", help="Skip outputs whose reference region, variants and "
+                        "config ranges are unchanged since the last run into the same output folder")
+    parser.add_argument("--by-gene", action="store_true", help="Group work by gene so each reference region is only "
+                        "read once and shared by every sample")
+    parser.add_argument("--dedup-haplotypes", action="store_true", help="Group work by gene (as --by-gene) and "
+                        "compute each distinct set of variants for a gene once, writing it out for every sample that "
+                        "shares it. Haplotype counts per gene are saved to haplotypes.tsv in the output folder")
+    parser.add_argument("--layout", choices=LAYOUTS, default="file", help="Output layout. file: one file per sample "
+                        "and gene (default), gene: one multi-FASTA per gene with a record per sample, sample: one "
+                        "multi-FASTA per sample with a record per gene")
+    parser.add_argument("--sites", choices=SITE_FORMATS, default=None, help="Instead of whole sequences, write a "
+                        "samples x variable sites matrix per gene: npy (uint8 base codes), phylip or fasta (SNP "
+                        "alignments), each with a .sites.tsv of the positions")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number "
+                        "of CPUs)")
+    parser.add_argument("--shard", type=ValidShard, default=None, help="Only process part i of N (e.g. 1/4) of the "
+                        "outputs, for running N jobs over the same inputs and output folder. Combine them afterwards "
+                        "with ava_merge")
+    parser.add_argument("--shard-by", choices=SHARD_MODES, default="hash", help="How outputs are split between shards. "
+                        "hash: by a hash of their names, cost: balanced by their estimated cost (default: %(default)s)")
+    parser.add_argument("--start-method", choices=multiprocessing.get_all_start_methods(), default=None, help="How "
+                        "worker processes are started (defaults to the platform default, fork on Linux). spawn and "
+                        "forkserver workers only import what the processing needs")
+    parser.add_argument("--chunksize", type=int, default=None, help="Most small tasks to send to a worker at once. By "
+                        "default small tasks are batched by their estimated cost")
+    parser.add_argument("--shared-reference", action="store_true", help="Read the reference regions once in the main "
+                        "process and share them with the workers through shared memory, instead of every task reading "
+                        "them from disk. Uses as much memory as the regions in the config")
+    parser.add_argument("--line-width", type=int, default=60, help="Number of bases per line in the output files "
+                        "(0 to write each sequence on a single line)")
+    parser.add_argument("--compress", action="store_true", help="Write bgzip compressed .fa.gz output files")
+    parser.add_argument("--compress-threads", type=int, default=4, help="Threads compressing the gene and sample "
+                        "layouts, which are written by the main process (default: %(default)s)")
+    parser.add_argument("--profile", action="store_true", help="Record per stage and per task timings, peak memory "
+                        "and I/O to profile.json in the output folder and print a summary")
+    parser.add_argument("--profile-top", type=int, default=0, help="With --profile, also save cProfile stats for this "
+                        "many of the slowest tasks to the profile folder")
 
     args = parser.parse_args()
     input_path: pathlib.Path = args.input
     cfg_path: pathlib.Path = args.config
     output_path: pathlib.Path = args.output
-    log_file_path = output_path / "output.log"
-
+    line_width: int = args.line_width
+    # Shards each keep their own log, summary, manifest... next to each other in the output folder
+    suffix = shard_suffix(*args.shard) if args.shard is not None else ""
+    log_file_path = output_path / f"output{suffix}.log"
+
+    def output_name(sid, cid, gid) -> str:
+        # Variable sites are written per gene whatever the layout
+        if args.sites:
+            return site_file_name(args.sites, cid, gid)
+        return output_file_name(args.layout, sid, cid, gid, args.compress)
+
+    def shard_key(sid, cid, gid) -> str:
+        # Everything going into an output file has to be on the same shard, and whole genes when work is grouped by gene
+        if args.layout != "sample" and (args.sites or args.by_gene or args.dedup_haplotypes):
+            return f"{cid}_{gid}"
+        return output_name(sid, cid, gid)
+
+    profile = RunProfile(args.profile_top) if args.profile else None
+    def stage(name: str):
+        return profile.stage(name) if profile is not None else nullcontext()
 
     # Recursively get relavant files
-    input_sequences: List[pathlib.Path] = [file for file in input_path.glob("**/*.fasta")]
-    input_sequences += [file for file in input_path.glob("**/*.fa")]
-    input_variances: List[pathlib.Path]  = [file for file in input_path.glob("**/*.csv")]
+    with stage("scan_input"):
+        catalog = Catalog(input_path, args.scan_snapshot)
+        input_sequences: List[pathlib.Path] = catalog.sequences
+        input_variances: List[pathlib.Path] = catalog.variants
 
     if (not len(input_sequences)):
-        print("No input files found. Ensure there are .fasta or .fa files in the input folder")
+        print("No input files found. Ensure there are .fasta or .fa files (optionally .gz) in the input folder")
         exit(errno.ENOENT)
 
-    if (not len(input_variances)):
-        print("No variance files were found. Ensure there are .csv files in the input folder")
+    if (not len(input_variances)) and not args.vcf:
+        print("No variance files were found. Ensure there are .csv or .csv.gz files in the input folder")
         exit(errno.ENOENT)
 
-    if cfg_path.suffix != ".csv":
-        print("Expecting a CSV file for the configuration file")
-        exit(errno.EBADF)
+    if line_width < 0:
+        print("Expecting a line width of 0 or more")
+        exit(errno.EINVAL)
 
-    # Check output exists
-    if not output_path.exists():
-        output_path.mkdir()
+    if args.workers is not None and args.workers < 1:
+        print("Expecting at least 1 worker")
+        exit(errno.EINVAL)
 
-    log_file = open(log_file_path, 'w')
-    # Load a list of all genes, Chromosomes and Samples
-    chromosomes = load_sequences(input_sequences)
-    cfg = load_config(cfg_path)
-    compact_cfg = {cid: {gid for gid, pos in values.items()} for cid, values in cfg.items()}
-    variants = load_variants(input_variances, cfg_path, compact_cfg, log_file)
+    if args.chunksize is not None and args.chunksize < 1:
+        print("Expecting a chunksize of at least 1")
+        exit(errno.EINVAL)
 
-    # convert every permutation in variants to a big list
-    operations: List[Tuple[Sid, Cid, Gid, List[range], Dict[int, Tuple[str, str]]], FastaRecord] = []
+    if args.compress_threads < 1:
+        print("Expecting at least 1 compression thread")
+        exit(errno.EINVAL)
 
-    temp_files: Dict[str, FastaRecord] = {}
+    if args.profile_top < 0:
+        print("Expecting --profile-top to be 0 or more")
+        exit(errno.EINVAL)
 
-    print("Performing preprocessing")
-    for sid, sid_data in variants.items():
-        for cid, cid_data in sid_data.items():
-            if cid not in chromosomes:
-                log_file.write(f"[WARN] gene {gid} was not found in sequences when trying to process "
-                                f"{cid}_{sid}_{gid}.\n")
-                continue
-
-            for gid, gid_data in cid_data.items():
-                # Get the range data from the
+    if args.sites and (args.layout != "file" or args.compress or args.dedup_haplotypes):
+        print("--sites can't be combined with --layout, --compress or --dedup-haplotypes")
+        exit(errno.EINVAL)
 
-                if cid not in cfg or gid not in cfg[cid]:
-                    log_file.write(f"[WARN] output ranges for {cid}_{sid}_{gid} could not be found in the metadata file"
-                                   ".\n")
-                    continue
-
-                operations.append((sid, cid, gid, cfg[cid][gid], gid_data,
-                                   pathlib.Path(chromosomes[cid][cid]._fa.filename)))
-
-    if not len(operations):
-        log_file.write(f"Insufficient data. No output files could be created\n")
-    log_file.close()
+    if not cfg_path.name.lower().removesuffix(".gz").endswith(CONFIG_SUFFIXES):
+        print(f"Expecting a CSV, GFF3 or GenBank file for the configuration file ({', '.join(CONFIG_SUFFIXES)}, "
+              f"optionally .gz)")
+        exit(errno.EBADF)
 
-    # Process the variations
-    with Pool() as pool:
-        args = [(output_path, data, log_file_path) for data in operations]
-        # it = pool.map(process_variations_compat, args)
-        # for data in tqdm(operations, desc="Preparing output files:"):
-            # sid, cid, gid, ranges, variations, record = data
-            # process_variations((output_path, args, log_file))
-        for _ in tqdm(pool.imap_unordered(process_variations_compat, args), total=len(args)):
-            pass
-        # for item in tqdm(it, desc="Preparing output files:"):
-        #     pass
+    if args.gene_pattern is not None:
+        try:
+            re.compile(args.gene_pattern)
+        except re.error as e:
+            print(f"Invalid --gene-pattern: {e}")
+            exit(errno.EINVAL)
+
+    genes = None
+    if args.genes is not None:
+        genes = []
+        for value in args.genes:
+            if os.path.isfile(value):
+                with open(value, 'r') as f:
+                    genes += [line.strip() for line in f if line.strip()]
+            else:
+                genes.append(value)
+
+    if args.start_method is not None:
+        multiprocessing.set_start_method(args.start_method, force=True)
 
-    # Clean up cache files
-    files_to_remove: List[pathlib.Path] = []
+    # Check output exists
+    # Shards may all start at once
+    output_path.mkdir(exist_ok=True)
+    if args.shard is not None:
+        done_marker_path(output_path, *args.shard).unlink(missing_ok=True)
 
-    files_to_remove += [file for file in input_path.glob("**/*.fasta.fai")]
-    files_to_remove += [file for file in input_path.glob("**/*.fa.fai")]
+    log_file = LogSink(log_file_path, output_path / f"summary{suffix}.json")
+    # Load a list of all genes, Chromosomes and Samples
+    with stage("load_sequences"):
+        chromosomes = load_sequences(input_sequences, args.index_cache)
+    with stage("load_config"):
+        try:
+            cfg = load_config(cfg_path, feature=args.feature, cache_dir=args.index_cache, log_output=log_file)
+        except ValueError as e:
+            print(f"Unable to read the configuration file: {e}")
+            exit(errno.EINVAL)
+        # Variant files of genes left out on purpose are skipped without a warning
+        cfg, left_out = split_genes(cfg, genes, args.gene_pattern)
+        compact_cfg = {cid: {gid for gid, pos in values.items()} for cid, values in cfg.items()}
+        index = RegionIndex(cfg) if args.vcf or args.whole_chromosome else None
+    with stage("load_variants"):
+        if args.vcf:
+            variants: Dict[Sid, Dict[Cid, Dict[Gid, VariantSet]]] = {}
+            for vcf_path in tqdm(args.vcf, desc="Loading variant files: "):
+                values, warnings = load_vcf(vcf_path, index)
+                log_file.events(warnings)
+                for sid, sid_data in values.items():
+                    for cid, cid_data in sid_data.items():
+                        variants.setdefault(sid, {}).setdefault(cid, {}).update(cid_data)
+        else:
+            variants = load_variants(input_variances, cfg_path, compact_cfg, log_file, args.workers, index, left_out)
 
-    files_to_remove += [file for file in output_path.glob("**/*_temp.fa")]
-    files_to_remove += [file for file in output_path.glob("**/*_temp.fa.fai")]
+    print("Performing preprocessing")
+    with stage("preprocessing"):
+        operations = build_operations(variants, chromosomes, cfg, log_file)
+        if not len(operations):
+            log_file.event(NO_OUTPUT, "Insufficient data. No output files could be created")
+
+        if args.shard is not None:
+            # Every shard logs the same warnings up to here, so ava_merge only keeps one copy of them
+            shared_counts, shared_log_end = log_file.checkpoint()
+            partition = stable_hash("\n".join(sorted({shard_key(*data[:3]) for data in operations})))
+            total_operations = len(operations)
+            operations = select_shard(operations, lambda data: shard_key(*data[:3]), operation_cost, *args.shard,
+                                      args.shard_by)
+            print(f"Shard {args.shard[0]} of {args.shard[1]}: {len(operations)} of {total_operations} operations")
+
+        # Work out what goes into every output file so finished, unchanged ones can be skipped on later runs
+        settings = f"{args.layout}\0{line_width}" + ("\0bgzip" if args.compress else "") + \
+            (f"\0sites={args.sites}" if args.sites else "")
+        reference_ids: Dict[pathlib.Path, str] = {}
+        targets: Dict[str, Dict[str, Dict[str, str]]] = {}
+        for sid, cid, gid, ranges, variations, reference in operations:
+            if reference.path not in reference_ids:
+                reference_ids[reference.path] = fingerprint(reference.path)
+            output = output_name(sid, cid, gid)
+            targets.setdefault(output, {})[member_key(sid, cid, gid)] = operation_digest(
+                reference_ids[reference.path], cid, ranges, variations, settings)
+
+        if args.dedup_haplotypes:
+            # Counted before --incremental drops anything, so the report always covers every output
+            haplotypes = group_by_haplotype(operations)
+            write_haplotype_report(output_path / f"haplotypes{suffix}.tsv", haplotypes)
+            print(f"{sum(len(data[4]) for data in haplotypes)} distinct haplotypes for "
+                  f"{sum(len(sids) for data in haplotypes for _, sids in data[4])} sample genes")
+
+        shard_outputs = sorted(targets)
+        manifest = Manifest(output_path, args.incremental, f"manifest{suffix}.jsonl")
+        if args.incremental:
+            stale = {output for output, members in targets.items() if not manifest.is_fresh(output, members)}
+            print(f"Skipping {len(targets) - len(stale)} unchanged of {len(targets)} output files")
+            operations = [data for data in operations if output_name(*data[:3]) in stale]
+            targets = {output: targets[output] for output in stale}
+        pending = {output: set(members) for output, members in targets.items()}
+
+        # Every region the tasks will read, before grouping changes the shape of the operations
+        regions = [(reference, cid, ranges) for _, cid, _, ranges, _, reference in operations]
+
+        worker = process_variations_compat
+        cost = operation_cost
+        if args.sites:
+            operations = group_by_gene(operations)
+            worker = process_sites_compat
+            cost = sites_cost
+        elif args.dedup_haplotypes:
+            operations = group_by_haplotype(operations)
+            worker = process_haplotypes_compat
+            cost = haplotype_cost
+        elif args.by_gene:
+            operations = group_by_gene(operations)
+            worker = process_gene_compat
+            cost = gene_cost
+
+        # Longest tasks first so the pool doesn't end on a few long genes, with small tasks batched together
+        workers = args.workers or os.cpu_count() or 1
+        batches = schedule(operations, cost, workers, args.chunksize)
+
+    shared = None
+    if args.shared_reference:
+        with stage("share_reference"):
+            shared = SharedReference(regions)
 
-    for file in tqdm(files_to_remove, desc="Cleaning up: "):
-        file.unlink()
+    # Process the variations
+    options = OutputOptions(output_path, line_width, args.layout, args.profile, args.profile_top, args.compress,
+                            args.sites)
+    initargs = (log_file.queue, shared.worker_args() if shared is not None else None)
+    with shared if shared is not None else nullcontext(), stage("process_variations"), \
+            Pool(workers, initializer=init_worker, initargs=initargs) as pool, \
+            RecordCollector(output_path, options.layout, line_width,
+                            args.compress_threads if args.compress else None) as collector, manifest, \
+            tqdm(total=sum(len(targets[output]) for output in targets)) as progress:
+        tasks = [(worker, options, batch) for batch in batches]
+        for done, results, timings in pool.imap_unordered(process_batch, tasks):
+            progress.update(len(done))
+            if profile is not None:
+                profile.add_tasks(timings)
+            # Only aggregated layouts send their sequences back
+            for sid, cid, gid, sequence in results:
+                collector.add(sid, cid, gid, sequence)
+
+            # Record each output file once everything in it has been written
+            for sid, cid, gid in done:
+                output = output_name(sid, cid, gid)
+                pending[output].discard(member_key(sid, cid, gid))
+                if not pending[output]:
+                    collector.finish(output)
+                    manifest.record(output, targets[output])
+
+        # Leaving the with terminates the workers, which could kill one while it's writing events to the log queue and
+        # leave log_file.close() waiting forever. Letting them exit flushes their queues first
+        pool.close()
+        pool.join()
 
+    log_file.close()
+    print(f"Warnings by category:\n{log_file.summary()}")
+    if profile is not None:
+        report_path = profile.write(output_path, suffix)
+        print(f"Profile written to {report_path}\n{profile.summary()}")
+    if args.shard is not None:
+        # Last, so a shard only counts as done once everything it wrote is in place
+        write_done_marker(done_marker_path(output_path, *args.shard), {
+            "shard": args.shard[0], "shards": args.shard[1], "shard_by": args.shard_by, "partition": partition,
+            "settings": settings.replace("\0", " "), "total_operations": total_operations,
+            "shared_counts": shared_counts, "shared_log_end": shared_log_end, "outputs": shard_outputs})
     print(f"Output to {output_path} complete. Check log at {log_file_path} for more details")
 
 if __name__ == "__main__":
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+# Allele Variance Applicator - benchmarks
+# Generates a synthetic project and times each stage of ava (and post_ava) on it
+
+import argparse
+import errno
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+
+try:
+    from ava.argparse_helpers import ValidFile, ValidOutput
+    from ava.ava import (build_operations, gene_cost, group_by_gene, load_config, load_sequences, load_variants,
+                         operation_cost)
+    from ava.log_sink import LogSink, init_worker_log
+    from ava.parallellisation import OutputOptions, process_batch, process_gene_compat, process_variations_compat
+    from ava.post_ava import RestructureOptions, restructure_file
+    from ava.scheduler import schedule
+except:
+    # allow imports when run in place
+    from argparse_helpers import ValidFile, ValidOutput
+    from ava import (build_operations, gene_cost, group_by_gene, load_config, load_sequences, load_variants,
+                     operation_cost)
+    from log_sink import LogSink, init_worker_log
+    from parallellisation import OutputOptions, process_batch, process_gene_compat, process_variations_compat
+    from post_ava import RestructureOptions, restructure_file
+    from scheduler import schedule
+
+BASES = numpy.frombuffer(b"ACGT", dtype=numpy.uint8)
+
+# What each entry point (and the worker processes) import at startup
+ENTRY_MODULES = ("ava.ava", "ava.parallellisation", "ava.pre_ava", "ava.post_ava")
+# Modules the worker module must not pull in
+HEAVY_MODULES = ("pandas", "pyfaidx", "tqdm")
+
+def generate(root: pathlib.Path, chromosomes: int, chromosome_length: int, genes: int, samples: int, snps: int,
+             seed: int = 0) -> Dict[str, int]:
+    """ Write a synthetic project to root: input/reference.fa, input/metadata.csv and input/{sid}_{gid}.csv per sample
+        and gene. Regions use plain, join(...), complement(...) and complement(join(...)) forms. Returns counts of what
+        was written """
+    rng = numpy.random.default_rng(seed)
+    input_path = root / "input"
+    input_path.mkdir(parents=True, exist_ok=True)
+
+    # Reference
+    sequences: Dict[str, bytes] = {}
+    with open(input_path / "reference.fa", 'wb') as f:
+        for c in range(chromosomes):
+            cid = f"Chr_{c + 1:02d}"
+            sequences[cid] = BASES[rng.integers(0, 4, chromosome_length)].tobytes()
+            f.write(f">{cid}\n".encode())
+            f.write(b"\n".join(sequences[cid][i:i + 60] for i in range(0, chromosome_length, 60)) + b"\n")
+
+    # Genes, spread evenly over the chromosomes without overlapping
+    config: Dict[str, tuple] = {}
+    per_chromosome = -(-genes // chromosomes)
+    slot = chromosome_length // per_chromosome
+    with open(input_path / "metadata.csv", 'w') as f:
+        f.write("Chromosome_ID,Gene_ID,Region\n")
+        for g in range(genes):
+            cid = f"Chr_{g // per_chromosome + 1:02d}"
+            gid = f"Gene{g + 1:05d}"
+            start = (g % per_chromosome) * slot
+            exons = int(rng.integers(1, 4))
+            bounds = numpy.sort(rng.choice(numpy.arange(start + 1, start + slot), exons * 2, replace=False))
+            ranges = [(int(bounds[i]), int(bounds[i + 1])) for i in range(0, len(bounds), 2)]
+            region = ",".join(f"{a}..{b}" for a, b in ranges)
+            if exons > 1:
+                region = f"join({region})"
+            if rng.random() < 0.5:
+                region = f"complement({region})"
+            f.write(f'{cid},{gid},"{region}"\n')
+            config[gid] = (cid, ranges)
+
+    # Variants - one file per sample and gene, with the reference allele listed alongside the variant like the
+    # exported variant tables
+    variant_count = 0
+    for s in range(samples):
+        sid = f"S{s + 1:04d}"
+        for gid, (cid, ranges) in config.items():
+            positions = numpy.concatenate([numpy.arange(a, b + 1) for a, b in ranges])
+            chosen = numpy.sort(rng.choice(positions, min(snps, len(positions)), replace=False))
+            lines = ["Chromosome,Region,Type,Reference,Allele,Count"]
+            for position in chosen.tolist():
+                ref = chr(sequences[cid][position - 1])
+                alt = chr(BASES[(BASES.tolist().index(ord(ref)) + int(rng.integers(1, 4))) % 4])
+                lines.append(f"{cid},{position},SNV,{ref},{ref},{int(rng.integers(1, 30))}")
+                lines.append(f"{cid},{position},SNV,{ref},{alt},{int(rng.integers(1, 30))}")
+            variant_count += len(chosen)
+            with open(input_path / f"{sid}_{gid}.csv", 'w') as f:
+                f.write("\n".join(lines) + "\n")
+
+    return {"chromosomes": chromosomes, "reference_bases": chromosomes * chromosome_length, "genes": genes,
+            "samples": samples, "variant_files": samples * genes, "variants": variant_count}
+
+class Timer():
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str, **work):
+        """ Time a block. work is the amount done in it (e.g. files=10, bases=1000) to report throughput """
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        result = {"seconds": seconds}
+        for unit, amount in work.items():
+            result[f"{unit}_per_second"] = amount / seconds if seconds else float("inf")
+        self.stages[name] = result
+
+def run(root: pathlib.Path, counts: Dict[str, int], workers: int, by_gene: bool) -> Dict[str, Dict[str, float]]:
+    """ Time each stage of ava and post_ava over the project in root """
+    timer = Timer()
+    input_path = root / "input"
+    output_path = root / "output"
+    post_path = root / "post_output"
+    for path in (output_path, post_path):
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir()
+    cfg_path = input_path / "metadata.csv"
+    sequences = list(input_path.glob("*.fa"))
+    variant_paths = [path for path in input_path.glob("*.csv") if path != cfg_path]
+
+    log = LogSink(output_path / "output.log")
+    with timer.stage("load_sequences", files=len(sequences), bases=counts["reference_bases"]):
+        # A fresh cache each time so indexing is part of the measurement
+        chromosomes = load_sequences(sequences, root / "index_cache")
+    with timer.stage("load_config", genes=counts["genes"]):
+        cfg = load_config(cfg_path, log_output=log)
+    with timer.stage("load_variants", files=len(variant_paths), variants=counts["variants"]):
+        compact_cfg = {cid: set(values) for cid, values in cfg.items()}
+        variants = load_variants(variant_paths, cfg_path, compact_cfg, log, workers)
+
+    operations = build_operations(variants, chromosomes, cfg, log)
+    output_bases = sum(sum(len(subset) for subset in data[3]) for data in operations)
+    worker = process_variations_compat
+    cost = operation_cost
+    if by_gene:
+        operations = group_by_gene(operations)
+        worker = process_gene_compat
+        cost = gene_cost
+
+    with timer.stage("process_variations", files=counts["variant_files"], bases=output_bases,
+                     variants=counts["variants"]):
+        options = OutputOptions(output_path)
+        batches = schedule(operations, cost, workers)
+        with Pool(workers, initializer=init_worker_log, initargs=(log.queue,)) as pool:
+            for _ in pool.imap_unordered(process_batch, [(worker, options, batch) for batch in batches]):
+                pass
+            # Let the workers flush their log events and exit, rather than being terminated mid write
+            pool.close()
+            pool.join()
+    log.close()
+
+    outputs = list(output_path.glob("*.fa"))
+    with timer.stage("post_ava", files=len(outputs), bases=output_bases):
+        options = RestructureOptions(post_path)
+        with Pool(workers) as pool:
+            for _ in pool.imap_unordered(restructure_file, [(file, options) for file in outputs],
+                                         chunksize=max(1, len(outputs) // (workers * 4))):
+                pass
+
+    return timer.stages
+
+def measure_imports(modules=ENTRY_MODULES) -> Tuple[Dict[str, Dict[str, float]], List[str]]:
+    """ Cold import time of each module in a fresh interpreter, from python -X importtime. Returns (stages, problems),
+        problems being heavy modules that the worker module imported """
+    stages = {}
+    problems = []
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    for module in modules:
+        output = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env,
+                                capture_output=True, text=True, check=True).stderr
+        # import time: self [us] | cumulative | imported package
+        imported = {}
+        for line in output.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.removeprefix("import time:").split("|")
+            if cumulative.strip().isdigit():
+                imported[name.strip()] = int(cumulative)
+        stages[f"import {module}"] = {"seconds": imported.get(module, 0) / 1e6}
+        if module == "ava.parallellisation":
+            problems += [f"{module} imports {heavy}" for heavy in HEAVY_MODULES if heavy in imported]
+    return stages, problems
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    """ Stages that got more than tolerance (a fraction) slower than the baseline """
+    regressions = []
+    for stage, values in results.items():
+        if stage not in baseline:
+            continue
+        before = baseline[stage]["seconds"]
+        if values["seconds"] > before * (1 + tolerance):
+            regressions.append(f"{stage}: {values['seconds']:.3f}s vs {before:.3f}s baseline "
+                               f"(+{(values['seconds'] / before - 1) * 100:.0f}%)")
+    return regressions
+
+def format_table(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+    lines = [f"{'stage':<28} {'seconds':>10} {'baseline':>10}  throughput"]
+    for stage, values in results.items():
+        before = f"{baseline[stage]['seconds']:.3f}" if baseline and stage in baseline else "-"
+        throughput = ", ".join(f"{value:,.0f} {unit.removesuffix('_per_second')}/s" for unit, value in values.items()
+                               if unit != "seconds")
+        lines.append(f"{stage:<28} {values['seconds']:>10.3f} {before:>10}  {throughput}")
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser("ava_bench", description="Benchmark each stage of ava on synthetic data")
+
+    parser.add_argument("--work-dir", type=ValidOutput, default=None, help="Folder to generate the data and outputs in. "
+                        "Defaults to a temporary folder that is removed afterwards")
+    parser.add_argument("--chromosomes", type=int, default=2, help="Number of chromosomes in the reference")
+    parser.add_argument("--chromosome-length", type=int, default=1_000_000, help="Bases per chromosome")
+    parser.add_argument("--genes", type=int, default=20, help="Number of genes in the metadata file")
+    parser.add_argument("--samples", type=int, default=50, help="Number of samples (variant files per gene)")
+    parser.add_argument("--snps", type=int, default=20, help="Variants per sample and gene")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the generated data")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number "
+                        "of CPUs)")
+    parser.add_argument("--by-gene", action="store_true", help="Benchmark ava's --by-gene mode")
+    parser.add_argument("--json", type=ValidOutput, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=ValidFile, default=None, help="Compare against results saved with --json")
+    parser.add_argument("--skip-imports", action="store_true", help="Don't measure the import time of each entry "
+                        "point")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction a stage may be slower than the baseline "
+                        "before it counts as a regression (default: %(default)s)")
+
+    args = parser.parse_args()
+    if min(args.chromosomes, args.chromosome_length, args.genes, args.samples, args.snps) < 1:
+        print("Expecting the data sizes to be at least 1")
+        exit(errno.EINVAL)
+    if args.chromosome_length // -(-args.genes // args.chromosomes) < 16:
+        print("Not enough room on the chromosomes for that many genes")
+        exit(errno.EINVAL)
+    workers = args.workers or os.cpu_count() or 1
+
+    work_dir = args.work_dir or pathlib.Path(tempfile.mkdtemp(prefix="ava_bench_"))
+    try:
+        shutil.rmtree(work_dir / "input", ignore_errors=True)
+        shutil.rmtree(work_dir / "index_cache", ignore_errors=True)
+        print("Generating data")
+        counts = generate(work_dir, args.chromosomes, args.chromosome_length, args.genes, args.samples, args.snps,
+                          args.seed)
+        results = run(work_dir, counts, workers, args.by_gene)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not args.skip_imports:
+        stages, problems = measure_imports()
+        results.update(stages)
+        for problem in problems:
+            print(f"[WARN] {problem}, which every worker will pay for")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)["stages"]
+    print(format_table(results, baseline))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"parameters": {key: value for key, value in vars(args).items()
+                                      if key not in ("json", "baseline", "work_dir", "skip_imports")},
+                       "counts": counts, "stages": results}, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("Regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Minimal BGZF (blocked gzip) reader and writer with tabix linear index and .gzi support
+
+import gzip
+import pathlib
+import struct
+import zlib
+
+from collections import deque
+from concurrent.futures import Executor
+from typing import BinaryIO, Deque, Dict, Iterator, List, Optional, Tuple
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Most uncompressed bytes in a block, as htslib uses, so the compressed block always fits in 64 KB
+MAX_BLOCK_DATA = 0xff00
+
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Most blocks a writer has queued for compression before it waits on the oldest (about 4 MB)
+MAX_PENDING_BLOCKS = 64
+
+def plain_name(path: pathlib.Path) -> str:
+    """ File name without a trailing .gz """
+    return pathlib.Path(path).name.removesuffix(".gz")
+
+def is_gzip(path: pathlib.Path) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+def is_bgzf(path: pathlib.Path) -> bool:
+    """ True if the file starts with a gzip member carrying the BGZF 'BC' extra subfield """
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+def read_block(handle: BinaryIO) -> Optional[bytes]:
+    """ Read and inflate the BGZF block at the current position. Returns None at end of file """
+    header = handle.read(18)
+    if len(header) < 18:
+        return None
+    if header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+        raise ValueError(f"Not a BGZF block at offset {handle.tell() - len(header)}")
+    block_size = struct.unpack("<H", header[16:18])[0] + 1
+    data = header + handle.read(block_size - 18)
+    return zlib.decompress(data, 31)
+
+def block_sizes(handle: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """ (compressed size, uncompressed size) of each block from the current position, without inflating them """
+    while True:
+        header = handle.read(18)
+        if len(header) < 18:
+            return
+        if header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+            raise ValueError(f"Not a BGZF block at offset {handle.tell() - len(header)}")
+        block_size = struct.unpack("<H", header[16:18])[0] + 1
+        handle.seek(block_size - 18 - 4, 1)
+        yield block_size, struct.unpack("<I", handle.read(4))[0]
+
+def build_gzi(path: pathlib.Path) -> List[Tuple[int, int]]:
+    """ (compressed offset, uncompressed offset) of the start of every block, like bgzip -i but including the first """
+    entries = []
+    compressed = 0
+    uncompressed = 0
+    with open(path, 'rb') as f:
+        for block_size, data_size in block_sizes(f):
+            entries.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += data_size
+    return entries
+
+def read_gzi(path: pathlib.Path) -> List[Tuple[int, int]]:
+    """ Block offsets from a .gzi, with the implied first block added back """
+    with open(path, 'rb') as f:
+        data = f.read()
+    count = struct.unpack_from("<Q", data)[0]
+    values = struct.unpack_from(f"<{count * 2}Q", data, 8)
+    return [(0, 0)] + [(values[i], values[i + 1]) for i in range(0, len(values), 2)]
+
+def write_gzi(entries: List[Tuple[int, int]], f: BinaryIO):
+    """ Write a .gzi in the format bgzip -i uses, which leaves out the first block """
+    entries = [entry for entry in entries if entry != (0, 0)]
+    f.write(struct.pack("<Q", len(entries)))
+    f.write(b"".join(struct.pack("<QQ", compressed, uncompressed) for compressed, uncompressed in entries))
+
+def compress_block(data: bytes, level: int = 6) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+class BgzfWriter():
+    """ Binary file-like writer producing BGZF. Blocks are compressed on executor when given (zlib releases the GIL, so
+        threads run in parallel) and written in order, otherwise inline """
+    def __init__(self, handle: BinaryIO, executor: Optional[Executor] = None, level: int = 6):
+        self.handle = handle
+        self.executor = executor
+        self.level = level
+        self.buffer = bytearray()
+        self.pending: Deque = deque()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= MAX_BLOCK_DATA:
+            self._submit(bytes(self.buffer[:MAX_BLOCK_DATA]))
+            del self.buffer[:MAX_BLOCK_DATA]
+        return len(data)
+
+    def _submit(self, data: bytes):
+        if self.executor is None:
+            self.handle.write(compress_block(data, self.level))
+            return
+        self.pending.append(self.executor.submit(compress_block, data, self.level))
+        while len(self.pending) > MAX_PENDING_BLOCKS:
+            self.handle.write(self.pending.popleft().result())
+
+    def flush(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.handle.write(self.pending.popleft().result())
+        self.handle.flush()
+
+    def close(self, eof: bool = True):
+        """ Flush and close the file. eof=False leaves off the end marker, for files that will be appended to """
+        self.flush()
+        if eof:
+            self.handle.write(EOF_BLOCK)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BgzfReader():
+    """ Line reader over a BGZF file that can jump to a virtual offset (compressed offset << 16 | block offset) """
+    def __init__(self, path: pathlib.Path):
+        self.handle = open(path, 'rb')
+        self.buffer = b""
+        # Start of the unread part of buffer
+        self.position = 0
+
+    def seek(self, virtual_offset: int):
+        self.handle.seek(virtual_offset >> 16)
+        self.buffer = read_block(self.handle) or b""
+        self.position = virtual_offset & 0xFFFF
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            end = self.buffer.find(b"\n", self.position)
+            while end < 0:
+                block = read_block(self.handle)
+                if block is None:
+                    if self.position < len(self.buffer):
+                        yield self.buffer[self.position:]
+                    self.buffer, self.position = b"", 0
+                    return
+                # Only a line running over the end of a block is copied
+                end = len(self.buffer) - self.position
+                self.buffer, self.position = self.buffer[self.position:] + block, 0
+                end = self.buffer.find(b"\n", end)
+            line = self.buffer[self.position:end + 1]
+            self.position = end + 1
+            yield line
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_tabix_linear_index(path: pathlib.Path) -> Dict[str, List[int]]:
+    """ Read the per sequence linear index (virtual offsets of the first record in each 16 kb window) from a .tbi """
+    with gzip.open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b"TBI\x01":
+        raise ValueError(f"{path} is not a tabix index")
+
+    n_ref = struct.unpack_from("<i", data, 4)[0]
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    names = data[36:36 + l_nm].rstrip(b"\x00").decode().split("\x00")
+    offset = 36 + l_nm
+
+    result: Dict[str, List[int]] = {}
+    for ref in range(n_ref):
+        n_bin = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        for _ in range(n_bin):
+            n_chunk = struct.unpack_from("<i", data, offset + 4)[0]
+            offset += 8 + n_chunk * 16
+        n_intv = struct.unpack_from("<i", data, offset)[0]
+        offset += 4
+        result[names[ref]] = list(struct.unpack_from(f"<{n_intv}Q", data, offset))
+        offset += n_intv * 8
+    return result
+
+def linear_index_offset(intervals: List[int], position: int) -> int:
+    """ Virtual offset to start reading from to find records at or after position (0-based) """
+    window = min(position >> 14, len(intervals) - 1)
+    # Empty windows are stored as 0, so fall back to the closest populated window before it
+    while window > 0 and not intervals[window]:
+        window -= 1
+    return intervals[window] if intervals else 0
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Input catalog. Finds every sequence and variant file under a folder in one os.scandir walk, instead of a recursive
+# glob per extension, and can keep a snapshot so re-runs don't list folders that haven't changed
+
+import json
+import os
+import pathlib
+import time
+
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+try:
+    from ava.index_cache import atomic_open
+except:
+    # allow imports when run in place
+    from index_cache import atomic_open
+
+# File kinds and the names that make them
+SEQUENCE = "sequence"
+VARIANT = "variant"
+KINDS = {SEQUENCE: (".fasta", ".fa", ".fasta.gz", ".fa.gz"), VARIANT: (".csv", ".csv.gz")}
+
+SNAPSHOT_VERSION = 1
+# Folders modified this close to a scan may have changed again within the same mtime tick, so they're listed again
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+class CatalogEntry(NamedTuple):
+    path: pathlib.Path
+    size: int
+    mtime_ns: int
+
+def classify(name: str) -> Optional[str]:
+    for kind, suffixes in KINDS.items():
+        if name.endswith(suffixes):
+            return kind
+    return None
+
+class Catalog():
+    """ Every sequence and variant file under root, found in a single walk (following links like glob does).
+
+        With a snapshot path, each folder's modification time and listing are saved after the walk. A folder whose
+        mtime hasn't changed since has had nothing added, removed or renamed in it, so the next walk reuses its listing
+        rather than reading it again and only stats its subfolders. Sizes and mtimes of reused files are the ones from
+        the snapshot """
+    def __init__(self, root: pathlib.Path, snapshot: Optional[pathlib.Path] = None):
+        self.root = root
+        self.snapshot = snapshot
+        self.files: Dict[str, List[CatalogEntry]] = {kind: [] for kind in KINDS}
+        # Folders listed and folders reused from the snapshot
+        self.scanned = 0
+        self.reused = 0
+
+        previous, previous_time = self._load_snapshot()
+        self.folders: Dict[str, dict] = {}
+        self.scan_time = time.time_ns()
+        self._walk(str(root), "", previous, previous_time, set())
+        for entries in self.files.values():
+            entries.sort()
+        if snapshot is not None:
+            self._save_snapshot()
+
+    def paths(self, kind: str) -> List[pathlib.Path]:
+        return [entry.path for entry in self.files[kind]]
+
+    @property
+    def sequences(self) -> List[pathlib.Path]:
+        return self.paths(SEQUENCE)
+
+    @property
+    def variants(self) -> List[pathlib.Path]:
+        return self.paths(VARIANT)
+
+    def _walk(self, folder: str, relative: str, previous: Dict[str, dict], previous_time: int,
+              seen: Set[Tuple[int, int]]):
+        try:
+            stat = os.stat(folder)
+        except OSError:
+            return
+        # Linked folders can loop back on themselves
+        if (stat.st_dev, stat.st_ino) in seen:
+            return
+        seen.add((stat.st_dev, stat.st_ino))
+
+        old = previous.get(relative)
+        if old is not None and old["mtime"] == stat.st_mtime_ns and stat.st_mtime_ns < previous_time - RACY_NS:
+            listing = old
+            self.reused += 1
+        else:
+            listing = self._list(folder, stat.st_mtime_ns)
+            self.scanned += 1
+        self.folders[relative] = listing
+
+        for name, size, mtime in listing["files"]:
+            kind = classify(name)
+            if kind is not None:
+                self.files[kind].append(CatalogEntry(pathlib.Path(folder, name), size, mtime))
+        for name in listing["folders"]:
+            self._walk(os.path.join(folder, name), f"{relative}/{name}" if relative else name, previous,
+                       previous_time, seen)
+
+    @staticmethod
+    def _list(folder: str, mtime: int) -> dict:
+        files = []
+        folders = []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            folders.append(entry.name)
+                        elif entry.is_file() and classify(entry.name) is not None:
+                            stat = entry.stat()
+                            files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+                    except OSError:
+                        # e.g. a broken link
+                        continue
+        except OSError:
+            pass
+        return {"mtime": mtime, "files": files, "folders": folders}
+
+    def _load_snapshot(self) -> Tuple[Dict[str, dict], int]:
+        if self.snapshot is None or not self.snapshot.exists():
+            return {}, 0
+        try:
+            with open(self.snapshot, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}, 0
+        if data.get("version") != SNAPSHOT_VERSION or data.get("root") != str(self.root.absolute()):
+            return {}, 0
+        return data["folders"], data["time"]
+
+    def _save_snapshot(self):
+        data = {"version": SNAPSHOT_VERSION, "root": str(self.root.absolute()), "time": self.scan_time,
+                "folders": self.folders}
+        # Written to the side first so an interrupted run doesn't leave a partial snapshot
+        with atomic_open(self.snapshot, 'w') as f:
+            json.dump(data, f)
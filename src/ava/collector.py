@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# Aggregated output layouts - one multi-FASTA per gene or per sample, written by the parent process
+
+import pathlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Optional, Set, Tuple
+
+try:
+    from ava.bgzf import EOF_BLOCK, BgzfWriter
+    from ava.fasta_writer import FastaWriter
+except:
+    # allow imports when run in place
+    from bgzf import EOF_BLOCK, BgzfWriter
+    from fasta_writer import FastaWriter
+
+# file: one file per (sample, chromosome, gene), written by the workers
+# gene: {cid}_{gid}.fa holding a record per sample
+# sample: {sid}.fa holding a record per gene
+LAYOUTS = ("file", "gene", "sample")
+
+# Most aggregate files kept open at once. Older ones are closed and re-opened for appending if needed again
+MAX_OPEN_FILES = 128
+
+def aggregate_target(layout: str, sid, cid, gid) -> Tuple[str, str]:
+    """ (file name, record name) for a result in an aggregated layout """
+    if layout == "gene":
+        return f"{cid}_{gid}.fa", f"{sid}"
+    if layout == "sample":
+        return f"{sid}.fa", f"{cid}_{gid}"
+    raise ValueError(f"{layout} is not an aggregated output layout")
+
+def output_file_name(layout: str, sid, cid, gid, compress: bool = False) -> str:
+    """ Name of the file a result ends up in, for any layout """
+    if layout == "file":
+        name = f"{cid}_{sid}_{gid}.fa"
+    else:
+        name = aggregate_target(layout, sid, cid, gid)[0]
+    return f"{name}.gz" if compress else name
+
+class RecordCollector():
+    """ Receives finished sequences from the workers and appends them to the aggregate file for the layout. With
+        compress_threads the files are bgzip compressed on a thread pool shared by every open file """
+    def __init__(self, output_root: pathlib.Path, layout: str, line_width: int, compress_threads: Optional[int] = None):
+        self.output_root = output_root
+        self.layout = layout
+        self.line_width = line_width
+        self.compress = compress_threads is not None
+        self.executor = ThreadPoolExecutor(compress_threads) if compress_threads else None
+        self.handles: "OrderedDict[str, BinaryIO]" = OrderedDict()
+        self.created: Set[str] = set()
+        # Compressed files closed to make room, still waiting for their end marker
+        self.evicted: Set[str] = set()
+        self.counts: Dict[str, int] = {}
+
+    def add(self, sid, cid, gid, sequence):
+        name = output_file_name(self.layout, sid, cid, gid, self.compress)
+        record = aggregate_target(self.layout, sid, cid, gid)[1]
+        FastaWriter(self._handle(name), self.line_width).write(record, sequence)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def _handle(self, name: str) -> BinaryIO:
+        if name in self.handles:
+            self.handles.move_to_end(name)
+            return self.handles[name]
+
+        if len(self.handles) >= MAX_OPEN_FILES:
+            oldest_name, oldest = self.handles.popitem(last=False)
+            if self.compress:
+                # Compressed files get their end marker once they are finished
+                oldest.close(eof=False)
+                self.evicted.add(oldest_name)
+            else:
+                oldest.close()
+        self.evicted.discard(name)
+
+        # Truncate any output from an earlier run the first time a file is seen
+        handle = open(self.output_root / name, 'ab' if name in self.created else 'wb', buffering=1024 * 1024)
+        if self.compress:
+            handle = BgzfWriter(handle, self.executor)
+        self.created.add(name)
+        self.handles[name] = handle
+        return handle
+
+    def finish(self, name: str):
+        """ Flush and close an aggregate file once everything destined for it has arrived """
+        if name in self.handles:
+            self.handles.pop(name).close()
+        elif name in self.evicted:
+            self._end(name)
+
+    def _end(self, name: str):
+        # The rest of the file was written (and closed without a marker) before it was evicted
+        with open(self.output_root / name, 'ab') as f:
+            f.write(EOF_BLOCK)
+        self.evicted.discard(name)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+        for name in list(self.evicted):
+            self._end(name)
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
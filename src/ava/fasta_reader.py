@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+# Reference access for the workers. Plain FASTA files are mmapped and sliced using the offsets in their .fai, bgzip
+# files are read a block at a time through their .gzi, anything else goes through pyfaidx
+
+import bisect
+import gzip
+import mmap
+import pathlib
+import shutil
+import tempfile
+
+from typing import Dict, Iterable, NamedTuple, Tuple
+
+try:
+    from ava.bgzf import BgzfReader, build_gzi, is_bgzf, is_gzip, read_block, read_gzi, write_gzi
+    from ava.index_cache import atomic_open, cached_index_path
+    from ava.metadata_types import Cid, Reference
+except:
+    # allow imports when run in place
+    from bgzf import BgzfReader, build_gzi, is_bgzf, is_gzip, read_block, read_gzi, write_gzi
+    from index_cache import atomic_open, cached_index_path
+    from metadata_types import Cid, Reference
+
+class FaiEntry(NamedTuple):
+    """ One line of a .fai: sequence length, byte offset of the first base, bases per line and bytes per line """
+    length: int
+    offset: int
+    line_bases: int
+    line_width: int
+
+def read_fai(index_path: pathlib.Path) -> Dict[str, FaiEntry]:
+    entries = {}
+    with open(index_path, 'r') as f:
+        for line in f:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 5:
+                continue
+            entries[fields[0]] = FaiEntry(*(int(value) for value in fields[1:5]))
+    return entries
+
+def write_fai(lines: Iterable[bytes], index_path: pathlib.Path):
+    """ Build a .fai (as samtools faidx would) from the lines of an uncompressed FASTA stream """
+    entries = []
+    offset = 0
+    current = None
+    for line in lines:
+        if line.startswith(b">"):
+            if current is not None:
+                entries.append(current)
+            # [name, length, offset, line bases, line width]
+            current = [line[1:].split(maxsplit=1)[0].decode() if line[1:].strip() else "", 0, offset + len(line), 0, 0]
+        elif current is not None:
+            bases = len(line.rstrip(b"\r\n"))
+            if not current[3]:
+                current[3], current[4] = bases, len(line)
+            current[1] += bases
+        offset += len(line)
+    if current is not None:
+        entries.append(current)
+
+    # Written to the side first so an interrupted run doesn't leave a partial index in the cache
+    with atomic_open(index_path, 'w', keep_existing=True) as f:
+        f.writelines("\t".join(str(value) for value in entry) + "\n" for entry in entries)
+
+def byte_offset(entry: FaiEntry, position: int) -> int:
+    """ Offset in the (uncompressed) file of a 0-based position in a sequence """
+    return entry.offset + (position // entry.line_bases) * entry.line_width + position % entry.line_bases
+
+def clamp(entry: FaiEntry, start: int, stop: int) -> Tuple[int, int]:
+    # Cut short at the end of the sequence like pyfaidx
+    start = max(0, min(start, entry.length))
+    return start, max(start, min(stop, entry.length))
+
+class MmapFasta():
+    """ Uncompressed FASTA mapped into memory. fetch() works out the byte span of a region from the .fai and strips the
+        line endings out of it in one go """
+    def __init__(self, reference: Reference):
+        self.entries = read_fai(reference.index)
+        self.handle = open(reference.path, 'rb')
+        try:
+            self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self.handle.close()
+            raise
+
+    def fetch(self, cid: Cid, start: int, stop: int) -> bytes:
+        """ Bases [start, stop) of cid, 0-based """
+        entry = self.entries[cid]
+        start, stop = clamp(entry, start, stop)
+        if start == stop:
+            return b""
+        return self.data[byte_offset(entry, start):byte_offset(entry, stop)].translate(None, b"\r\n")
+
+    def close(self):
+        self.data.close()
+        self.handle.close()
+
+class BgzfFasta():
+    """ bgzip compressed FASTA. The .fai gives the uncompressed span of a region and the .gzi the blocks holding it """
+    def __init__(self, reference: Reference):
+        self.entries = read_fai(reference.index)
+        blocks = read_gzi(reference.gzi)
+        self.compressed = [compressed for compressed, _ in blocks]
+        self.uncompressed = [uncompressed for _, uncompressed in blocks]
+        self.handle = open(reference.path, 'rb')
+        # Last block read, as neighbouring regions often share it
+        self.cached: Tuple[int, bytes] = (-1, b"")
+
+    def _block(self, i: int) -> bytes:
+        if self.cached[0] != i:
+            self.handle.seek(self.compressed[i])
+            self.cached = (i, read_block(self.handle) or b"")
+        return self.cached[1]
+
+    def fetch(self, cid: Cid, start: int, stop: int) -> bytes:
+        """ Bases [start, stop) of cid, 0-based """
+        entry = self.entries[cid]
+        start, stop = clamp(entry, start, stop)
+        if start == stop:
+            return b""
+        position, end = byte_offset(entry, start), byte_offset(entry, stop)
+
+        parts = []
+        i = bisect.bisect_right(self.uncompressed, position) - 1
+        while position < end and i < len(self.compressed):
+            block = self._block(i)
+            base = self.uncompressed[i]
+            parts.append(block[position - base:end - base])
+            position = max(position, base + len(block))
+            i += 1
+        return b"".join(parts).translate(None, b"\r\n")
+
+    def close(self):
+        self.handle.close()
+
+class FaidxFasta():
+    """ The same interface over pyfaidx, for files that can't be mapped """
+    def __init__(self, reference: Reference):
+        # Imported here as it is only needed for unusual files and for indexing
+        from pyfaidx import Fasta
+
+        self.fasta = Fasta(str(reference.path), indexname=str(reference.index), one_based_attributes=False)
+
+    def fetch(self, cid: Cid, start: int, stop: int) -> bytes:
+        return str(self.fasta[cid][start:stop]).encode()
+
+    def close(self):
+        self.fasta.close()
+
+def index_reference(path: pathlib.Path, cache_dir: pathlib.Path) -> Reference:
+    """ Reference for a plain, bgzip or gzip FASTA file, building the indexes it needs in cache_dir on first use """
+    index = cached_index_path(path, cache_dir)
+    if not is_gzip(path):
+        if not index.exists():
+            from pyfaidx import Fasta
+            # pyfaidx writes its index in place, so it builds it in a folder of its own for atomic_open to move over
+            with tempfile.TemporaryDirectory(dir=cache_dir) as folder, \
+                    atomic_open(index, 'wb', keep_existing=True) as f:
+                built = pathlib.Path(folder) / index.name
+                Fasta(str(path), indexname=str(built), one_based_attributes=False).close()
+                f.write(built.read_bytes())
+        return Reference(path.absolute(), index)
+
+    if is_bgzf(path):
+        # Prefer a .gzi made by bgzip -i or samtools faidx
+        gzi = pathlib.Path(f"{path}.gzi")
+        if not gzi.exists():
+            gzi = index.with_suffix(".gzi")
+            if not gzi.exists():
+                with atomic_open(gzi, 'wb', keep_existing=True) as f:
+                    write_gzi(build_gzi(path), f)
+        if not index.exists():
+            with BgzfReader(path) as reader:
+                reader.seek(0)
+                write_fai(reader, index)
+        return Reference(path.absolute(), index, gzi.absolute())
+
+    # Plain gzip can't be read at random, so keep a decompressed copy in the cache instead
+    copy = index.with_suffix(".fa")
+    if not copy.exists():
+        with gzip.open(path, 'rb') as file_in, atomic_open(copy, 'wb', keep_existing=True) as file_out:
+            shutil.copyfileobj(file_in, file_out, 16 * 1024 * 1024)
+    return index_reference(copy, cache_dir)
+
+def open_reference(reference: Reference):
+    """ A reader with fetch(cid, start, stop) -> bytes and close() for the reference. The indexes must already exist,
+        which index_reference makes sure of """
+    if reference.gzi is not None:
+        return BgzfFasta(reference)
+    try:
+        reader = MmapFasta(reference)
+    except (OSError, ValueError):
+        # e.g. an empty file or a filesystem without mmap support
+        return FaidxFasta(reference)
+    if not all(entry.line_bases > 0 for entry in reader.entries.values()):
+        reader.close()
+        return FaidxFasta(reference)
+    return reader
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+# Buffered FASTA writer shared by ava and its extras
+
+from typing import BinaryIO, Union
+
+# Number of lines joined together before being handed to the file
+LINES_PER_WRITE = 16384
+
+class FastaWriter():
+    """ Write FASTA records to a binary handle, wrapping sequences every line_width bases (0 to disable wrapping) """
+    def __init__(self, handle: BinaryIO, line_width: int = 60):
+        if line_width < 0:
+            raise ValueError(f"line width must be 0 or more, got {line_width}")
+        self.handle = handle
+        self.line_width = line_width
+
+    def write(self, name: str, sequence: Union[bytes, bytearray, memoryview, str]):
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        self.handle.write(f">{name}\n".encode())
+        self.write_sequence(sequence)
+
+    def write_sequence(self, sequence: Union[bytes, bytearray, memoryview]):
+        """ Just the wrapped sequence lines of a record, e.g. to write the same sequence under several headers """
+        view = memoryview(sequence)
+        if not len(view):
+            return
+
+        width = self.line_width or len(view)
+        block = width * LINES_PER_WRITE
+        for start in range(0, len(view), block):
+            end = min(start + block, len(view))
+            self.handle.write(b"\n".join([view[i:min(i + width, end)] for i in range(start, end, width)]))
+            self.handle.write(b"\n")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Persistent .fai cache so references are only indexed once, and never inside the input folder
+
+import hashlib
+import os
+import pathlib
+import tempfile
+
+from contextlib import contextmanager
+
+# Bytes hashed from each end of a file for its fingerprint
+FINGERPRINT_SAMPLE = 1024 * 1024
+
+def default_cache_dir() -> pathlib.Path:
+    root = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(root) / "aght" / "fai"
+
+def fingerprint(path: pathlib.Path) -> str:
+    """ Cheap identity for a file: path, size, mtime and a hash of its first and last MB """
+    path = pathlib.Path(path).absolute()
+    stat = path.stat()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_SAMPLE))
+        if stat.st_size > FINGERPRINT_SAMPLE:
+            f.seek(max(FINGERPRINT_SAMPLE, stat.st_size - FINGERPRINT_SAMPLE))
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def cached_index_path(path: pathlib.Path, cache_dir: pathlib.Path) -> pathlib.Path:
+    """ Where the .fai for path lives in the cache. It is built there on first use, along with a .gzi or a decompressed
+        copy for compressed files """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / f"{pathlib.Path(path).name}.{fingerprint(path)}.fai"
+
+def cached_config_path(path: pathlib.Path, cache_dir: pathlib.Path, options: str) -> pathlib.Path:
+    """ Where the compiled region table for a config or annotation file, read with options, lives in the cache """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = hashlib.blake2b(options.encode(), digest_size=8).hexdigest()
+    return cache_dir / f"{pathlib.Path(path).name}.{fingerprint(path)}.{key}.regions.pickle"
+
+@contextmanager
+def atomic_open(path: pathlib.Path, mode: str = 'wb', keep_existing: bool = False):
+    """ Open a temporary file of this process's own beside path, moved to path once the block finishes. Runs sharing a
+        cache (e.g. shards started together) build the same files at the same time, so a fixed temporary name would be
+        written and moved by all of them at once. With keep_existing a copy another run has already put in place is
+        kept rather than written over, so files named after a fingerprint of it (e.g. the index of a decompressed copy)
+        stay valid """
+    descriptor, partial = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, mode) as f:
+            yield f
+        if keep_existing:
+            try:
+                # Fails rather than replacing if path is there already
+                os.link(partial, path)
+                return
+            except FileExistsError:
+                return
+            except OSError:
+                # Filesystems without hard links
+                pass
+        try:
+            os.replace(partial, path)
+        except OSError:
+            # e.g. on Windows while another run has it open. Every run makes the same contents, so theirs will do
+            if not path.exists():
+                raise
+    finally:
+        if os.path.exists(partial):
+            os.unlink(partial)
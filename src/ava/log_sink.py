@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Single log writer for a run. Workers send structured events over a queue, the parent batches them into the log and
+# keeps a count per category
+
+import json
+import multiprocessing
+import pathlib
+import queue
+import threading
+
+from typing import Dict, List, Optional, Tuple
+
+# Event categories
+EMPTY_FILE = "empty_file"
+UNREADABLE_FILE = "unreadable_file"
+UNREADABLE_FEATURE = "unreadable_feature"
+UNMAPPED_GENE = "unmapped_gene"
+MULTIPLE_CHROMOSOMES = "multiple_chromosomes"
+AMBIGUOUS_ALLELE = "ambiguous_allele"
+UNREADABLE_POSITION = "unreadable_position"
+DUPLICATE_GENE = "duplicate_gene"
+SKIPPED_CALLS = "skipped_calls"
+NO_GENOTYPES = "no_genotypes"
+MISSING_CHROMOSOME = "missing_chromosome"
+MISSING_RANGES = "missing_ranges"
+OUT_OF_REGION = "out_of_region"
+MISMATCHED_REFERENCE = "mismatched_reference"
+UNAPPLIED_VARIANT = "unapplied_variant"
+NO_OUTPUT = "no_output"
+
+# (category, message)
+Event = Tuple[str, str]
+
+# Most events written to the log in one go
+BATCH_SIZE = 4096
+
+_worker_queue: Optional["multiprocessing.Queue"] = None
+
+def init_worker_log(events: "multiprocessing.Queue"):
+    """ Pool initializer, so workers can send events to the parent's sink """
+    global _worker_queue
+    _worker_queue = events
+
+def send_events(events: List[Event]):
+    """ Send a task's events to the parent in one message """
+    if events and _worker_queue is not None:
+        _worker_queue.put(events)
+
+def format_summary(counts: Dict[str, int]) -> str:
+    lines = [f"{category}: {count}" for category, count in sorted(counts.items())]
+    return "\n".join(lines) if lines else "no warnings"
+
+class LogSink():
+    """ Owns the log file. Events come from the parent through event() or from workers through the queue """
+    def __init__(self, log_path: pathlib.Path, summary_path: Optional[pathlib.Path] = None):
+        self.log_path = log_path
+        self.summary_path = summary_path
+        self.counts: Dict[str, int] = {}
+        self.handle = open(log_path, 'w')
+        self.queue: "multiprocessing.Queue" = multiprocessing.Queue()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._drain, daemon=True)
+        self.thread.start()
+
+    def event(self, category: str, message: str):
+        self.events([(category, message)])
+
+    def events(self, events: List[Event]):
+        with self.lock:
+            lines = []
+            for category, message in events:
+                self.counts[category] = self.counts.get(category, 0) + 1
+                lines.append(message.rstrip("\n") + "\n")
+            self.handle.write("".join(lines))
+
+    def _drain(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            # Grab whatever else is waiting so it goes out in a single write
+            try:
+                while len(batch) < BATCH_SIZE:
+                    more = self.queue.get_nowait()
+                    if more is None:
+                        self.events(batch)
+                        return
+                    batch += more
+            except queue.Empty:
+                pass
+            self.events(batch)
+
+    def checkpoint(self) -> Tuple[Dict[str, int], int]:
+        """ Counts so far and how far into the log they go. Only exact while no workers are sending events """
+        with self.lock:
+            self.handle.flush()
+            return dict(self.counts), self.handle.tell()
+
+    def summary(self) -> str:
+        return format_summary(self.counts)
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.queue.close()
+
+        self.handle.write(f"\nSummary\n{self.summary()}\n")
+        self.handle.close()
+        if self.summary_path is not None:
+            with open(self.summary_path, 'w') as f:
+                json.dump(self.counts, f, indent=2, sort_keys=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
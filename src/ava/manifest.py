@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Manifest of completed outputs, so re-runs only redo outputs whose inputs changed
+
+import hashlib
+import json
+import pathlib
+
+from typing import Dict, List
+
+try:
+    from ava.variant_store import VariantSet
+except:
+    # allow imports when run in place
+    from variant_store import VariantSet
+
+MANIFEST_NAME = "manifest.jsonl"
+
+def _hash(*parts) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, (bytes, bytearray, memoryview)) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def variants_digest(variations: VariantSet) -> str:
+    return _hash(variations.positions.tobytes(), variations.ref.tobytes(), variations.alt.tobytes(),
+                 sorted(variations.other.items()))
+
+def ranges_digest(ranges: List[range]) -> str:
+    return _hash([(subset.start, subset.stop) for subset in ranges])
+
+def operation_digest(reference_id: str, cid, ranges: List[range], variations: VariantSet, settings: str) -> Dict[str, str]:
+    """ Hashes of everything that goes into one output sequence. The reference region is identified by the reference
+        file fingerprint, the chromosome and the ranges read from it """
+    ranges_hash = ranges_digest(ranges)
+    return {"reference": _hash(reference_id, cid, ranges_hash), "variants": variants_digest(variations),
+            "ranges": ranges_hash, "settings": _hash(settings)}
+
+def member_key(sid, cid, gid) -> str:
+    return f"{cid}\t{sid}\t{gid}"
+
+class Manifest():
+    """ Append-only record of finished output files and the digests of every sequence in them. The last entry for an
+        output wins, so a run that dies part way keeps everything it finished """
+    def __init__(self, output_root: pathlib.Path, resume: bool, name: str = MANIFEST_NAME):
+        self.output_root = output_root
+        self.path = output_root / name
+        self.entries: Dict[str, Dict[str, Dict[str, str]]] = {}
+
+        if resume and self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partial line from a run that was killed mid write
+                        continue
+                    self.entries[entry["output"]] = entry["members"]
+
+        # Rewrite with only the latest entries so the file doesn't grow forever
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, 'w') as f:
+            for output, members in self.entries.items():
+                f.write(self._line(output, members))
+        temp_path.replace(self.path)
+        self.handle = open(self.path, 'a')
+
+    def is_fresh(self, output: str, members: Dict[str, Dict[str, str]]) -> bool:
+        return self.entries.get(output) == members and (self.output_root / output).exists()
+
+    def record(self, output: str, members: Dict[str, Dict[str, str]]):
+        self.entries[output] = members
+        self.handle.write(self._line(output, members))
+        self.handle.flush()
+
+    @staticmethod
+    def _line(output: str, members: Dict[str, Dict[str, str]]) -> str:
+        return json.dumps({"output": output, "members": members}, sort_keys=True) + "\n"
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
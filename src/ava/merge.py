@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+# Allele Variance Applicator - shard merger
+# Checks every ava --shard i/N job into an output folder finished, then combines their logs, summaries and manifests
+
+import argparse
+import errno
+import json
+import pathlib
+
+from typing import Dict, List
+
+try:
+    from ava.argparse_helpers import ValidFolder
+    from ava.log_sink import format_summary
+    from ava.manifest import MANIFEST_NAME
+    from ava.sharding import done_marker_path, read_done_markers, shard_suffix
+except:
+    # allow imports when run in place
+    from argparse_helpers import ValidFolder
+    from log_sink import format_summary
+    from manifest import MANIFEST_NAME
+    from sharding import done_marker_path, read_done_markers, shard_suffix
+
+# Marker fields every shard of a run has to agree on
+RUN_FIELDS = ("shards", "shard_by", "partition", "settings", "total_operations")
+
+def verify(output_path: pathlib.Path, markers: List[Dict]) -> List[str]:
+    """ Everything wrong with a set of shards: disagreeing runs, missing shards or missing and doubled up outputs """
+    problems = []
+    shards = markers[0]["shards"]
+    for field in RUN_FIELDS:
+        values = {json.dumps(marker[field]) for marker in markers}
+        if len(values) > 1:
+            problems.append(f"Shards disagree on {field} ({', '.join(sorted(values))}). Were they all run with the "
+                            f"same inputs and options?")
+
+    finished = {marker["shard"] for marker in markers}
+    missing = [str(shard) for shard in range(1, shards + 1) if shard not in finished]
+    if missing:
+        problems.append(f"Shards not finished: {', '.join(missing)} of {shards}")
+
+    owners: Dict[str, int] = {}
+    for marker in markers:
+        for output in marker["outputs"]:
+            if output in owners:
+                problems.append(f"{output} was written by shards {owners[output]} and {marker['shard']}")
+            owners[output] = marker["shard"]
+            if not (output_path / output).exists():
+                problems.append(f"{output} from shard {marker['shard']} is missing")
+    return problems
+
+def shard_log(path: pathlib.Path, start: int) -> bytes:
+    """ A shard's log from start, without the summary LogSink adds at the end """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read()
+    end = data.rfind(b"\nSummary\n")
+    return data[:end] if end >= 0 else data
+
+def merge(output_path: pathlib.Path, markers: List[Dict]) -> Dict[str, int]:
+    """ Write output.log, summary.json and manifest.jsonl (and haplotypes.tsv) for the whole run. Returns the combined
+        warning counts """
+    markers = sorted(markers, key=lambda marker: marker["shard"])
+    suffixes = [shard_suffix(marker["shard"], marker["shards"]) for marker in markers]
+
+    # The warnings from loading the inputs are the same in every shard, so they are only counted once
+    counts = dict(markers[0]["shared_counts"])
+    with open(output_path / "output.log", 'wb') as log:
+        with open(output_path / f"output{suffixes[0]}.log", 'rb') as f:
+            log.write(f.read(markers[0]["shared_log_end"]))
+        for marker, suffix in zip(markers, suffixes):
+            log.write(shard_log(output_path / f"output{suffix}.log", marker["shared_log_end"]))
+            with open(output_path / f"summary{suffix}.json", 'r') as f:
+                shard_counts = json.load(f)
+            for category, count in shard_counts.items():
+                count -= marker["shared_counts"].get(category, 0)
+                if count:
+                    counts[category] = counts.get(category, 0) + count
+        log.write(f"\nSummary\n{format_summary(counts)}\n".encode())
+    with open(output_path / "summary.json", 'w') as f:
+        json.dump(counts, f, indent=2, sort_keys=True)
+
+    # One manifest, so later unsharded --incremental runs into the folder pick up where the shards left off
+    with open(output_path / MANIFEST_NAME, 'wb') as manifest:
+        for suffix in suffixes:
+            path = output_path / f"manifest{suffix}.jsonl"
+            if path.exists():
+                manifest.write(path.read_bytes())
+
+    haplotypes = [output_path / f"haplotypes{suffix}.tsv" for suffix in suffixes]
+    if all(path.exists() for path in haplotypes):
+        with open(output_path / "haplotypes.tsv", 'w') as report:
+            for i, path in enumerate(haplotypes):
+                lines = path.read_text().splitlines(keepends=True)
+                report.writelines(lines if i == 0 else lines[1:])
+    return counts
+
+def clean(output_path: pathlib.Path, markers: List[Dict]):
+    """ Remove the per shard files once they have been merged """
+    for marker in markers:
+        suffix = shard_suffix(marker["shard"], marker["shards"])
+        for name in (f"output{suffix}.log", f"summary{suffix}.json", f"manifest{suffix}.jsonl",
+                     f"haplotypes{suffix}.tsv"):
+            (output_path / name).unlink(missing_ok=True)
+        done_marker_path(output_path, marker["shard"], marker["shards"]).unlink()
+
+def main():
+    parser = argparse.ArgumentParser("ava_merge", description="Check every ava --shard job finished and combine "
+                                     "their logs, summaries and manifests")
+
+    parser.add_argument("--output", "-o", type=ValidFolder, required=True, help="Output folder the shards wrote to")
+    parser.add_argument("--verify-only", action="store_true", help="Only check the shards, without combining anything")
+    parser.add_argument("--clean", action="store_true", help="Remove the per shard logs, summaries, manifests and done "
+                        "markers after merging")
+
+    args = parser.parse_args()
+    output_path: pathlib.Path = args.output
+
+    markers = [marker for _, marker in read_done_markers(output_path)]
+    if not markers:
+        print(f"No finished shards found in {output_path}")
+        exit(errno.ENOENT)
+
+    problems = verify(output_path, markers)
+    if problems:
+        print("\n".join(problems))
+        exit(errno.EIO)
+    outputs = sum(len(marker["outputs"]) for marker in markers)
+    print(f"All {markers[0]['shards']} shards finished with {outputs} output files")
+    if args.verify_only:
+        return
+
+    counts = merge(output_path, markers)
+    if args.clean:
+        clean(output_path, markers)
+    print(f"Warnings by category:\n{format_summary(counts)}")
+    print(f"Merged into {output_path}. Check log at {output_path / 'output.log'} for more details")
+
+if __name__ == "__main__":
+    main()
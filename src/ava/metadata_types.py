@@ -5,11 +5,13 @@
 """ Gene ID - represents a sequence """
 
 import pathlib
-import pandas
 
-from typing import Dict, List, Set
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Set
 
-from pyfaidx import Fasta
+# Only used in annotations. Everything imports this module, so it mustn't pull them in at runtime
+if TYPE_CHECKING:
+    import pandas
+    from pyfaidx import Fasta
 
 
 class Gid(str):
@@ -23,11 +25,23 @@ class Sid(str):
 class Cid(str):
     pass
 
+""" Reference FASTA holding a chromosome, where its .fai lives, and its .gzi block index if it is bgzip compressed """
+class Reference(NamedTuple):
+    path: pathlib.Path
+    index: pathlib.Path
+    gzi: Optional[pathlib.Path] = None
+
+""" Ranges of a gene in the order they are joined, and the strand they are on: +, - or . when mixed """
+class Regions(list):
+    def __init__(self, ranges=(), strand: str = "+"):
+        super().__init__(ranges)
+        self.strand = strand
+
 # class Gene():
 #     def __init__(self, gid: Gid, )
 
 class Chromosome():
-    def __init__(self, cid: Cid, source: Fasta):
+    def __init__(self, cid: Cid, source: "Fasta"):
         self.cid = cid
         self.source_file = source
         self.genes: Set[Gid] = {}
@@ -44,7 +58,7 @@ class Sample():
     #     self.
 
 class Variations():
-    def __init__(self, sid: Sid, gid: Gid, variation_path: pathlib.Path, data: pandas.DataFrame):
+    def __init__(self, sid: Sid, gid: Gid, variation_path: pathlib.Path, data: "pandas.DataFrame"):
         if not len(data):
             return
         print(f"{str(variation_path.absolute())} was empty and had no variation files")
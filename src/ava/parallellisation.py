@@ -1,132 +1,370 @@
+import io
+import numpy
 import pathlib
-import pandas
-from pyfaidx import Fasta
 
-def parse_variant_compat(variant_path: pathlib.Path, info, log_output):
-    name = variant_path.name
-    gid = None
-    data = pandas.read_csv(str(variant_path.absolute()))
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Tuple
 
-    if not len(data):
-        log_output.write(f"[WARN] While parsing {str(variant_path.absolute())}: File has no entries. Unable to map "
-                         f"variants to a known chromosomes detected in same file. Skipping.\n")
+# Only the variant file parsers need pandas, so it is imported there. Processing workers never load it
+if TYPE_CHECKING:
+    import pandas
+
+try:
+    from ava.bgzf import EOF_BLOCK, MAX_BLOCK_DATA, BgzfWriter, compress_block, plain_name
+    from ava.fasta_reader import open_reference
+    from ava.fasta_writer import FastaWriter
+    from ava.log_sink import (AMBIGUOUS_ALLELE, EMPTY_FILE, MISMATCHED_REFERENCE, MULTIPLE_CHROMOSOMES, OUT_OF_REGION,
+                              SKIPPED_CALLS, UNAPPLIED_VARIANT, UNMAPPED_GENE, UNREADABLE_FILE, UNREADABLE_POSITION,
+                              Event, init_worker_log, send_events)
+    from ava.metadata_types import Cid, Gid, Reference, Sid
+    from ava.profiling import profile_task
+    from ava.shared_reference import attach, read_shared
+    from ava.sites import site_matrix, write_sites
+    from ava.variant_store import VariantSet
+except:
+    # allow imports when run in place
+    from bgzf import EOF_BLOCK, MAX_BLOCK_DATA, BgzfWriter, compress_block, plain_name
+    from fasta_reader import open_reference
+    from fasta_writer import FastaWriter
+    from log_sink import (AMBIGUOUS_ALLELE, EMPTY_FILE, MISMATCHED_REFERENCE, MULTIPLE_CHROMOSOMES, OUT_OF_REGION,
+                          SKIPPED_CALLS, UNAPPLIED_VARIANT, UNMAPPED_GENE, UNREADABLE_FILE, UNREADABLE_POSITION, Event,
+                          init_worker_log, send_events)
+    from metadata_types import Cid, Gid, Reference, Sid
+    from profiling import profile_task
+    from shared_reference import attach, read_shared
+    from sites import site_matrix, write_sites
+    from variant_store import VariantSet
+
+class OutputOptions(NamedTuple):
+    """ Settings shared by every task in a run """
+    root: pathlib.Path
+    line_width: int = 60
+    # file layout is written by the workers, other layouts are returned to the parent to collect
+    layout: str = "file"
+    # Record timings for every task, and cProfile stats when profile_top is set
+    profile: bool = False
+    profile_top: int = 0
+    # Write bgzip compressed .fa.gz files
+    compress: bool = False
+    # Write only the variable sites of each gene in this format (see sites.SITE_FORMATS) instead of whole sequences
+    sites: Optional[str] = None
+
+# Open references, kept for the life of the worker
+_handles: Dict[pathlib.Path, object] = {}
+
+def init_worker(events, shared: Optional[Tuple[str, Dict]] = None):
+    """ Pool initializer. shared is SharedReference.worker_args() when the parent has shared the reference regions """
+    init_worker_log(events)
+    if shared is not None:
+        attach(*shared)
+
+VARIANT_COLUMNS = {"Chromosome": str, "Region": str, "Reference": str, "Allele": str}
+
+def read_variant_table(variant_path: pathlib.Path, warnings: List[Event]) -> Optional["pandas.DataFrame"]:
+    """ The variant columns of a file, or None (with a warning) if it isn't a variant file, e.g. another CSV left in
+        the input folder """
+    import pandas
+
+    try:
+        return pandas.read_csv(str(variant_path.absolute()), usecols=list(VARIANT_COLUMNS), dtype=VARIANT_COLUMNS,
+                               keep_default_na=False)
+    except (ValueError, KeyError) as e:
+        # Missing columns, unparseable or empty files all end up here
+        warnings.append((UNREADABLE_FILE, f"[WARN] While parsing {str(variant_path.absolute())}: not a variant file "
+                         f"with {', '.join(VARIANT_COLUMNS)} columns ({str(e).strip()}). Skipping."))
         return None
 
+def parse_variant_compat(args):
+    # left_out holds genes deliberately not selected, whose files aren't worth a warning
+    variant_path, info, left_out = args
+    # .csv.gz is read the same as .csv
+    name = plain_name(variant_path).removesuffix(".csv")
+    warnings: List[Event] = []
+    data = read_variant_table(variant_path, warnings)
+    if data is None:
+        return None, warnings
+
+    if not len(data):
+        warnings.append((EMPTY_FILE, f"[WARN] While parsing {str(variant_path.absolute())}: File has no entries. "
+                         f"Unable to map variants to a known chromosomes detected in same file. Skipping."))
+        return None, warnings
+
     # Get the first value
-    ch = data["Chromosome"][0]
+    ch = data["Chromosome"].iat[0]
 
     # See if there's a gene in this chromosome in the file name
     sid = None
     gid = None
-    for gene in info[ch]:
+    for gene in info.get(ch, ()):
         if gene in name:
-            sid = name.removesuffix(variant_path.suffix).removesuffix(gene).removesuffix("_")
+            sid = name.removesuffix(gene).removesuffix("_")
             gid = gene
             break
 
     if sid == None:
-        return None
+        if any(gene in name for gene in left_out.get(ch, ())):
+            return None, warnings
+        warnings.append((UNMAPPED_GENE, f"[WARN] While parsing {str(variant_path.absolute())}: Unable to match the "
+                         f"file name to a gene on {ch} in the metadata file. Skipping."))
+        return None, warnings
 
     # Get the variation data
-    prev_region = ""
-    prev_allele = ""
-    variances = {}
+    if (data["Chromosome"] != ch).any():
+        warnings.append((MULTIPLE_CHROMOSOMES, f"[WARN] While processing {str(variant_path.absolute())}: multiple "
+                         f"chromosomes detected in same file. This will cause unexpected behaviour"))
 
-    for cid, region, ref, allele in zip(data["Chromosome"], data["Region"], data["Reference"], data["Allele"]):
-        if (cid != ch):
-            log_output.write(f"[WARN] While processing {str(variant_path.absolute())}: multiple chromosomes detected in"
-                             f" same file. This will cause unexpected behaviour\n")
+    positions, keep = find_variances(variant_path, data, warnings)
+    variances = VariantSet.from_columns(positions[keep].to_numpy(), data["Reference"][keep], data["Allele"][keep])
 
-        # Check for an edge case for two regions with different alleles
-        if prev_region == region and allele != ref and prev_allele != ref:
-            log_output.write(f"[WARN] Unexpected event. Found an instance in {str(variant_path.absolute())} where "
-                             f"neither allele - ({allele} and {prev_allele}) did not match the reference: {ref} at position {region}\n")
+    return (sid, ch, gid, variances), warnings
 
-        prev_region = region
-        prev_allele = allele
+def find_variances(variant_path: pathlib.Path, data: "pandas.DataFrame", warnings: List[Event]):
+    """ 0-based positions of every row (NaN where unreadable) and a mask of the rows that differ from the reference """
+    import pandas
 
-        # Skip instances where this was not the variance
-        if allele == ref:
-            continue
+    region, ref, allele = data["Region"], data["Reference"], data["Allele"]
+    # Check for an edge case for two regions with different alleles
+    prev_region, prev_allele = region.shift(), allele.shift()
+    unexpected = (prev_region == region) & (allele != ref) & (prev_allele != ref)
+    for position, current, new, prev in zip(region[unexpected], ref[unexpected], allele[unexpected],
+                                            prev_allele[unexpected]):
+        warnings.append((AMBIGUOUS_ALLELE, f"[WARN] Unexpected event. Found an instance in "
+                         f"{str(variant_path.absolute())} where neither allele - ({new} and {prev}) did not match the "
+                         f"reference: {current} at position {position}"))
 
-        variances[int(region) -1 ] = (ref, allele)
+    positions = pandas.to_numeric(region, errors="coerce")
+    for position in region[positions.isna()]:
+        warnings.append((UNREADABLE_POSITION, f"[WARN] While parsing {str(variant_path.absolute())}: could not read "
+                         f"position {position}. Skipping."))
 
-    return (sid, ch, gid, variances)
+    # Only substitutions are applied, as vcf.py does
+    lengths = ref.str.len() != allele.str.len()
+    if lengths.any():
+        warnings.append((SKIPPED_CALLS, f"[WARN] While parsing {str(variant_path.absolute())}: skipped "
+                         f"{int(lengths.sum())} variants that were not substitutions (insertions or deletions)."))
 
-def process_variations_compat(args):
-    output_root, data, log_output_path = args
-    log_output = open(log_output_path, 'a')
-    # Create a temp file and copy the contents of
-    sid, cid, gid, ranges, variations, record_path = data
-    record = Fasta(record_path)[cid]
-    temp_file = output_root / f"{cid}_{sid}_{gid}_temp.fa"
-    with open(temp_file, 'w') as f:
-        f.write(f">{record.name}\n")
-        for line in record:
-            f.write(f"{str(line)}\n")
-
-    # temp file has been created. Open it as a fasta, but make it mutable
-    fasta = Fasta(temp_file.absolute(), one_based_attributes=False, mutable=True)
-    mutable = fasta[cid]
-
-    failed_modifications = []
-
-    # Apply changes gloablly for this sample
-    for index, [current, new] in variations.items():
-        if (mutable[index] != current):
-            log_output.write(f"[WARN] while processing varations, position {index + 1} was expecting {current}, but "
-                             f"found {mutable[index]}. Skipping\n")
-
-        try:
-            mutable[index] = new
+    # Skip instances where this was not the variance
+    keep = positions.notna() & (allele != ref) & ~lengths
+    return (positions.fillna(0).astype("int64") - 1), keep
+
+def parse_sample_variants_compat(args):
+    """ Parse a variant file covering whole chromosomes for one sample (named after the file), routing each variant to
+        the genes whose regions cover it. Every gene on the chromosomes in the file gets an entry, even without
+        variants """
+    variant_path, index = args
+    warnings: List[Event] = []
+    data = read_variant_table(variant_path, warnings)
+    if data is None:
+        return None, warnings
+
+    if not len(data):
+        warnings.append((EMPTY_FILE, f"[WARN] While parsing {str(variant_path.absolute())}: File has no entries. "
+                         f"Skipping."))
+        return None, warnings
+
+    sid = plain_name(variant_path).removesuffix(".csv")
+    positions, keep = find_variances(variant_path, data, warnings)
+    data, positions = data[keep], positions[keep]
+
+    result: Dict[Cid, Dict[Gid, VariantSet]] = {}
+    dropped = 0
+    for cid, rows in data.groupby("Chromosome", sort=False).indices.items():
+        if cid not in index:
+            dropped += len(rows)
             continue
-        except OSError as e:
-            # Fault in pyfaidx with newlines. Can circumvent this by modifying 2 chars, but depends on the location
-            if index % 60 == 1 and index > 0:
-                # use the character before
-                mutable[index - 1 : index + 1] = str(mutable[index - 1]) + new
-                continue
-
-            if index % 60 == 0 and index + 1 < len(mutable):
-                mutable[index:index + 1] = new + str(mutable[index + 1])
-                continue
-
-            # hail mary
-            try:
-                mutable[index - 1 : index + 1] = str(mutable[index - 1]) + new
-                continue
-            except:
-                pass
-            try:
-
-                mutable[index:index + 1] = new + str(mutable[index + 1])
-                continue
-            except:
-                pass
-
-            # rip in peace
-            log_output.writable(f"Fatal Error. While processing {sid}_{cid}_{gid} unable to modify {current} to {new} "
-                                "at position {index + 1} due to a bug in pyfaidx with single characters but my "
-                                "workaround didn't work.\n")
-
-            raise e
+        genes, outside = index.route(cid, positions.iloc[rows].to_numpy())
+        dropped += outside
+        refs, alleles = data["Reference"].iloc[rows].to_numpy(), data["Allele"].iloc[rows].to_numpy()
+        result[cid] = {gid: VariantSet.from_columns(positions.iloc[rows].to_numpy()[found], refs[found],
+                                                    alleles[found]) for gid, found in genes.items()}
+        for gid in index.genes(cid):
+            if gid not in result[cid]:
+                result[cid][gid] = VariantSet.from_columns([], [], [])
+
+    if dropped:
+        warnings.append((OUT_OF_REGION, f"[INFO] While parsing {str(variant_path.absolute())}: dropped {dropped} "
+                         f"variants outside the regions in the metadata file."))
+    return (sid, result), warnings
+
+def read_regions(reader, cid, ranges: List[range]) -> bytearray:
+    # Only pull the bases that make it to the output, concatenated in config order
+    buffer = bytearray()
+    for subset in ranges:
+        buffer += reader.fetch(cid, subset.start, subset.stop)
+    return buffer
+
+def read_reference_regions(reference: Reference, cid, ranges: List[range]) -> bytearray:
+    buffer = read_shared(reference, cid, ranges)
+    if buffer is not None:
+        return buffer
+
+    if reference.path not in _handles:
+        _handles[reference.path] = open_reference(reference)
+    return read_regions(_handles[reference.path], cid, ranges)
 
+def apply_variations(buffer: bytearray, ranges: List[range], variations: VariantSet):
+    mismatches: List[Tuple[int, str, str]] = []
+    bases = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    base = 0
+    for subset in ranges:
+        # Variants are sorted, so the ones in this range are a contiguous slice
+        lo, hi = numpy.searchsorted(variations.positions, [subset.start, subset.stop])
+        offsets = variations.positions[lo:hi] - subset.start + base
+        base += len(subset)
+
+        found = bases[offsets]
+        expected = variations.ref[lo:hi]
+        for i in numpy.flatnonzero(found != expected).tolist():
+            mismatches.append((int(variations.positions[lo + i]), chr(expected[i]), chr(found[i])))
+        bases[offsets] = variations.alt[lo:hi]
+    del bases
+
+    # Anything that isn't a single base substitution
+    if variations.other:
+        offsets = []
+        base = 0
+        for subset in ranges:
+            offsets.append((subset.start, subset.stop, base))
+            base += len(subset)
+
+        for index, [current, new] in variations.other.items():
+            for start, stop, base in offsets:
+                if not start <= index < stop:
+                    continue
+                if len(new) != len(current) or index + len(current) > stop:
+                    # Only substitutions are applied. Insertions and deletions would need the sequence to move, and one
+                    # running past the end of its range would grow the sequence or run into the next range
+                    mismatches.append((index, current, None))
+                    continue
+                offset = base + index - start
+                found = buffer[offset:offset + len(current)].decode()
+                if found != current:
+                    mismatches.append((index, current, found))
+                buffer[offset:offset + len(new)] = new.encode()
+    return mismatches
+
+def mismatch_events(mismatches: List[Tuple[int, str, Optional[str]]]) -> List[Event]:
+    """ Events for what apply_variations returns. found is None for variants it leaves out: ones that aren't
+        substitutions or that run past the end of their range """
+    return [(UNAPPLIED_VARIANT, f"[WARN] while processing varations, {current} at position {index + 1} is not a "
+                                f"substitution within one region. Skipping") if found is None else
+            (MISMATCHED_REFERENCE, f"[WARN] while processing varations, position {index + 1} was expecting {current}, "
+                                   f"but found {found}. Skipping")
+            for index, current, found in mismatches]
+
+def log_mismatches(mismatches: List[Tuple[int, str, Optional[str]]]):
+    send_events(mismatch_events(mismatches))
+
+def write_variation(output_root: pathlib.Path, sid, cid, gid, buffer: bytearray, line_width: int,
+                    compress: bool = False):
     # Same subsections of each file
     # Unclear what to do with ranges here - For now assume to just concatenate everything
     ext_name = f"{cid}_{sid}_{gid}"
-    output_file = output_root / f"{ext_name}.fa"
-    with open(output_file, 'w') as f:
-        f.write(f">{ext_name}\n")
-        temp = ""
-        for subset in ranges:
-            for i in range(subset.start, subset.stop):
-                temp += str(mutable[i])
-                if len(temp) % 61 == 60:
-                    #60th character, + new lines before it
-                    temp += "\n"
-        if (temp[-1] != "\n"):
-            temp += "\n"
-        temp += "\n"
-        f.write(temp)
-    # done?
-    fasta.close()
\ No newline at end of file
+    output_file = output_root / f"{ext_name}.fa{'.gz' if compress else ''}"
+    # Every worker is busy already, so compress inline rather than on threads
+    with BgzfWriter(open(output_file, 'wb')) if compress else open(output_file, 'wb') as f:
+        FastaWriter(f, line_width).write(ext_name, buffer)
+
+def write_haplotype(options: OutputOptions, sids: List[Sid], cid, gid, buffer: bytearray):
+    """ Write a sequence shared by several samples to each of their files. The wrapped body (and its bgzip blocks) is
+        made once, and only the header is written per sample """
+    body = io.BytesIO()
+    FastaWriter(body, options.line_width).write_sequence(buffer)
+    body = body.getvalue()
+    if options.compress:
+        # BGZF blocks stand alone, so the header goes in a block of its own in front of the shared body blocks
+        body = b"".join(compress_block(body[i:i + MAX_BLOCK_DATA]) for i in range(0, len(body), MAX_BLOCK_DATA))
+        body += EOF_BLOCK
+    for sid in sids:
+        ext_name = f"{cid}_{sid}_{gid}"
+        header = f">{ext_name}\n".encode()
+        with open(options.root / f"{ext_name}.fa{'.gz' if options.compress else ''}", 'wb') as f:
+            f.write(compress_block(header) if options.compress else header)
+            f.write(body)
+
+def emit_variation(options: OutputOptions, sid, cid, gid, buffer: bytearray, results: list):
+    if options.layout == "file":
+        write_variation(options.root, sid, cid, gid, buffer, options.line_width, options.compress)
+    else:
+        results.append((sid, cid, gid, bytes(buffer)))
+
+# Workers return ([(sid, cid, gid) finished], [(sid, cid, gid, sequence) for the parent to write])
+def process_variations_compat(args):
+    options, data = args
+    sid, cid, gid, ranges, variations, reference = data
+
+    # Read the regions of interest into memory and apply changes gloablly for this sample
+    buffer = read_reference_regions(reference, cid, ranges)
+    log_mismatches(apply_variations(buffer, ranges, variations))
+
+    results = []
+    emit_variation(options, sid, cid, gid, buffer, results)
+    return [(sid, cid, gid)], results
+
+def process_gene_compat(args):
+    options, data = args
+    cid, gid, ranges, reference, samples = data
+
+    # Read the reference region once, then apply each sample's variants to a copy of it
+    region = read_reference_regions(reference, cid, ranges)
+
+    mismatches = []
+    results = []
+    for sid, variations in samples:
+        buffer = bytearray(region)
+        mismatches += apply_variations(buffer, ranges, variations)
+        emit_variation(options, sid, cid, gid, buffer, results)
+    log_mismatches(mismatches)
+    return [(sid, cid, gid) for sid, _ in samples], results
+
+def process_haplotypes_compat(args):
+    options, data = args
+    cid, gid, ranges, reference, haplotypes = data
+
+    # Read the reference region once, then apply each distinct set of variants once for all the samples sharing it
+    region = read_reference_regions(reference, cid, ranges)
+
+    mismatches = []
+    results = []
+    done = []
+    for variations, sids in haplotypes:
+        buffer = bytearray(region)
+        # Counted per sample, as they would be without deduplication
+        mismatches += apply_variations(buffer, ranges, variations) * len(sids)
+        if options.layout == "file":
+            write_haplotype(options, sids, cid, gid, buffer)
+        else:
+            # The same object for every sample, so it is only pickled once on the way back to the parent
+            sequence = bytes(buffer)
+            results += [(sid, cid, gid, sequence) for sid in sids]
+        done += [(sid, cid, gid) for sid in sids]
+    log_mismatches(mismatches)
+    return done, results
+
+def process_sites_compat(args):
+    options, data = args
+    cid, gid, ranges, reference, samples = data
+
+    # Only the reference bases under the variants are read
+    positions, bases, matrix, mismatches = site_matrix(
+        ranges, samples, lambda subsets: read_reference_regions(reference, cid, subsets))
+    write_sites(options.root, options.sites, options.line_width, cid, gid, [sid for sid, _ in samples], positions,
+                bases, matrix)
+    log_mismatches(mismatches)
+    return [(sid, cid, gid) for sid, _ in samples], []
+
+def process_batch(args):
+    """ Run a batch of tasks from the scheduler through worker, merging what they return. The third value holds
+        (timing record, cProfile stats) per task when profiling """
+    worker, options, batch = args
+    done = []
+    results = []
+    profiles = []
+    for data in batch:
+        if options.profile:
+            (finished, sequences), record, stats = profile_task(worker, (options, data), options.profile_top > 0)
+            profiles.append((record, stats))
+        else:
+            finished, sequences = worker((options, data))
+        done += finished
+        results += sequences
+    return done, results, profiles
@@ -5,20 +5,161 @@
 
 import argparse
 import errno
+import gzip
+import os
 import pathlib
+import shutil
 
-from typing import List, Dict, Set, Tuple
-
-from tqdm import tqdm
+from multiprocessing import Pool
+from typing import BinaryIO, List, Dict, NamedTuple, Optional, Set, Tuple
 
 try:
     from ava.argparse_helpers import ValidFolder, ValidFile, ValidOutput
+    from ava.bgzf import BgzfWriter, is_gzip, plain_name
+    from ava.catalog import Catalog
+    from ava.fasta_writer import FastaWriter
 except:
     # allow imports when run in place
     from argparse_helpers import ValidFolder, ValidFile, ValidOutput
+    from bgzf import BgzfWriter, is_gzip, plain_name
+    from catalog import Catalog
+    from fasta_writer import FastaWriter
+
+# Buffer size for the plain read/write fallback when the kernel copies aren't available
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+class RestructureOptions(NamedTuple):
+    output_path: pathlib.Path
+    # None keeps the existing line wrapping and copies the sequence as is
+    line_width: Optional[int] = None
+    move: bool = False
+    # Write bgzip compressed .fa.gz files
+    compress: bool = False
+
+def parse_name(name: str) -> Tuple[Optional[Tuple[str, str, str]], Optional[str]]:
+    """ Split an ava output name into (chromosome, sample, gene). Returns (ids or None, warning or None) """
+    segments = name.count("_")
+    if segments == 4:
+        temp_ch_id_1, temp_ch_id_2, temp_s_id_1, temp_s_id_2, g_id = name.split("_")
+        ch_id = f"{temp_ch_id_1}_{temp_ch_id_2}"
+        s_id = f"{temp_s_id_1}_{temp_s_id_2}"
+        return (ch_id, s_id, g_id), None
+    elif segments == 3:
+        temp_ch_id_1, temp_ch_id_2, s_id, g_id = name.split("_")
+        ch_id = f"{temp_ch_id_1}_{temp_ch_id_2}"
+    elif segments == 2:
+        ch_id, s_id, g_id = name.split("_")
+    else:
+        return None, f"Error: Could not determine file name for {name}\n"
+    return (ch_id, s_id, g_id), (f"Warning: Potentially malformed name While attempting to rename '{name}'. Assuming "
+                                 f"Chromosome: {ch_id}, sample: {s_id}, gene: {g_id} \n")
+
+def copy_body(file_in: BinaryIO, file_out: BinaryIO, offset: int):
+    """ Copy everything after offset from file_in to the end of file_out, in the kernel where possible """
+    file_out.flush()
+    remaining = os.fstat(file_in.fileno()).st_size - offset
+    try:
+        while remaining > 0:
+            copied = os.copy_file_range(file_in.fileno(), file_out.fileno(), remaining, offset)
+            if not copied:
+                break
+            offset += copied
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        while remaining > 0:
+            copied = os.sendfile(file_out.fileno(), file_in.fileno(), offset, remaining)
+            if not copied:
+                break
+            offset += copied
+            remaining -= copied
+        return
+    except (AttributeError, OSError):
+        pass
+    file_in.seek(offset)
+    shutil.copyfileobj(file_in, file_out, COPY_BUFFER_SIZE)
+
+def move_in_place(file: pathlib.Path, out_file: pathlib.Path, first_line: bytes, header: bytes) -> bool:
+    """ Overwrite the header in place and rename the file. Only possible when the new header is as long as the old one
+        (anything else would mean moving the whole body, so it is copied instead) and both paths are on the same
+        filesystem. file must not be open, as Windows can't rename open files """
+    ending = b"\r\n" if first_line.endswith(b"\r\n") else b"\n"
+    if len(header) != len(first_line) - len(ending) or os.stat(file).st_dev != os.stat(out_file.parent).st_dev:
+        return False
+    with open(file, 'r+b') as f:
+        f.write(header)
+    os.replace(file, out_file)
+    return True
+
+def open_input(file: pathlib.Path, compressed: bool) -> BinaryIO:
+    return gzip.open(file, 'rb') if compressed else open(file, 'rb')
+
+def restructure_file(args) -> Tuple[List[str], int]:
+    """ Re-file a single ava output into the per gene folder structure. Returns (log lines, number of issues) """
+    file, options = args
+    file: pathlib.Path
+    options: RestructureOptions
+    log: List[str] = []
+
+    # get the ch and g IDs
+    name = plain_name(file).removesuffix(".fa").removesuffix(".fasta")
+    ids, warning = parse_name(name)
+    if warning:
+        log.append(warning)
+    if ids is None:
+        return log, len(log)
+    ch_id, s_id, g_id = ids
+
+    # determine output subdirectory
+    out_subdir = options.output_path / f"{ch_id}_{g_id}"
+    out_subdir.mkdir(exist_ok=True)
+
+    # start moving data from the old file to the new one, but be sure to change the file name and sequence name
+    out_file = out_subdir / f"{s_id}.fa{'.gz' if options.compress else ''}"
+    # The sample is the record ID. The chromosome and gene go in the description, which also keeps the header as long
+    # as ava's >{ch_id}_{s_id}_{g_id}, so --move can rewrite it in place
+    record = f"{s_id} {ch_id}_{g_id}"
+    header = f">{record}".encode()
+    # Compressed inputs are read through gzip, and the body can only be copied byte for byte between plain files
+    compressed = is_gzip(file)
+    raw = not compressed and not options.compress
+    with open_input(file, compressed) as file_in:
+        first_line = file_in.readline()
+    if first_line == b"":
+        log.append(f"Empty value in {file.name}\n")
+        return log, len(log)
+    if f">{name}".encode() not in first_line:
+        log.append(f"unexpected data in {file.name}\n")
+
+    # Tried once the input is closed again
+    if raw and options.line_width is None and options.move and move_in_place(file, out_file, first_line, header):
+        return log, len(log)
+
+    with open_input(file, compressed) as file_in:
+        file_in.readline()
+        with BgzfWriter(open(out_file, 'wb')) if options.compress else open(out_file, 'wb') as file_out:
+            if options.line_width is not None:
+                # Re-wrap the whole sequence body in one go
+                FastaWriter(file_out, options.line_width).write(record, file_in.read().translate(None, b"\r\n"))
+            elif raw:
+                # Only the header changes, the body is copied as is
+                file_out.write(header + b"\n")
+                copy_body(file_in, file_out, len(first_line))
+            else:
+                file_out.write(header + b"\n")
+                shutil.copyfileobj(file_in, file_out, COPY_BUFFER_SIZE)
+
+    if options.move:
+        file.unlink()
 
+    return log, len(log)
 
 def main():
+    # Workers only need restructure_file, so the progress bar is imported here
+    from tqdm import tqdm
+
     # Load input arguments
 
     parser = argparse.ArgumentParser("post_ava", description="ava postprocessor (copy and rename output sequence files)")
@@ -26,70 +167,48 @@ def main():
     parser.add_argument("--input", "-i", type=ValidFolder, help="Folder with all the ava output .fasta/.fa files",
                         default='.')
     parser.add_argument("--output", "-o", type=ValidOutput, required=True, help="Output folder for renamed outputs to go")
+    parser.add_argument("--line-width", type=int, default=None, help="Re-wrap sequences to this many bases per line "
+                        "(0 to write each sequence on a single line). By default sequences are copied as is")
+    parser.add_argument("--move", action="store_true", help="Move the input files instead of copying them. Files are "
+                        "renamed in place when the input and output are on the same filesystem")
+    parser.add_argument("--compress", action="store_true", help="Write bgzip compressed .fa.gz files. Compressed "
+                        "(.fa.gz) inputs are always read")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number "
+                        "of CPUs)")
+    parser.add_argument("--scan-snapshot", type=ValidOutput, default=None, help="File to save a snapshot of the "
+                        "input folder listing to. Later runs only list folders that have changed since")
 
     args = parser.parse_args()
     input_path: pathlib.Path = args.input
     output_path: pathlib.Path = args.output
+    line_width: Optional[int] = args.line_width
+    if line_width is not None and line_width < 0:
+        print("Expecting a line width of 0 or more")
+        exit(errno.EINVAL)
+    if args.workers is not None and args.workers < 1:
+        print("Expecting at least 1 worker")
+        exit(errno.EINVAL)
     if not output_path.exists():
         output_path.mkdir()
     log_file_path = output_path / "post_output.log"
     log_count = 0
 
     with open(log_file_path, 'w') as log:
-        # Recursively get any input .fa/.fasta files
-        input_files: List[pathlib.Path] = [file for file in input_path.glob("**/*.fa")]
-        input_files += [file for file in input_path.glob("**/*.fasta")]
+        # Recursively get any input .fa/.fasta files, compressed or not
+        input_files: List[pathlib.Path] = Catalog(input_path, args.scan_snapshot).sequences
 
         # process each file
-        for file in tqdm(input_files):
-            file: pathlib.Path
-            # get the ch and g IDs
-            name = file.name.removesuffix(".fa").removesuffix(".fasta")
-            segments = name.count("_")
-            if segments == 4:
-                temp_ch_id_1, temp_ch_id_2, temp_s_id_1, temp_s_id_2, g_id = name.split("_")
-                ch_id = f"{temp_ch_id_1}_{temp_ch_id_2}"
-                s_id = f"{temp_s_id_1}_{temp_s_id_2}"
-            elif segments == 3:
-                temp_ch_id_1, temp_ch_id_2, s_id, g_id = name.split("_")
-                ch_id = f"{temp_ch_id_1}_{temp_ch_id_2}"
-                log.write(f"Warning: Potentially malformed name While attempting to rename '{name}'. Assuming "
-                          f"Chromosome: {ch_id}, sample: {s_id}, gene: {g_id} \n")
-                log_count += 1
-            elif segments == 2:
-                ch_id, s_id, g_id = name.split("_")
-                log.write(f"Warning: Potentially malformed name While attempting to rename '{name}'. Assuming "
-                          f"Chromosome: {ch_id}, sample: {s_id}, gene: {g_id} \n")
-                log_count += 1
-            else:
-                log.write(f"Error: Could not determine file name for {name}")
-                log_count += 1
-                continue
-
-            # determine output subdirectory
-            out_subdir = output_path / f"{ch_id}_{g_id}"
-            if not out_subdir.exists():
-                out_subdir.mkdir()
-
-            # start moving data from the old file to the new one, but be sure to change the file name and sequence name
-            out_file = out_subdir / f"{s_id}.fa"
-            with open(file, 'r') as file_in:
-                with open(out_file, 'w') as file_out:
-                    first_line = file_in.readline()
-                    if first_line == "":
-                        log.write(f"Empty value in {file.name}\n")
-                        log_count += 1
-                        continue
-                    if f">{name}" not in first_line:
-                        log.write(f"unexpected data in {file.name}\n")
-                        log_count += 1
-                    file_out.write(f">{s_id}\n")
-                    line = file_in.readline()
-                    while line != "":
-                        file_out.write(line)
-                        line = file_in.readline()
+        options = RestructureOptions(output_path, line_width, args.move, args.compress)
+        tasks = [(file, options) for file in input_files]
+        workers = args.workers or os.cpu_count() or 1
+        with Pool(workers) as pool:
+            chunksize = max(1, len(tasks) // (workers * 4))
+            for lines, count in tqdm(pool.imap_unordered(restructure_file, tasks, chunksize=chunksize),
+                                     total=len(tasks)):
+                log.writelines(lines)
+                log_count += count
 
     print(f"Renamed {len(input_files)} files with {log_count} potential issues. {f'See {str(log_file_path)} for more details' if log_count else ''}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
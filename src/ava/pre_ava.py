@@ -9,16 +9,18 @@ import pathlib
 
 from typing import List, Dict, Set, Tuple
 
-from tqdm import tqdm
-
 try:
     from ava.argparse_helpers import ValidFolder, ValidFile, ValidOutput
+    from ava.catalog import Catalog
 except:
     # allow imports when run in place
     from argparse_helpers import ValidFolder, ValidFile, ValidOutput
+    from catalog import Catalog
 
 
 def main():
+    from tqdm import tqdm
+
     # Load input arguments
 
     parser = argparse.ArgumentParser("pre_ava", description="ava preprocessor (rename input variant files)")
@@ -26,13 +28,15 @@ def main():
     parser.add_argument("--input", "-i", type=ValidFolder, help="Folder with all the input .csv and .fasta files",
                         default='.')
     parser.add_argument("--name", "-n", type=str, default=" (Variants, filtered)", help="Name to remove from file names")
+    parser.add_argument("--scan-snapshot", type=ValidOutput, default=None, help="File to save a snapshot of the "
+                        "input folder listing to. Later runs only list folders that have changed since")
 
     args = parser.parse_args()
     input_path: pathlib.Path = args.input
     name: str = args.name
 
-    # Recursively get any input .csv files and rename instances with name
-    input_variances: List[pathlib.Path] = [file for file in input_path.glob("**/*.csv")]
+    # Recursively get any input .csv files (optionally .gz) and rename instances with name
+    input_variances: List[pathlib.Path] = Catalog(input_path, args.scan_snapshot).variants
 
     # Rename each file
     counter = 0
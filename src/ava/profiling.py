@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# Opt-in instrumentation for ava runs - per stage and per task timings, peak memory and I/O
+
+import cProfile
+import json
+import marshal
+import os
+import pathlib
+import sys
+import time
+
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, memory and child CPU time are reported as 0
+    resource = None
+
+def read_io() -> Tuple[int, int]:
+    """ (bytes read, bytes written) by this process so far, or zeros where /proc isn't available """
+    try:
+        with open("/proc/self/io", 'r') as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+def peak_rss() -> int:
+    """ Peak resident set size of this process in bytes """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def child_cpu() -> float:
+    """ CPU seconds used by finished child processes """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def task_info(data) -> Dict[str, object]:
+    """ What a task covers, for the per sample, per gene and per haplotype task shapes. Haplotype tasks also give the
+        number of haplotypes, and count each one's variants once as that's how often they are applied """
+    haplotypes = None
+    if len(data) == 6:
+        sid, cid, gid, ranges, variations, _ = data
+        samples = [sid]
+        variants = len(variations)
+    else:
+        cid, gid, ranges, _, members = data
+        if members and isinstance(members[0][1], list):
+            # [(variants, [sids])]
+            samples = [sid for _, sids in members for sid in sids]
+            variants = sum(len(variations) for variations, _ in members)
+            haplotypes = len(members)
+        else:
+            # [(sid, variants)]
+            samples = [sid for sid, _ in members]
+            variants = sum(len(variations) for _, variations in members)
+    record = {"sid": samples[0] if len(samples) == 1 else f"{len(samples)} samples", "cid": cid, "gid": gid,
+              "bases": sum(len(subset) for subset in ranges) * len(samples), "variants": variants}
+    if haplotypes is not None:
+        record["haplotypes"] = haplotypes
+    return record
+
+def profile_task(worker, args, with_cprofile: bool):
+    """ Run worker(args), returning (its result, timing record, marshalled cProfile stats or None) """
+    read_before, written_before = read_io()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    stats = None
+    if with_cprofile:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(worker, args)
+        profiler.create_stats()
+        stats = marshal.dumps(profiler.stats)
+    else:
+        result = worker(args)
+    read_after, written_after = read_io()
+
+    record = task_info(args[1])
+    record.update({"wall_seconds": time.perf_counter() - wall, "cpu_seconds": time.process_time() - cpu,
+                   "bytes_read": read_after - read_before, "bytes_written": written_after - written_before,
+                   "worker": os.getpid(), "worker_peak_rss": peak_rss()})
+    return result, record, stats
+
+class RunProfile():
+    """ Collects stage timings in the parent and task records from the workers, then writes the report """
+    def __init__(self, top: int = 0):
+        self.top = top
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.tasks: List[Dict[str, object]] = []
+        # (wall seconds, task record, marshalled stats) for the slowest tasks
+        self.slowest: List[Tuple[float, Dict[str, object], bytes]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        read_before, written_before = read_io()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        children = child_cpu()
+        yield
+        read_after, written_after = read_io()
+        self.stages[name] = {"wall_seconds": time.perf_counter() - wall, "cpu_seconds": time.process_time() - cpu,
+                             # Only includes workers that have exited by the end of the stage
+                             "child_cpu_seconds": child_cpu() - children,
+                             "bytes_read": read_after - read_before, "bytes_written": written_after - written_before}
+
+    def add_tasks(self, records: List[Tuple[Dict[str, object], Optional[bytes]]]):
+        for record, stats in records:
+            self.tasks.append(record)
+            if stats is None:
+                continue
+            self.slowest.append((record["wall_seconds"], record, stats))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[self.top:]
+
+    def write(self, output_path: pathlib.Path, suffix: str = "") -> pathlib.Path:
+        """ Write profile{suffix}.json (and cProfile dumps for the slowest tasks) to output_path, returning the report
+            path """
+        worker_peaks: Dict[str, int] = {}
+        for task in self.tasks:
+            worker_peaks[str(task["worker"])] = max(worker_peaks.get(str(task["worker"]), 0), task["worker_peak_rss"])
+
+        dumps = []
+        if self.slowest:
+            profile_dir = output_path / f"profile{suffix}"
+            profile_dir.mkdir(exist_ok=True)
+            for rank, (_, record, stats) in enumerate(self.slowest, 1):
+                path = profile_dir / f"{rank:03d}_{record['cid']}_{record['gid']}.prof"
+                with open(path, 'wb') as f:
+                    f.write(stats)
+                dumps.append(str(path))
+
+        report_path = output_path / f"profile{suffix}.json"
+        with open(report_path, 'w') as f:
+            json.dump({"stages": self.stages, "tasks": self.tasks, "worker_peak_rss": worker_peaks,
+                       "parent_peak_rss": peak_rss(), "cprofile_dumps": dumps}, f, indent=2)
+        return report_path
+
+    def summary(self, slowest: int = 10) -> str:
+        lines = [f"{'stage':<20} {'wall (s)':>10} {'cpu (s)':>10} {'child cpu (s)':>14} {'read (MB)':>10} "
+                 f"{'written (MB)':>13}"]
+        for name, stage in self.stages.items():
+            lines.append(f"{name:<20} {stage['wall_seconds']:>10.3f} {stage['cpu_seconds']:>10.3f} "
+                         f"{stage['child_cpu_seconds']:>14.3f} {stage['bytes_read'] / 1e6:>10.1f} "
+                         f"{stage['bytes_written'] / 1e6:>13.1f}")
+
+        if self.tasks:
+            lines.append("")
+            lines.append(f"Slowest tasks (of {len(self.tasks)})")
+            for task in sorted(self.tasks, key=lambda task: task["wall_seconds"], reverse=True)[:slowest]:
+                lines.append(f"  {task['cid']}_{task['gid']} ({task['sid']}): {task['wall_seconds']:.3f}s, "
+                             f"{task['bases']:,} bases, {task['variants']:,} variants")
+            lines.append(f"Peak worker RSS: {max(task['worker_peak_rss'] for task in self.tasks) / 1e6:.1f} MB, "
+                         f"parent: {peak_rss() / 1e6:.1f} MB")
+        return "\n".join(lines)
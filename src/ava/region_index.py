@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Sorted interval index over the configured gene regions, to route variants by position to the genes that cover them
+
+from typing import Dict, List, Tuple
+
+import numpy
+
+try:
+    from ava.metadata_types import Cid, Gid
+except:
+    # allow imports when run in place
+    from metadata_types import Cid, Gid
+
+class RegionIndex():
+    """ Per chromosome, the config ranges sorted by start along with a running maximum of their stops, so a binary
+        search finds the ranges overlapping a position even when genes overlap each other """
+    def __init__(self, cfg: Dict[Cid, Dict[Gid, List[range]]]):
+        self.starts: Dict[Cid, numpy.ndarray] = {}
+        self.stops: Dict[Cid, numpy.ndarray] = {}
+        self.max_stops: Dict[Cid, numpy.ndarray] = {}
+        self.gids: Dict[Cid, List[Gid]] = {}
+        # Genes in config order
+        self.order: Dict[Cid, List[Gid]] = {}
+        for cid, genes in cfg.items():
+            self.order[cid] = list(genes)
+            spans = sorted((subset.start, subset.stop, gid) for gid, ranges in genes.items() for subset in ranges)
+            self.starts[cid] = numpy.array([start for start, _, _ in spans], dtype=numpy.int64)
+            self.stops[cid] = numpy.array([stop for _, stop, _ in spans], dtype=numpy.int64)
+            self.max_stops[cid] = numpy.maximum.accumulate(self.stops[cid]) if spans else self.stops[cid]
+            self.gids[cid] = [gid for _, _, gid in spans]
+
+    def __contains__(self, cid) -> bool:
+        return cid in self.starts
+
+    def genes(self, cid: Cid) -> List[Gid]:
+        """ Every gene with a range on the chromosome """
+        return self.order.get(cid, [])
+
+    def chromosomes(self) -> List[Cid]:
+        return list(self.order)
+
+    def start(self, cid: Cid) -> int:
+        """ Start of the first configured range on the chromosome """
+        return int(self.starts[cid][0]) if cid in self and len(self.starts[cid]) else 0
+
+    def end(self, cid: Cid) -> int:
+        """ End of the last configured range on the chromosome """
+        return int(self.max_stops[cid][-1]) if cid in self and len(self.max_stops[cid]) else 0
+
+    def genes_at(self, cid: Cid, position: int) -> List[Gid]:
+        """ Genes with a range covering the 0-based position """
+        if cid not in self:
+            return []
+        result = []
+        # Walk back from the last range starting at or before position until no earlier range can reach it
+        i = int(numpy.searchsorted(self.starts[cid], position, side="right")) - 1
+        while i >= 0 and self.max_stops[cid][i] > position:
+            if self.stops[cid][i] > position and self.gids[cid][i] not in result:
+                result.append(self.gids[cid][i])
+            i -= 1
+        return result
+
+    def route(self, cid: Cid, positions: numpy.ndarray) -> Tuple[Dict[Gid, numpy.ndarray], int]:
+        """ Bucket 0-based positions into genes. Returns ({gid: indices into positions, in their original order}, number
+            of positions outside every range) """
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        if cid not in self:
+            return {}, len(positions)
+
+        order = numpy.argsort(positions, kind="stable")
+        ordered = positions[order]
+        lows = numpy.searchsorted(ordered, self.starts[cid], side="left")
+        highs = numpy.searchsorted(ordered, self.stops[cid], side="left")
+
+        found: Dict[Gid, List[numpy.ndarray]] = {}
+        covered = numpy.zeros(len(positions) + 1, dtype=numpy.int64)
+        for gid, low, high in zip(self.gids[cid], lows.tolist(), highs.tolist()):
+            if low == high:
+                continue
+            found.setdefault(gid, []).append(order[low:high])
+            covered[low] += 1
+            covered[high] -= 1
+
+        result = {gid: numpy.unique(numpy.concatenate(parts)) for gid, parts in found.items()}
+        dropped = int(numpy.count_nonzero(numpy.cumsum(covered[:-1]) == 0))
+        return result, dropped
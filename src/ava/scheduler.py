@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Cost based task scheduling - longest tasks first, small tasks batched together
+
+from typing import Callable, List, Optional, Sequence, TypeVar
+
+T = TypeVar("T")
+
+# Relative cost of a variant compared to copying/writing a base, and the fixed cost of a task (opening the reference,
+# creating the output file), in bases
+VARIANT_WEIGHT = 50
+TASK_OVERHEAD = 20000
+
+# Aim for this many batches per worker when working out the batch size automatically
+BATCHES_PER_WORKER = 8
+
+def estimate_cost(ranges: List[range], variants: int, samples: int = 1) -> int:
+    """ Rough cost of a task: the region is read once and written once per sample """
+    bases = sum(len(subset) for subset in ranges)
+    return TASK_OVERHEAD + bases * (1 + samples) + VARIANT_WEIGHT * variants
+
+def schedule(tasks: Sequence[T], cost: Callable[[T], int], workers: int,
+             chunksize: Optional[int] = None) -> List[List[T]]:
+    """ Order tasks longest-processing-time first and group the small ones into batches.
+
+        Tasks costing at least the target batch cost (total / (workers * BATCHES_PER_WORKER)) go out on their own.
+        Cheaper tasks are grouped until the batch reaches that cost, or holds chunksize tasks if given. Batches come back
+        in descending cost order so the long ones start first and the tail is made of small batches """
+    costs = [cost(task) for task in tasks]
+    order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)
+    target = sum(costs) / max(1, workers * BATCHES_PER_WORKER)
+
+    batches: List[List[T]] = []
+    batch_costs: List[int] = []
+    current: List[T] = []
+    current_cost = 0
+    for i in order:
+        if costs[i] >= target:
+            batches.append([tasks[i]])
+            batch_costs.append(costs[i])
+            continue
+        current.append(tasks[i])
+        current_cost += costs[i]
+        full = len(current) >= chunksize if chunksize is not None else current_cost >= target
+        if full:
+            batches.append(current)
+            batch_costs.append(current_cost)
+            current = []
+            current_cost = 0
+    if current:
+        batches.append(current)
+        batch_costs.append(current_cost)
+
+    return [batches[i] for i in sorted(range(len(batches)), key=lambda i: batch_costs[i], reverse=True)]
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+# Splitting a run across independent jobs (e.g. a batch scheduler array) that share nothing but the output folder.
+# Every shard loads the same inputs and works out the same partition on its own, then only processes its part
+
+import hashlib
+import heapq
+import json
+import pathlib
+
+from typing import Callable, Dict, List, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# hash: outputs go to shards by a stable hash of their names. Nothing to agree on beyond the names
+# cost: outputs are dealt out longest first to the shard with the least work so far, using the scheduler's estimates
+SHARD_MODES = ("hash", "cost")
+
+def shard_suffix(shard: int, shards: int) -> str:
+    """ Added to the name of every bookkeeping file (log, summary, manifest...) a shard writes """
+    return f".shard-{shard}-of-{shards}"
+
+def done_marker_path(output_root: pathlib.Path, shard: int, shards: int) -> pathlib.Path:
+    return output_root / f"shard-{shard}-of-{shards}.done"
+
+def stable_hash(key: str) -> int:
+    # Python's hash() of a str changes between processes, so it can't be used to agree across jobs
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+def assign_shards(costs: Dict[str, int], shards: int, mode: str) -> Dict[str, int]:
+    """ {key: shard (1 based)} for every key. Only depends on the keys (and their costs), never on their order """
+    if mode == "hash":
+        return {key: stable_hash(key) % shards + 1 for key in costs}
+
+    assigned = {}
+    loads = [(0, shard) for shard in range(1, shards + 1)]
+    # Ties broken by key so every shard sorts the same way
+    for key in sorted(costs, key=lambda key: (-costs[key], key)):
+        load, shard = heapq.heappop(loads)
+        assigned[key] = shard
+        heapq.heappush(loads, (load + costs[key], shard))
+    return assigned
+
+def select_shard(tasks: Sequence[T], key: Callable[[T], str], cost: Callable[[T], int], shard: int, shards: int,
+                 mode: str) -> List[T]:
+    """ The tasks belonging to shard. Tasks sharing a key (e.g. writing to the same output file) stay together """
+    costs: Dict[str, int] = {}
+    for task in tasks:
+        costs[key(task)] = costs.get(key(task), 0) + cost(task)
+    assigned = assign_shards(costs, shards, mode)
+    return [task for task in tasks if assigned[key(task)] == shard]
+
+def write_done_marker(path: pathlib.Path, info: Dict):
+    # Only written once everything else is, and moved into place so a merge never sees half of one
+    partial = path.with_name(f"{path.name}.tmp")
+    with open(partial, 'w') as f:
+        json.dump(info, f, indent=2, sort_keys=True)
+    partial.replace(path)
+
+def read_done_markers(output_root: pathlib.Path) -> List[Tuple[pathlib.Path, Dict]]:
+    markers = []
+    for path in sorted(output_root.glob("shard-*-of-*.done")):
+        with open(path, 'r') as f:
+            markers.append((path, json.load(f)))
+    return markers
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Reference regions read once by the parent and shared with the pool workers through shared memory
+
+import bisect
+
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    from ava.fasta_reader import open_reference
+    from ava.metadata_types import Cid, Reference
+except:
+    # allow imports when run in place
+    from fasta_reader import open_reference
+    from metadata_types import Cid, Reference
+
+# (reference path, chromosome) -> (span starts, span stops, offsets into the shared block), sorted by start
+SpanTable = Dict[Tuple[str, Cid], Tuple[List[int], List[int], List[int]]]
+
+_shared: Optional[shared_memory.SharedMemory] = None
+_table: SpanTable = {}
+
+def merge_ranges(ranges: Iterable[range]) -> List[Tuple[int, int]]:
+    """ Sorted (start, stop) spans covering every range, with overlapping or touching ranges joined """
+    spans: List[Tuple[int, int]] = []
+    for subset in sorted(ranges, key=lambda subset: subset.start):
+        if spans and subset.start <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], subset.stop))
+        else:
+            spans.append((subset.start, subset.stop))
+    return spans
+
+class SharedReference():
+    """ Parent side. Reads the merged regions that the tasks need from each reference once, into a single shared
+        memory block that workers attach to with attach(*shared.worker_args()) """
+    def __init__(self, regions: Iterable[Tuple[Reference, Cid, List[range]]]):
+        wanted: Dict[Tuple[Reference, Cid], List[range]] = {}
+        for reference, cid, ranges in regions:
+            wanted.setdefault((reference, cid), []).extend(ranges)
+
+        self.table: SpanTable = {}
+        size = 0
+        for (reference, cid), ranges in wanted.items():
+            spans = merge_ranges(ranges)
+            offsets = []
+            for start, stop in spans:
+                offsets.append(size)
+                size += stop - start
+            self.table[(str(reference.path), cid)] = ([start for start, _ in spans], [stop for _, stop in spans],
+                                                       offsets)
+        self.size = size
+
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, size))
+        try:
+            references: Dict[Reference, List[Cid]] = {}
+            for reference, cid in wanted:
+                references.setdefault(reference, []).append(cid)
+            for reference, cids in references.items():
+                reader = open_reference(reference)
+                try:
+                    for cid in cids:
+                        starts, stops, offsets = self.table[(str(reference.path), cid)]
+                        for i, (start, stop, offset) in enumerate(zip(starts, stops, offsets)):
+                            sequence = reader.fetch(cid, start, stop)
+                            self.memory.buf[offset:offset + len(sequence)] = sequence
+                            # Ranges past the end of the chromosome are short, leave those to the fallback reader
+                            stops[i] = start + len(sequence)
+                finally:
+                    reader.close()
+        except:
+            self.close()
+            raise
+
+    def worker_args(self) -> Tuple[str, SpanTable]:
+        return self.memory.name, self.table
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def attach(name: str, table: SpanTable):
+    """ Worker side, from the pool initializer. The block stays attached for the life of the worker """
+    global _shared, _table
+    _shared = shared_memory.SharedMemory(name=name)
+    _table = table
+
+def read_shared(reference: Reference, cid: Cid, ranges: List[range]) -> Optional[bytearray]:
+    """ The bases of ranges concatenated, copied from the shared block, or None if they aren't all shared """
+    if _shared is None:
+        return None
+    spans = _table.get((str(reference.path), cid))
+    if spans is None:
+        return None
+    starts, stops, offsets = spans
+
+    buffer = bytearray()
+    for subset in ranges:
+        i = bisect.bisect_right(starts, subset.start) - 1
+        if i < 0 or stops[i] < subset.stop:
+            return None
+        offset = offsets[i] + subset.start - starts[i]
+        buffer += _shared.buf[offset:offset + len(subset)]
+    return buffer
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Variable site output. Instead of every base of every gene, only the columns of a gene where some sample differs from
+# the reference are written, as a samples x sites matrix. Built from the variants and the reference bases under them,
+# so the cost follows the number of variants rather than the length of the genes
+
+import pathlib
+
+from typing import Callable, List, Optional, Tuple
+
+import numpy
+
+try:
+    from ava.fasta_writer import FastaWriter
+    from ava.metadata_types import Sid
+    from ava.variant_store import VariantSet
+except:
+    # allow imports when run in place
+    from fasta_writer import FastaWriter
+    from metadata_types import Sid
+    from variant_store import VariantSet
+
+# npy: {cid}_{gid}.npy of uint8 base codes, one row per sample, with the row names in {cid}_{gid}.samples.txt
+# phylip: {cid}_{gid}.phy, a relaxed sequential PHYLIP alignment
+# fasta: {cid}_{gid}.snps.fa, a FASTA alignment with a record per sample
+# Each also gets {cid}_{gid}.sites.tsv giving the position and reference base of every column
+SITE_FORMATS = ("npy", "phylip", "fasta")
+SITE_EXTENSIONS = {"npy": ".npy", "phylip": ".phy", "fasta": ".snps.fa"}
+
+# Reference bases this close together are read in one go
+FETCH_GAP = 256
+
+def site_file_name(site_format: str, cid, gid) -> str:
+    """ Name of the main file for a gene in a site format """
+    return f"{cid}_{gid}{SITE_EXTENSIONS[site_format]}"
+
+def range_offsets(ranges: List[range]) -> List[Tuple[int, int, int]]:
+    """ (start, stop, offset in the concatenated sequence) of each range """
+    spans = []
+    base = 0
+    for subset in ranges:
+        spans.append((subset.start, subset.stop, base))
+        base += len(subset)
+    return spans
+
+def genomic_positions(spans: List[Tuple[int, int, int]], offsets: numpy.ndarray) -> numpy.ndarray:
+    """ 0-based reference positions of offsets into the concatenated sequence """
+    bases = numpy.array([base for _, _, base in spans], dtype=numpy.int64)
+    starts = numpy.array([start for start, _, _ in spans], dtype=numpy.int64)
+    i = numpy.searchsorted(bases, offsets, side="right") - 1
+    return starts[i] + offsets - bases[i]
+
+def fetch_bases(spans: List[Tuple[int, int, int]], offsets: numpy.ndarray,
+                fetch: Callable[[List[range]], bytes]) -> numpy.ndarray:
+    """ Reference bases at sorted offsets into the concatenated sequence, reading nearby ones together """
+    positions = genomic_positions(spans, offsets).tolist()
+    bases = numpy.array([base for _, _, base in spans], dtype=numpy.int64)
+    # Reads can't run from one range into the next, as the ranges needn't be next to each other in the reference
+    span_of = (numpy.searchsorted(bases, offsets, side="right") - 1).tolist()
+    ranges: List[range] = []
+    index: List[int] = []
+    read = 0
+    current_span = None
+    for position, span in zip(positions, span_of):
+        if ranges and span == current_span and position - ranges[-1].stop < FETCH_GAP:
+            ranges[-1] = range(ranges[-1].start, position + 1)
+        else:
+            if ranges:
+                read += len(ranges[-1])
+            ranges.append(range(position, position + 1))
+            current_span = span
+        index.append(read + position - ranges[-1].start)
+    return numpy.frombuffer(bytes(fetch(ranges)), dtype=numpy.uint8)[index]
+
+def sample_edits(spans: List[Tuple[int, int, int]], variations: VariantSet):
+    """ Single base substitutions of a sample as (offsets, references, alleles) into the concatenated sequence, and
+        its other variants as [(position, offset, reference, allele)], in the order apply_variations applies them. The
+        offset is None for those it leaves out, as they aren't substitutions or run past the end of their range """
+    offsets, refs, alts = [numpy.zeros(0, dtype=numpy.int64)], [numpy.zeros(0, dtype=numpy.uint8)], \
+                          [numpy.zeros(0, dtype=numpy.uint8)]
+    for start, stop, base in spans:
+        lo, hi = numpy.searchsorted(variations.positions, [start, stop])
+        offsets.append(variations.positions[lo:hi] - start + base)
+        refs.append(variations.ref[lo:hi])
+        alts.append(variations.alt[lo:hi])
+
+    others = []
+    for index, [current, new] in variations.other.items():
+        for start, stop, base in spans:
+            if start <= index < stop:
+                applied = len(new) == len(current) and index + len(current) <= stop
+                offset = base + index - start if applied else None
+                others.append((index, offset, current, new))
+    return numpy.concatenate(offsets), numpy.concatenate(refs), numpy.concatenate(alts), others
+
+def site_matrix(ranges: List[range], samples: List[Tuple[Sid, VariantSet]],
+                fetch: Callable[[List[range]], bytes]):
+    """ (0-based positions, reference codes, samples x sites uint8 matrix, mismatches) for the variable sites of a
+        gene. Each column is what the full sequence made by apply_variations would hold there, including its reference
+        mismatch warnings. fetch reads ranges of the reference, concatenated """
+    spans = range_offsets(ranges)
+
+    # First work out every offset whose reference base matters and read just those
+    edits = [sample_edits(spans, variations) for _, variations in samples]
+    needed = [numpy.zeros(0, dtype=numpy.int64)]
+    for offsets, _, _, others in edits:
+        needed.append(offsets)
+        for _, offset, current, new in others:
+            if offset is not None:
+                needed.append(numpy.arange(offset, offset + len(current), dtype=numpy.int64))
+    needed = numpy.unique(numpy.concatenate(needed))
+    reference = fetch_bases(spans, needed, fetch) if len(needed) else numpy.zeros(0, dtype=numpy.uint8)
+
+    def reference_at(offsets) -> numpy.ndarray:
+        return reference[numpy.searchsorted(needed, offsets)]
+
+    mismatches: List[Tuple[int, str, Optional[str]]] = []
+    changes = []
+    for offsets, refs, alts, others in edits:
+        found = reference_at(offsets)
+        positions = genomic_positions(spans, offsets) if len(offsets) else offsets
+        for i in numpy.flatnonzero(found != refs).tolist():
+            mismatches.append((int(positions[i]), chr(refs[i]), chr(found[i])))
+        if not others:
+            changes.append((offsets, alts))
+            continue
+
+        # Multi base variants see the sequence as the earlier variants left it
+        state = dict(zip(offsets.tolist(), alts.tolist()))
+        for index, offset, current, new in others:
+            if offset is None:
+                mismatches.append((index, current, None))
+                continue
+            found = bytes(state.get(o, int(reference_at(o))) for o in range(offset, offset + len(current))).decode()
+            if found != current:
+                mismatches.append((index, current, found))
+            for o, base in enumerate(new.encode(), offset):
+                state[o] = base
+        changes.append((numpy.fromiter(state.keys(), dtype=numpy.int64, count=len(state)),
+                        numpy.fromiter(state.values(), dtype=numpy.uint8, count=len(state))))
+
+    # One column per changed offset, then only keep the ones where a sample ends up different from the reference
+    columns = numpy.unique(numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] +
+                                             [offsets for offsets, _ in changes]))
+    column_reference = reference_at(columns) if len(columns) else numpy.zeros(0, dtype=numpy.uint8)
+    matrix = numpy.tile(column_reference, (len(samples), 1))
+    for row, (offsets, alleles) in enumerate(changes):
+        matrix[row, numpy.searchsorted(columns, offsets)] = alleles
+    variable = (matrix != column_reference).any(axis=0)
+    columns = columns[variable]
+    positions = genomic_positions(spans, columns) if len(columns) else columns
+    return positions, column_reference[variable], matrix[:, variable], mismatches
+
+def write_sites(root: pathlib.Path, site_format: str, line_width: int, cid, gid, sids: List[Sid],
+                positions: numpy.ndarray, reference: numpy.ndarray, matrix: numpy.ndarray):
+    name = f"{cid}_{gid}"
+    with open(root / f"{name}.sites.tsv", 'w') as f:
+        f.write("Position\tReference\n")
+        f.writelines(f"{position + 1}\t{chr(base)}\n" for position, base in zip(positions.tolist(), reference.tolist()))
+
+    path = root / site_file_name(site_format, cid, gid)
+    if site_format == "npy":
+        numpy.save(path, matrix)
+        with open(root / f"{name}.samples.txt", 'w') as f:
+            f.writelines(f"{sid}\n" for sid in sids)
+    elif site_format == "phylip":
+        # Names padded to the strict PHYLIP 10 characters where they fit
+        width = max([10] + [len(sid) + 1 for sid in sids])
+        with open(path, 'wb') as f:
+            f.write(f"{len(sids)} {matrix.shape[1]}\n".encode())
+            for sid, row in zip(sids, matrix):
+                f.write(sid.ljust(width).encode() + row.tobytes() + b"\n")
+    else:
+        with open(path, 'wb') as f:
+            writer = FastaWriter(f, line_width)
+            for sid, row in zip(sids, matrix):
+                writer.write(sid, row.tobytes())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# Compact storage for the variants of one sample in one gene
+
+from typing import Dict, Iterator, Tuple
+
+import numpy
+
+class VariantSet():
+    """ Sorted 0-based positions with uint8 reference/allele codes for single base substitutions. Anything else (e.g.
+        multi base substitutions) is kept as a {position: (reference, allele)} dict in other """
+    __slots__ = ("positions", "ref", "alt", "other")
+
+    def __init__(self, positions: numpy.ndarray, ref: numpy.ndarray, alt: numpy.ndarray,
+                 other: Dict[int, Tuple[str, str]] = None):
+        self.positions = positions
+        self.ref = ref
+        self.alt = alt
+        self.other = other or {}
+
+    @classmethod
+    def from_columns(cls, positions, refs, alts) -> "VariantSet":
+        """ Build from parallel sequences of 0-based positions, references and alleles. Later entries for the same
+            position replace earlier ones """
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        refs = list(refs)
+        alts = list(alts)
+
+        # Keep the last entry for each position
+        unique, last = numpy.unique(positions[::-1], return_index=True)
+        last = len(positions) - 1 - last
+
+        snp = [i for i in last.tolist() if len(refs[i]) == 1 and len(alts[i]) == 1]
+        other = {int(positions[i]): (refs[i], alts[i]) for i in last.tolist() if len(refs[i]) != 1 or
+                 len(alts[i]) != 1}
+        return cls(positions[snp], encode(refs[i] for i in snp), encode(alts[i] for i in snp), other)
+
+    @classmethod
+    def from_dict(cls, variations: Dict[int, Tuple[str, str]]) -> "VariantSet":
+        return cls.from_columns(list(variations.keys()), [ref for ref, _ in variations.values()],
+                                [alt for _, alt in variations.values()])
+
+    def __len__(self):
+        return len(self.positions) + len(self.other)
+
+    def items(self) -> Iterator[Tuple[int, Tuple[str, str]]]:
+        """ Iterate (position, (reference, allele)) in the same shape as the old dict based store """
+        for position, ref, alt in zip(self.positions.tolist(), self.ref.tobytes().decode(),
+                                      self.alt.tobytes().decode()):
+            yield position, (ref, alt)
+        yield from self.other.items()
+
+def encode(bases) -> numpy.ndarray:
+    return numpy.frombuffer("".join(bases).encode(), dtype=numpy.uint8).copy()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+# Multi-sample VCF input (plain, gzip or bgzip with an optional tabix index)
+
+import gzip
+import pathlib
+import re
+
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    from ava.bgzf import BgzfReader, is_bgzf, is_gzip, linear_index_offset, read_tabix_linear_index
+    from ava.log_sink import NO_GENOTYPES, OUT_OF_REGION, SKIPPED_CALLS, Event
+    from ava.metadata_types import Cid, Gid, Sid
+    from ava.region_index import RegionIndex
+    from ava.variant_store import VariantSet
+except:
+    # allow imports when run in place
+    from bgzf import BgzfReader, is_bgzf, is_gzip, linear_index_offset, read_tabix_linear_index
+    from log_sink import NO_GENOTYPES, OUT_OF_REGION, SKIPPED_CALLS, Event
+    from metadata_types import Cid, Gid, Sid
+    from region_index import RegionIndex
+    from variant_store import VariantSet
+
+GT_SEPARATOR = re.compile(r"[/|]")
+
+def _records(path: pathlib.Path, index: RegionIndex) -> Iterable[bytes]:
+    """ Yield the raw lines of the VCF, only visiting the configured chromosomes when a tabix index is available """
+    index_path = pathlib.Path(f"{path}.tbi")
+    if is_bgzf(path) and index_path.exists():
+        tabix = read_tabix_linear_index(index_path)
+        with BgzfReader(path) as reader:
+            # Header first, so the sample names are known
+            reader.seek(0)
+            for line in reader:
+                if not line.startswith(b"#"):
+                    break
+                yield line
+            for cid in index.chromosomes():
+                if cid not in tabix or not index.genes(cid):
+                    continue
+                end = index.end(cid)
+                reader.seek(linear_index_offset(tabix[cid], index.start(cid)))
+                started = False
+                for line in reader:
+                    if line.startswith(b"#"):
+                        continue
+                    chrom, position = line.split(b"\t", 2)[:2]
+                    if chrom.decode() != cid:
+                        if started:
+                            break
+                        continue
+                    started = True
+                    if int(position) > end:
+                        break
+                    yield line
+        return
+
+    opener = gzip.open if is_gzip(path) else open
+    with opener(path, 'rb') as f:
+        yield from f
+
+def load_vcf(vcf_path: pathlib.Path, index: RegionIndex):
+    """ Stream a (multi-sample) VCF once, routing each record to every sample and to each gene whose configured ranges
+        overlap it. Returns ({sid: {cid: {gid: VariantSet}}}, warnings) """
+    warnings: List[Event] = []
+    samples: List[Sid] = []
+    columns: Dict[Tuple[Sid, Cid, Gid], Tuple[List[int], List[str], List[str]]] = {}
+    seen: Dict[Cid, bool] = {}
+    skipped = 0
+    dropped = 0
+
+    for raw in _records(vcf_path, index):
+        line = raw.decode().rstrip("\r\n")
+        if line.startswith("##") or not line:
+            continue
+        if line.startswith("#CHROM"):
+            samples = [Sid(sample) for sample in line.split("\t")[9:]]
+            continue
+
+        fields = line.split("\t", 9)
+        cid = fields[0]
+        if cid not in index:
+            continue
+        seen[cid] = True
+        position = int(fields[1]) - 1
+        genes = index.genes_at(cid, position)
+        if not genes:
+            dropped += 1
+            continue
+
+        ref = fields[3]
+        alts = fields[4].split(",")
+        formats = fields[8].split(":") if len(fields) > 9 else []
+        if "GT" not in formats:
+            warnings.append((NO_GENOTYPES, f"[WARN] While parsing {str(vcf_path.absolute())}: record at "
+                             f"{cid}:{position + 1} has no genotypes. Skipping."))
+            continue
+        gt_index = formats.index("GT")
+
+        for sid, sample in zip(samples, fields[9].split("\t")):
+            # Apply the first non reference allele called for this sample
+            called = [int(allele) for allele in GT_SEPARATOR.split(sample.split(":")[gt_index])
+                      if allele.isdigit() and allele != "0"]
+            if not called:
+                continue
+            if called[0] > len(alts):
+                # Allele index past the end of ALT
+                skipped += 1
+                continue
+            alt = alts[called[0] - 1]
+            if len(alt) != len(ref) or alt.startswith("<") or alt == "*":
+                skipped += 1
+                continue
+            for gid in genes:
+                if (sid, cid, gid) not in columns:
+                    columns[(sid, cid, gid)] = ([], [], [])
+                values = columns[(sid, cid, gid)]
+                values[0].append(position)
+                values[1].append(ref)
+                values[2].append(alt)
+
+    if skipped:
+        warnings.append((SKIPPED_CALLS, f"[WARN] While parsing {str(vcf_path.absolute())}: skipped {skipped} calls "
+                         f"that were not substitutions (insertions, deletions or symbolic alleles) or named an allele "
+                         f"missing from ALT."))
+    if dropped:
+        warnings.append((OUT_OF_REGION, f"[INFO] While parsing {str(vcf_path.absolute())}: dropped {dropped} "
+                         f"records outside the regions in the metadata file."))
+
+    # Every sample gets every gene on the chromosomes present in the file, even without variants
+    result: Dict[Sid, Dict[Cid, Dict[Gid, VariantSet]]] = {}
+    for sid in samples:
+        result[sid] = {}
+        for cid in seen:
+            result[sid][cid] = {gid: VariantSet.from_columns(*columns.get((sid, cid, gid), ([], [], [])))
+                                for gid in index.genes(cid)}
+    return result, warnings
@@ -0,0 +1,41 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+SRC = pathlib.Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC))
+
+REFERENCE = {
+    "Chr_01": "ACGT" * 150,
+    "Chr_02": "TTGCA" * 100,
+}
+CONFIG = ("Chromosome_ID,Gene_ID,Region\n"
+          "Chr_01,G1,\"join(11..60,101..150)\"\n"
+          "Chr_02,G2,\"complement(201..300)\"\n")
+
+def variant_csv(rows) -> str:
+    return "Chromosome,Region,Type,Reference,Allele,Count\n" + \
+           "".join(f"{cid},{position},SNV,{ref},{alt},1\n" for cid, position, ref, alt in rows)
+
+@pytest.fixture
+def dataset(tmp_path):
+    """ A small input folder and metadata file: three samples over two genes, where S1 and S2 share G1's variants """
+    inputs = tmp_path / "in"
+    inputs.mkdir()
+    with open(inputs / "ref.fa", 'w') as f:
+        for cid, sequence in REFERENCE.items():
+            f.write(f">{cid}\n{sequence}\n")
+    (tmp_path / "meta.csv").write_text(CONFIG)
+    (inputs / "S1_G1.csv").write_text(variant_csv([("Chr_01", 12, "T", "C"), ("Chr_01", 102, "C", "A")]))
+    (inputs / "S2_G1.csv").write_text(variant_csv([("Chr_01", 12, "T", "C"), ("Chr_01", 102, "C", "A")]))
+    (inputs / "S3_G1.csv").write_text(variant_csv([("Chr_01", 13, "A", "G")]))
+    (inputs / "S1_G2.csv").write_text(variant_csv([("Chr_02", 202, "T", "G")]))
+    return tmp_path
+
+def run_ava(*args, cwd=None) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=str(SRC))
+    return subprocess.run([sys.executable, "-m", "ava.ava", *map(str, args)], cwd=cwd, env=env,
+                          capture_output=True, text=True)
@@ -0,0 +1,60 @@
+import pytest
+
+from ava.annotations import load_regions, parse_location
+
+from conftest import CONFIG, run_ava
+
+def test_parse_location():
+    regions = parse_location("join(complement(10..20),complement(1..5))")
+    assert list(regions) == [range(9, 20), range(0, 5)]
+    assert regions.strand == "-"
+
+def test_csv_with_byte_order_mark(tmp_path):
+    plain = tmp_path / "plain.csv"
+    plain.write_text(CONFIG)
+    marked = tmp_path / "marked.csv"
+    marked.write_bytes(b"\xef\xbb\xbf" + CONFIG.encode())
+    assert load_regions(marked) == load_regions(plain)
+    assert list(load_regions(marked)[0]["Chr_01"]["G1"]) == [range(10, 60), range(100, 150)]
+
+GENBANK = ("LOCUS       Chr_01     600 bp    DNA     linear   UNK\n"
+           "FEATURES             Location/Qualifiers\n"
+           "     gene            11..60\n"
+           "                     /locus_tag=\"G1\"\n"
+           "     gene            OTHER.1:100..200\n"
+           "                     /locus_tag=\"G2\"\n"
+           "ORIGIN\n"
+           "//\n")
+
+def test_genbank_warnings_are_events(tmp_path, capsys):
+    path = tmp_path / "genes.gbk"
+    path.write_text(GENBANK)
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    for _ in range(2):
+        # Parsed the first time, then read back from the cache along with its warnings
+        regions, warnings = load_regions(path, cache_dir=cache_dir)
+        assert {cid: list(genes) for cid, genes in regions.items()} == {"Chr_01": ["G1"]}
+        assert [category for category, _ in warnings] == ["unreadable_feature"]
+        assert "skipped 1 features" in warnings[0][1]
+    assert capsys.readouterr().out == ""
+
+def test_csv_blank_region(tmp_path):
+    path = tmp_path / "meta.csv"
+    path.write_text(CONFIG + "Chr_02,G3,\n")
+    with pytest.raises(ValueError, match="line 4: gene G3 has no Region"):
+        load_regions(path)
+
+def test_csv_missing_column(tmp_path):
+    path = tmp_path / "meta.csv"
+    path.write_text("Chromosome_ID,Gene_ID\nChr_01,G1\n")
+    with pytest.raises(ValueError, match="missing the Region column"):
+        load_regions(path)
+
+def test_cli_blank_region(dataset):
+    (dataset / "meta.csv").write_text(CONFIG + "Chr_02,G3,\n")
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", dataset / "out", "--index-cache",
+                     dataset / "cache", "--workers", "1")
+    assert result.returncode != 0
+    assert "gene G3 has no Region" in result.stdout
+    assert "Traceback" not in result.stderr
@@ -0,0 +1,32 @@
+from ava.api import MemoryReference, apply_variants
+
+REFERENCE = {"Chr_01": "ACGT" * 500}
+CONFIG = {"Chr_01": {f"G{i}": [range(i * 20, i * 20 + 10)] for i in range(50)}}
+VARIANTS = {"S1": {"Chr_01": {f"G{i}": {i * 20: ("A", "T")} for i in range(50)}},
+            "S2": {"Chr_01": {"G3": {61: ("C", "G")}}}}
+
+def test_workers_give_the_same_sequences():
+    events = []
+    serial = list(apply_variants(REFERENCE, CONFIG, VARIANTS, log=events.extend))
+    assert len(serial) == 51
+    assert ("S1", "Chr_01", "G0", b"TCGTACGTAC") in serial
+    assert ("S2", "Chr_01", "G3", b"AGGTACGTAC") in serial
+    assert events == []
+    assert sorted(apply_variants(REFERENCE, CONFIG, VARIANTS, workers=2)) == sorted(serial)
+
+def test_regions_are_read_as_results_are_taken(monkeypatch):
+    fetched = []
+    fetch = MemoryReference.fetch
+
+    def counted_fetch(self, cid, start, stop):
+        fetched.append((cid, start, stop))
+        return fetch(self, cid, start, stop)
+
+    monkeypatch.setattr(MemoryReference, "fetch", counted_fetch)
+
+    results = apply_variants(REFERENCE, CONFIG, VARIANTS, workers=2)
+    next(results)
+    # Only the first few batches have been handed out
+    assert 0 < len(fetched) < len(CONFIG["Chr_01"])
+    assert len(list(results)) == 50
+    assert len(fetched) == len(CONFIG["Chr_01"])
@@ -0,0 +1,119 @@
+import gzip
+import io
+import struct
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ava.bgzf import (BgzfReader, BgzfWriter, EOF_BLOCK, MAX_BLOCK_DATA, build_gzi, compress_block,
+                      linear_index_offset, read_gzi, write_gzi)
+from ava.region_index import RegionIndex
+from ava.vcf import _records, load_vcf
+
+HEADER = [b"##fileformat=VCFv4.2\n", b"#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\tS2\n"]
+
+def write_indexed_vcf(path, lines):
+    """ One line per block, with a .tbi holding the linear index """
+    intervals = {}
+    with open(path, 'wb') as f:
+        for line in lines:
+            if not line.startswith(b"#"):
+                cid, position = line.decode().split("\t")[:2]
+                windows = intervals.setdefault(cid, [])
+                window = (int(position) - 1) >> 14
+                windows.extend([0] * (window + 1 - len(windows)))
+                for i in range(window + 1):
+                    windows[i] = windows[i] or f.tell() << 16
+            f.write(compress_block(line))
+        f.write(EOF_BLOCK)
+
+    names = b"".join(cid.encode() + b"\x00" for cid in intervals)
+    data = b"TBI\x01" + struct.pack("<8i", len(intervals), 2, 1, 2, 0, ord("#"), 0, len(names)) + names
+    for windows in intervals.values():
+        data += struct.pack(f"<ii{len(windows)}Q", 0, len(windows), *windows)
+    with gzip.open(f"{path}.tbi", 'wb') as f:
+        f.write(data)
+
+def test_writer_reader_round_trip(tmp_path):
+    path = tmp_path / "lines.gz"
+    lines = [f"line {i} {'x' * (i % 97)}\n".encode() for i in range(5000)]
+    with ThreadPoolExecutor(2) as executor, BgzfWriter(open(path, 'wb'), executor) as writer:
+        for line in lines:
+            writer.write(line)
+
+    data = b"".join(lines)
+    assert len(data) > 3 * MAX_BLOCK_DATA
+    assert gzip.decompress(path.read_bytes()) == data
+    assert path.read_bytes().endswith(EOF_BLOCK)
+
+    with BgzfReader(path) as reader:
+        reader.seek(0)
+        assert list(reader) == lines
+
+    entries = build_gzi(path)
+    assert [uncompressed for _, uncompressed in entries[:4]] == [0, MAX_BLOCK_DATA, 2 * MAX_BLOCK_DATA,
+                                                                 3 * MAX_BLOCK_DATA]
+    gzi = tmp_path / "lines.gz.gzi"
+    with open(gzi, 'wb') as f:
+        write_gzi(entries, f)
+    assert read_gzi(gzi) == entries
+
+    # Jump into the middle of the second block
+    compressed, uncompressed = entries[1]
+    with BgzfReader(path) as reader:
+        reader.seek(compressed << 16 | 100)
+        assert b"".join(reader) == data[uncompressed + 100:]
+
+def test_reader_without_final_newline(tmp_path):
+    path = tmp_path / "lines.gz"
+    path.write_bytes(compress_block(b"a\nb") + compress_block(b"c\n") + compress_block(b"d") + EOF_BLOCK)
+    with BgzfReader(path) as reader:
+        reader.seek(0)
+        assert list(reader) == [b"a\n", b"bc\n", b"d"]
+
+def test_write_gzi_leaves_out_first_block():
+    f = io.BytesIO()
+    write_gzi([(0, 0), (100, MAX_BLOCK_DATA)], f)
+    assert f.getvalue() == struct.pack("<QQQ", 1, 100, MAX_BLOCK_DATA)
+
+def test_linear_index_offset():
+    intervals = [10 << 16, 0, 0, 30 << 16]
+    assert linear_index_offset(intervals, 0) == 10 << 16
+    # Empty windows fall back to the closest populated one before them
+    assert linear_index_offset(intervals, 2 << 14) == 10 << 16
+    assert linear_index_offset(intervals, 3 << 14) == 30 << 16
+    # Past the last window
+    assert linear_index_offset(intervals, 100 << 14) == 30 << 16
+    assert linear_index_offset([], 5) == 0
+
+def test_tabix_record_at_chromosome_start(tmp_path):
+    path = tmp_path / "calls.vcf.gz"
+    records = [b"Chr_01\t12\t.\tT\tC\t.\tPASS\t.\tGT\t0/1\t0/0\n",
+               b"Chr_01\t102\t.\tC\tA\t.\tPASS\t.\tGT\t1/1\t0/1\n",
+               b"Chr_02\t202\t.\tT\tG\t.\tPASS\t.\tGT\t0/0\t0|1\n"]
+    write_indexed_vcf(path, HEADER + records)
+    index = RegionIndex({"Chr_01": {"G1": [range(10, 60), range(100, 150)]}, "Chr_02": {"G2": [range(200, 300)]}})
+
+    assert list(_records(path, index)) == HEADER + records
+
+    variants, warnings = load_vcf(path, index)
+    assert warnings == []
+    assert sorted(variants["S1"]["Chr_01"]["G1"].items()) == [(11, ("T", "C")), (101, ("C", "A"))]
+    assert sorted(variants["S2"]["Chr_02"]["G2"].items()) == [(201, ("T", "G"))]
+
+def test_tabix_skips_other_chromosomes(tmp_path):
+    path = tmp_path / "calls.vcf.gz"
+    records = [b"Chr_01\t12\t.\tT\tC\t.\tPASS\t.\tGT\t0/1\t0/0\n",
+               b"Chr_02\t202\t.\tT\tG\t.\tPASS\t.\tGT\t0/0\t0|1\n"]
+    write_indexed_vcf(path, HEADER + records)
+    index = RegionIndex({"Chr_02": {"G2": [range(200, 300)]}})
+    assert list(_records(path, index)) == HEADER + records[1:]
+
+def test_genotype_past_alt_is_skipped(tmp_path):
+    path = tmp_path / "calls.vcf"
+    path.write_bytes(b"".join(HEADER) + b"Chr_01\t12\t.\tT\tC\t.\tPASS\t.\tGT\t0/2\t1/1\n")
+    index = RegionIndex({"Chr_01": {"G1": [range(10, 60)]}})
+    variants, warnings = load_vcf(path, index)
+    assert len(variants["S1"]["Chr_01"]["G1"]) == 0
+    assert sorted(variants["S2"]["Chr_01"]["G1"].items()) == [(11, ("T", "C"))]
+    assert [category for category, _ in warnings] == ["skipped_calls"]
+    assert "skipped 1 calls" in warnings[0][1]
@@ -0,0 +1,56 @@
+import os
+import time
+
+from ava.catalog import Catalog
+
+def age(*folders):
+    """ Move folder mtimes back past the racy window, as if they were last changed a while ago """
+    past = time.time() - 60
+    for folder in folders:
+        os.utime(folder, (past, past))
+
+def test_catalog_kinds(tmp_path):
+    (tmp_path / "sub").mkdir()
+    for name in ("S1_G1.csv", "S2_G1.csv.gz", "ref.fa", "notes.txt", "sub/ref.fasta.gz", "sub/S3_G1.csv"):
+        (tmp_path / name).write_text("")
+    catalog = Catalog(tmp_path)
+    assert catalog.variants == [tmp_path / "S1_G1.csv", tmp_path / "S2_G1.csv.gz", tmp_path / "sub" / "S3_G1.csv"]
+    assert catalog.sequences == [tmp_path / "ref.fa", tmp_path / "sub" / "ref.fasta.gz"]
+
+def test_catalog_snapshot(tmp_path):
+    root = tmp_path / "in"
+    (root / "sub" / "deep").mkdir(parents=True)
+    (root / "S1_G1.csv").write_text("")
+    (root / "sub" / "S2_G1.csv").write_text("")
+    (root / "sub" / "deep" / "ref.fa").write_text("")
+    age(root, root / "sub", root / "sub" / "deep")
+    snapshot = tmp_path / "scan.json"
+
+    first = Catalog(root, snapshot)
+    assert (first.scanned, first.reused) == (3, 0)
+
+    second = Catalog(root, snapshot)
+    assert (second.scanned, second.reused) == (0, 3)
+    assert second.files == first.files
+
+    # Only the folder that changed is listed again
+    (root / "sub" / "S3_G1.csv").write_text("")
+    third = Catalog(root, snapshot)
+    assert (third.scanned, third.reused) == (1, 2)
+    assert third.variants == [root / "S1_G1.csv", root / "sub" / "S2_G1.csv", root / "sub" / "S3_G1.csv"]
+    assert third.sequences == first.sequences
+
+    # Folders changed just before the scan are listed every time
+    fourth = Catalog(root, snapshot)
+    assert (fourth.scanned, fourth.reused) == (1, 2)
+
+def test_snapshot_of_another_root_is_ignored(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / f"{name}.csv").write_text("")
+        age(tmp_path / name)
+    snapshot = tmp_path / "scan.json"
+    Catalog(tmp_path / "a", snapshot)
+    other = Catalog(tmp_path / "b", snapshot)
+    assert other.reused == 0
+    assert other.variants == [tmp_path / "b" / "b.csv"]
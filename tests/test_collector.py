@@ -0,0 +1,30 @@
+import gzip
+
+import ava.collector
+
+from ava.bgzf import EOF_BLOCK
+from ava.collector import RecordCollector
+
+def test_evicted_compressed_files_are_finished(tmp_path, monkeypatch):
+    monkeypatch.setattr(ava.collector, "MAX_OPEN_FILES", 2)
+    with RecordCollector(tmp_path, "sample", 60, compress_threads=1) as collector:
+        for sample in range(4):
+            collector.add(f"S{sample}", "Chr_01", "G1", b"ACGT")
+        for sample in range(4):
+            collector.add(f"S{sample}", "Chr_01", "G2", b"TTTT")
+        for sample in range(4):
+            collector.finish(f"S{sample}.fa.gz")
+
+    for sample in range(4):
+        data = (tmp_path / f"S{sample}.fa.gz").read_bytes()
+        assert data.endswith(EOF_BLOCK)
+        assert data.count(EOF_BLOCK) == 1
+        assert gzip.decompress(data) == b">Chr_01_G1\nACGT\n>Chr_01_G2\nTTTT\n"
+
+def test_close_finishes_evicted_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(ava.collector, "MAX_OPEN_FILES", 1)
+    with RecordCollector(tmp_path, "gene", 60, compress_threads=1) as collector:
+        collector.add("S1", "Chr_01", "G1", b"ACGT")
+        collector.add("S1", "Chr_01", "G2", b"ACGT")
+    assert (tmp_path / "Chr_01_G1.fa.gz").read_bytes().endswith(EOF_BLOCK)
+    assert (tmp_path / "Chr_01_G2.fa.gz").read_bytes().endswith(EOF_BLOCK)
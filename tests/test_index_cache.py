@@ -0,0 +1,40 @@
+import gzip
+import multiprocessing
+
+from ava.fasta_reader import index_reference, open_reference
+from ava.index_cache import atomic_open
+
+from conftest import REFERENCE
+
+def build(args):
+    path, cache_dir = args
+    reference = index_reference(path, cache_dir)
+    reader = open_reference(reference)
+    try:
+        return bytes(reader.fetch("Chr_02", 0, 20))
+    finally:
+        reader.close()
+
+def test_concurrent_gzip_reference(tmp_path):
+    path = tmp_path / "ref.fa.gz"
+    with gzip.open(path, 'wt') as f:
+        for cid, sequence in REFERENCE.items():
+            f.write(f">{cid}\n{sequence}\n")
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        results = pool.map(build, [(path, cache_dir)] * 8, chunksize=1)
+    assert results == [REFERENCE["Chr_02"][:20].encode()] * 8
+    assert not list(cache_dir.glob("*.tmp"))
+
+def test_atomic_open_keep_existing(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"first")
+    with atomic_open(path, 'wb', keep_existing=True) as f:
+        f.write(b"second")
+    assert path.read_bytes() == b"first"
+    with atomic_open(path, 'wb') as f:
+        f.write(b"second")
+    assert path.read_bytes() == b"second"
+    assert [item.name for item in tmp_path.iterdir()] == ["file"]
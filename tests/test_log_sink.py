@@ -0,0 +1,29 @@
+import json
+
+from ava.log_sink import LogSink
+
+from conftest import REFERENCE, run_ava, variant_csv
+
+def test_log_sink_counts(tmp_path):
+    log = LogSink(tmp_path / "output.log", tmp_path / "summary.json")
+    log.event("empty_file", "first")
+    log.queue.put([("empty_file", "second"), ("unmapped_gene", "third")])
+    log.close()
+    assert json.loads((tmp_path / "summary.json").read_text()) == {"empty_file": 2, "unmapped_gene": 1}
+    assert (tmp_path / "output.log").read_text().startswith("first\nsecond\nthird\n")
+
+def test_every_worker_event_is_logged(dataset):
+    # Many workers sending many events each, all of which have to reach the log before the run finishes
+    sequence = REFERENCE["Chr_01"]
+    wrong = {"A": "C", "C": "G", "G": "T", "T": "A"}
+    for sample in range(40):
+        rows = [("Chr_01", position, wrong[sequence[position - 1]], sequence[position - 1])
+                for position in range(11, 61, 5)]
+        (dataset / "in" / f"M{sample}_G1.csv").write_text(variant_csv(rows))
+    output = dataset / "out"
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--index-cache",
+                     dataset / "cache", "--workers", "4", "--chunksize", "1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(output / "summary.json", 'r') as f:
+        assert json.load(f) == {"mismatched_reference": 400}
+    assert (output / "output.log").read_text().count("was expecting") == 400
@@ -0,0 +1,47 @@
+from ava.manifest import MANIFEST_NAME, Manifest, member_key, operation_digest
+from ava.variant_store import VariantSet
+
+from conftest import run_ava, variant_csv
+
+def test_manifest_resume(tmp_path):
+    members = {member_key("S1", "Chr_01", "G1"): operation_digest("ref", "Chr_01", [range(10, 60)],
+                                                                    VariantSet.from_dict({11: ("T", "C")}), "")}
+    with Manifest(tmp_path, False) as manifest:
+        manifest.record("S1_G1.fa", members)
+        manifest.record("S2_G1.fa", members)
+    # A line cut short by a killed run
+    with open(tmp_path / MANIFEST_NAME, 'a') as f:
+        f.write('{"output": "S3_G1.fa", "mem')
+    (tmp_path / "S1_G1.fa").write_text("")
+
+    with Manifest(tmp_path, True) as manifest:
+        assert manifest.is_fresh("S1_G1.fa", members)
+        # Recorded, but the file is gone
+        assert not manifest.is_fresh("S2_G1.fa", members)
+        assert not manifest.is_fresh("S3_G1.fa", members)
+        changed = {member_key("S1", "Chr_01", "G1"): operation_digest(
+            "ref", "Chr_01", [range(10, 60)], VariantSet.from_dict({11: ("T", "G")}), "")}
+        assert not manifest.is_fresh("S1_G1.fa", changed)
+    assert len((tmp_path / MANIFEST_NAME).read_text().splitlines()) == 2
+
+    with Manifest(tmp_path, False) as manifest:
+        assert not manifest.is_fresh("S1_G1.fa", members)
+    assert (tmp_path / MANIFEST_NAME).read_text() == ""
+
+def test_incremental_run(dataset):
+    output = dataset / "out"
+
+    def run():
+        result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--index-cache",
+                         dataset / "cache", "--workers", "1", "--incremental")
+        assert result.returncode == 0, result.stdout + result.stderr
+        return result.stdout
+
+    assert "Skipping 0 unchanged of 4 output files" in run()
+    assert "Skipping 4 unchanged of 4 output files" in run()
+
+    (dataset / "in" / "S3_G1.csv").write_text(variant_csv([("Chr_01", 14, "C", "T")]))
+    (output / "Chr_02_S1_G2.fa").unlink()
+    assert "Skipping 2 unchanged of 4 output files" in run()
+    assert (output / "Chr_02_S1_G2.fa").exists()
+    assert "Skipping 4 unchanged of 4 output files" in run()
@@ -0,0 +1,26 @@
+import subprocess
+import sys
+
+from conftest import SRC, run_ava
+
+def test_worker_import_is_minimal():
+    code = "import sys, ava.parallellisation; print('ava.ava' in sys.modules, 'ava.api' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], env={"PYTHONPATH": str(SRC)}, capture_output=True, text=True)
+    assert result.stdout.split() == ["False", "False"], result.stderr
+
+def test_entry_points_import_tqdm_when_run():
+    code = "import sys, ava.pre_ava, ava.post_ava; print('tqdm' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], env={"PYTHONPATH": str(SRC)}, capture_output=True, text=True)
+    assert result.stdout.split() == ["False"], result.stderr
+
+def test_lazy_exports():
+    import ava
+    from ava.api import apply_variants
+    assert ava.apply_variants is apply_variants
+    assert callable(ava.main)
+
+def test_run_as_module_without_warning(dataset):
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", dataset / "out", "--index-cache",
+                     dataset / "cache", "--workers", "2", "--start-method", "spawn")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "RuntimeWarning" not in result.stderr
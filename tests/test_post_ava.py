@@ -0,0 +1,49 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from ava.post_ava import move_in_place
+
+from conftest import SRC, run_ava
+
+def run_post_ava(*args) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=str(SRC))
+    return subprocess.run([sys.executable, "-m", "ava.post_ava", *map(str, args)], env=env, capture_output=True,
+                          text=True)
+
+def read_tree(root):
+    return {str(path.relative_to(root)): path.read_bytes() for path in root.rglob("*.fa")}
+
+def test_move_matches_copy(dataset):
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", dataset / "out", "--index-cache",
+                     dataset / "cache", "--workers", "1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    shutil.copytree(dataset / "out", dataset / "moving")
+
+    assert run_post_ava("-i", dataset / "out", "-o", dataset / "copied", "--workers", "1").returncode == 0
+    assert run_post_ava("-i", dataset / "moving", "-o", dataset / "moved", "--move", "--workers", "1").returncode == 0
+    copied = read_tree(dataset / "copied")
+    assert len(copied) == 4
+    assert read_tree(dataset / "moved") == copied
+    assert not list((dataset / "moving").glob("*.fa"))
+    assert copied["Chr_01_G1/S1.fa"].startswith(b">S1 Chr_01_G1\n")
+
+def test_move_renames_in_place(dataset):
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", dataset / "out", "--index-cache",
+                     dataset / "cache", "--workers", "1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    inodes = {path.name: path.stat().st_ino for path in (dataset / "out").glob("*.fa")}
+
+    assert run_post_ava("-i", dataset / "out", "-o", dataset / "moved", "--move", "--workers", "1").returncode == 0
+    moved = dataset / "moved" / "Chr_02_G2" / "S1.fa"
+    assert moved.stat().st_ino == inodes["Chr_02_S1_G2.fa"]
+    assert moved.read_bytes().startswith(b">S1 Chr_02_G2\n")
+
+def test_move_in_place(tmp_path):
+    file = tmp_path / "Chr_01_S1_G1.fa"
+    file.write_bytes(b">AB\nACGT\n")
+    assert not move_in_place(file, tmp_path / "S1.fa", b">AB\n", b">S")
+    assert move_in_place(file, tmp_path / "S1.fa", b">AB\n", b">S1")
+    assert (tmp_path / "S1.fa").read_bytes() == b">S1\nACGT\n"
+    assert not file.exists()
@@ -0,0 +1,37 @@
+import json
+
+from ava.profiling import task_info
+from ava.variant_store import VariantSet
+
+from conftest import run_ava
+
+def variants(*positions):
+    return VariantSet.from_columns(list(positions), ["A"] * len(positions), ["C"] * len(positions))
+
+def test_task_info_haplotypes():
+    single = task_info(("Chr_01", "G1", [range(0, 10)], None, [(variants(1, 2), ["S1", "S2", "S3"])]))
+    assert single == {"sid": "3 samples", "cid": "Chr_01", "gid": "G1", "bases": 30, "variants": 2, "haplotypes": 1}
+    json.dumps(single)
+
+    several = task_info(("Chr_01", "G1", [range(0, 10)], None, [(variants(1), ["S1"]), (variants(2, 3), ["S2"])]))
+    assert several["sid"] == "2 samples"
+    assert several["variants"] == 3
+    assert several["haplotypes"] == 2
+
+def test_task_info_gene():
+    record = task_info(("Chr_01", "G1", [range(0, 10)], None, [("S1", variants(1)), ("S2", variants(2, 3))]))
+    assert record == {"sid": "2 samples", "cid": "Chr_01", "gid": "G1", "bases": 20, "variants": 3}
+
+def test_dedup_with_profile(dataset):
+    output = dataset / "out"
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--dedup-haplotypes",
+                     "--profile", "--index-cache", dataset / "cache", "--workers", "1")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(output / "profile.json", 'r') as f:
+        tasks = {task["gid"]: task for task in json.load(f)["tasks"]}
+    # S1 and S2 share G1's variants, S3 has its own
+    assert tasks["G1"]["sid"] == "3 samples"
+    assert tasks["G1"]["haplotypes"] == 2
+    assert tasks["G1"]["variants"] == 3
+    assert tasks["G2"]["sid"] == "S1"
+    assert tasks["G2"]["haplotypes"] == 1
@@ -0,0 +1,37 @@
+import numpy
+
+from ava.region_index import RegionIndex
+
+# G2 sits inside G1's first range and G3 overlaps the end of it
+INDEX = RegionIndex({"Chr_01": {"G1": [range(10, 60), range(100, 150)], "G2": [range(20, 30)],
+                                "G3": [range(55, 110)]}})
+
+def test_genes_at():
+    assert INDEX.genes_at("Chr_01", 9) == []
+    assert INDEX.genes_at("Chr_01", 10) == ["G1"]
+    assert sorted(INDEX.genes_at("Chr_01", 25)) == ["G1", "G2"]
+    assert INDEX.genes_at("Chr_01", 30) == ["G1"]
+    assert sorted(INDEX.genes_at("Chr_01", 57)) == ["G1", "G3"]
+    assert INDEX.genes_at("Chr_01", 80) == ["G3"]
+    assert INDEX.genes_at("Chr_01", 149) == ["G1"]
+    assert INDEX.genes_at("Chr_01", 150) == []
+    assert INDEX.genes_at("Chr_02", 25) == []
+
+def test_bounds():
+    assert INDEX.chromosomes() == ["Chr_01"]
+    assert INDEX.genes("Chr_01") == ["G1", "G2", "G3"]
+    assert (INDEX.start("Chr_01"), INDEX.end("Chr_01")) == (10, 150)
+    assert "Chr_02" not in INDEX
+
+def test_route_matches_genes_at():
+    positions = numpy.array([200, 25, 57, 0, 105, 80, 25, 149, 150])
+    routed, dropped = INDEX.route("Chr_01", positions)
+    assert dropped == 3
+    for gid, indices in routed.items():
+        assert indices.tolist() == [i for i, position in enumerate(positions.tolist())
+                                    if gid in INDEX.genes_at("Chr_01", position)]
+    assert sorted(routed) == ["G1", "G2", "G3"]
+
+def test_route_unknown_chromosome():
+    routed, dropped = INDEX.route("Chr_02", numpy.array([1, 2]))
+    assert routed == {} and dropped == 2
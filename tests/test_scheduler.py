@@ -0,0 +1,21 @@
+from ava.scheduler import TASK_OVERHEAD, estimate_cost, schedule
+
+def test_estimate_cost():
+    assert estimate_cost([range(0, 10), range(20, 25)], 0) == TASK_OVERHEAD + 15 * 2
+    assert estimate_cost([range(0, 10)], 2, samples=3) > estimate_cost([range(0, 10)], 2)
+    assert estimate_cost([range(0, 10)], 2) > estimate_cost([range(0, 10)], 1)
+
+def test_longest_first_and_small_tasks_batched():
+    costs = {"a": 1000, "b": 10, "c": 600, "d": 10, "e": 10, "f": 10}
+    # Target batch cost is 1640 / 8 with one worker, so a and c go out on their own
+    batches = schedule(list(costs), costs.get, workers=1)
+    assert batches == [["a"], ["c"], ["b", "d", "e", "f"]]
+
+def test_chunksize_limits_batches():
+    tasks = list(range(10))
+    batches = schedule(tasks, lambda task: 1, workers=1, chunksize=3)
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+    assert sorted(task for batch in batches for task in batch) == tasks
+
+def test_empty():
+    assert schedule([], len, workers=4) == []
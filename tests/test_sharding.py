@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from ava.sharding import assign_shards, select_shard
+
+from conftest import SRC, run_ava
+
+COSTS = {f"S{sample}_G{gene}.fa": sample * 100 + gene for sample in range(1, 8) for gene in range(1, 4)}
+
+def run_merge(*args) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=str(SRC))
+    return subprocess.run([sys.executable, "-m", "ava.merge", *map(str, args)], env=env, capture_output=True,
+                          text=True)
+
+@pytest.mark.parametrize("mode", ["hash", "cost"])
+def test_assignment_is_stable_and_disjoint(mode):
+    assigned = assign_shards(COSTS, 3, mode)
+    assert set(assigned.values()) <= {1, 2, 3}
+    # The same keys in any order get the same shards
+    assert assign_shards(dict(reversed(list(COSTS.items()))), 3, mode) == assigned
+
+    tasks = [(key, part) for key in COSTS for part in range(2)]
+    selected = [select_shard(tasks, lambda task: task[0], lambda task: COSTS[task[0]], shard, 3, mode)
+                for shard in (1, 2, 3)]
+    assert sorted(task for part in selected for task in part) == sorted(tasks)
+    # Tasks sharing a key stay together
+    for shard, part in enumerate(selected, 1):
+        assert all(assigned[key] == shard for key, _ in part)
+
+def test_cost_mode_balances():
+    loads = [0, 0, 0]
+    for key, shard in assign_shards(COSTS, 3, "cost").items():
+        loads[shard - 1] += COSTS[key]
+    assert max(loads) - min(loads) <= max(COSTS.values())
+
+def test_hash_does_not_depend_on_the_process():
+    script = f"from ava.sharding import assign_shards; print(sorted(assign_shards({COSTS!r}, 3, 'hash').items()))"
+    expected = f"{sorted(assign_shards(COSTS, 3, 'hash').items())}\n"
+    for seed in ("1", "2"):
+        env = dict(os.environ, PYTHONPATH=str(SRC), PYTHONHASHSEED=seed)
+        result = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True)
+        assert result.stdout == expected
+
+def test_shards_and_merge(dataset):
+    output = dataset / "out"
+    for shard in ("1/2", "2/2"):
+        result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--index-cache",
+                         dataset / "cache", "--workers", "1", "--shard", shard)
+        assert result.returncode == 0, result.stdout + result.stderr
+
+    markers = [json.loads((output / f"shard-{shard}-of-2.done").read_text()) for shard in (1, 2)]
+    outputs = [set(marker["outputs"]) for marker in markers]
+    assert not outputs[0] & outputs[1]
+    assert {path.name for path in output.glob("*.fa")} == outputs[0] | outputs[1]
+    assert len(outputs[0] | outputs[1]) == 4
+
+    result = run_merge("-o", output, "--verify-only")
+    assert result.returncode == 0, result.stdout
+    assert not (output / "summary.json").exists()
+
+    result = run_merge("-o", output, "--clean")
+    assert result.returncode == 0, result.stdout
+    assert json.loads((output / "summary.json").read_text()) == {}
+    assert len((output / "manifest.jsonl").read_text().splitlines()) == 4
+    assert not list(output.glob("*.done")) and not list(output.glob("*.shard-*"))
+
+def test_merge_rejects_missing_done(dataset):
+    output = dataset / "out"
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--index-cache",
+                     dataset / "cache", "--workers", "1", "--shard", "2/2")
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    result = run_merge("-o", output)
+    assert result.returncode != 0
+    assert "Shards not finished: 1 of 2" in result.stdout
+    assert not (output / "output.log").exists()
+
+    (output / "shard-2-of-2.done").unlink()
+    result = run_merge("-o", output)
+    assert result.returncode != 0
+    assert "No finished shards" in result.stdout
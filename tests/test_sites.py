@@ -0,0 +1,76 @@
+import random
+
+import numpy
+
+from ava.parallellisation import apply_variations
+from ava.sites import site_matrix
+from ava.variant_store import VariantSet
+
+from conftest import run_ava
+
+def full_sequences(reference: bytes, ranges, samples):
+    """ What the whole sequence mode writes for each sample, and its mismatch warnings """
+    region = b"".join(reference[subset.start:subset.stop] for subset in ranges)
+    rows = []
+    mismatches = []
+    for _, variations in samples:
+        sequence = bytearray(region)
+        mismatches += apply_variations(sequence, ranges, variations)
+        rows.append(numpy.frombuffer(bytes(sequence), dtype=numpy.uint8))
+    return numpy.frombuffer(region, dtype=numpy.uint8), numpy.array(rows), mismatches
+
+def test_site_matrix():
+    reference = b"AAAACCCCGGGGTTTT"
+    ranges = [range(2, 6), range(10, 14)]
+    samples = [("S1", VariantSet.from_dict({3: ("A", "G"), 11: ("G", "A")})),
+               ("S2", VariantSet.from_dict({3: ("A", "G"), 12: ("T", "C")})),
+               # Outside the ranges, a mismatched reference and a multi base substitution
+               ("S3", VariantSet.from_dict({0: ("A", "T"), 4: ("G", "T"), 12: ("TT", "GA")}))]
+    fetch = lambda ranges: b"".join(reference[subset.start:subset.stop] for subset in ranges)
+
+    positions, bases, matrix, mismatches = site_matrix(ranges, samples, fetch)
+    assert positions.tolist() == [3, 4, 11, 12, 13]
+    assert bases.tobytes() == b"ACGTT"
+    assert [row.tobytes() for row in matrix] == [b"GCATT", b"GCGCT", b"ATGGA"]
+    assert mismatches == [(4, "G", "C")]
+
+def test_site_matrix_matches_full_sequences():
+    rng = random.Random(0)
+    for _ in range(200):
+        reference = bytes(rng.choice(b"ACGT") for _ in range(200))
+        ranges = []
+        for _ in range(rng.randint(1, 3)):
+            start = rng.randint(0, 190)
+            ranges.append(range(start, rng.randint(start + 1, min(200, start + 60))))
+        samples = []
+        for sample in range(rng.randint(1, 4)):
+            variations = {}
+            for _ in range(rng.randint(0, 10)):
+                position = rng.randint(0, 199)
+                length = 1 if rng.random() < 0.8 else rng.randint(1, 3)
+                current = reference[position:position + length].decode() or "A"
+                # Multi base variants may also be insertions or deletions, which are left out
+                allele = "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 3) if length > 1 else 1))
+                variations[position] = (current if rng.random() < 0.9 else rng.choice("ACGT"), allele)
+            samples.append((f"S{sample}", VariantSet.from_dict(variations)))
+        fetch = lambda ranges: b"".join(reference[subset.start:subset.stop] for subset in ranges)
+
+        positions, bases, matrix, mismatches = site_matrix(ranges, samples, fetch)
+        region, rows, expected = full_sequences(reference, ranges, samples)
+        columns = numpy.flatnonzero((rows != region).any(axis=0))
+        assert (matrix == rows[:, columns]).all()
+        assert (bases == region[columns]).all()
+        assert mismatches == expected
+
+def test_cli_sites(dataset):
+    output = dataset / "out"
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--index-cache",
+                     dataset / "cache", "--workers", "2", "--sites", "phylip")
+    assert result.returncode == 0, result.stdout + result.stderr
+
+    assert (output / "Chr_01_G1.sites.tsv").read_text() == "Position\tReference\n12\tT\n13\tA\n102\tC\n"
+    lines = (output / "Chr_01_G1.phy").read_text().splitlines()
+    assert lines[0] == "3 3"
+    assert sorted(line.split() for line in lines[1:]) == [["S1", "CAA"], ["S2", "CAA"], ["S3", "TGC"]]
+    assert (output / "Chr_02_G2.phy").exists()
+    assert not list(output.glob("*.fa"))
@@ -0,0 +1,47 @@
+import json
+
+from ava.parallellisation import parse_sample_variants_compat, parse_variant_compat
+
+from conftest import CONFIG, run_ava, variant_csv
+
+def test_parse_other_csv(tmp_path):
+    path = tmp_path / "metadata.csv"
+    path.write_text(CONFIG)
+    for parse, args in ((parse_variant_compat, (path, {}, {})), (parse_sample_variants_compat, (path, None))):
+        values, warnings = parse(args)
+        assert values is None
+        assert [category for category, _ in warnings] == ["unreadable_file"]
+
+def test_other_csv_in_input(dataset):
+    # A metadata file left in the input folder while --config points at another one
+    (dataset / "in" / "metadata.csv").write_text(CONFIG)
+    output = dataset / "out"
+    result = run_ava("-i", dataset / "in", "-c", dataset / "meta.csv", "-o", output, "--index-cache",
+                     dataset / "cache", "--workers", "2")
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(output / "summary.json", 'r') as f:
+        assert json.load(f) == {"unreadable_file": 1}
+    assert len(list(output.glob("*.fa"))) == 4
+
+def test_only_substitutions_within_a_range_are_applied():
+    from ava.parallellisation import apply_variations, mismatch_events
+    from ava.variant_store import VariantSet
+
+    reference = b"AAAACCCCGGGGTTTT"
+    ranges = [range(0, 4), range(8, 12)]
+    region = bytearray(reference[0:4] + reference[8:12])
+    # Runs from the end of the first range into the second, a deletion, an insertion and a substitution
+    variations = VariantSet.from_dict({3: ("AG", "TT"), 0: ("AA", "A"), 9: ("G", "GTT"), 10: ("GG", "TC")})
+    mismatches = apply_variations(region, ranges, variations)
+    assert bytes(region) == b"AAAAGGTC"
+    assert sorted(mismatches) == [(0, "AA", None), (3, "AG", None), (9, "G", None)]
+    assert {category for category, _ in mismatch_events(mismatches)} == {"unapplied_variant"}
+
+def test_csv_indels_are_skipped(tmp_path):
+    path = tmp_path / "S1_G1.csv"
+    path.write_text(variant_csv([("Chr_01", 12, "T", "C"), ("Chr_01", 20, "TA", "T"), ("Chr_01", 30, "G", "GCC"),
+                                 ("Chr_01", 40, "AC", "GT")]))
+    (sid, cid, gid, variations), warnings = parse_variant_compat((path, {"Chr_01": {"G1"}}, {}))
+    assert sorted(variations.items()) == [(11, ("T", "C")), (39, ("AC", "GT"))]
+    assert [category for category, _ in warnings] == ["skipped_calls"]
+    assert "skipped 2 variants" in warnings[0][1]